@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Benchmark of the composition and solving pipeline over the v4 grid (size x mode x gamma).
+
+Each configuration runs in a fresh process (so that the peak RSS is its own,
+and nothing is reused from previous runs), and the stages are timed
+separately: service building, build_system_service, DFA compilation,
+composition and solving. The results are written as JSON and, optionally,
+compared against a stored baseline.
+
+Usage (from the repository root):
+
+    python -m docs.notebooks.benchmark --sizes small medium --modes automata ltlf --gammas 0.9 \
+        --output experimental_restults/benchmark.json --baseline experimental_restults/benchmark_baseline.json
+
+The baseline is not versioned, as the timings depend on the machine: create
+it once on the benchmark machine, from a known-good revision, with
+
+    python -m docs.notebooks.benchmark --baseline experimental_restults/benchmark_baseline.json --save-baseline
+
+and then pass the same --baseline to the later runs, with the same grid options.
+
+With the sparse and parallel solvers, --dtype float32 and --palette solve a
+compact variant of the MDP (see compact_encoding); the policy is then
+validated against the float64 one, and a mismatch is reported as a regression.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from typing import Dict, List, Optional
+
+SIZES = ["small", "medium", "large"]
+MODES = ["automata", "ltlf"]
+GAMMAS = [0.9]
+SOLVERS = ["dp", "sparse", "parallel"]
+DTYPES = ["float64", "float32"]
+STAGES = ["services", "system_service", "dfa", "composition", "solving"]
+DEFAULT_THRESHOLD = 0.2
+# differences below this number of seconds are considered noise
+DEFAULT_MIN_SECONDS = 0.5
+
+
+def peak_rss_mb() -> float:
+    """Get the peak resident set size of the current process, in MB."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss / 1024 ** 2 if sys.platform == "darwin" else max_rss / 1024
+
+
+def count_transitions(mdp) -> int:
+    """Count the (state, action, next state) transitions of an MDP."""
+    return sum(
+        len(next_states)
+        for transitions_by_action in mdp.transitions.values()
+        for next_states in transitions_by_action.values()
+    )
+
+
+def run_configuration(
+    mode: str, size: str, gamma: float, solver: str, dtype: str = "float64", palette: bool = False
+) -> Dict:
+    """Run one configuration of the grid, and return its measures."""
+    from docs.notebooks.setup_v4 import process_services, target_service_automata, target_service_ltlf
+    from stochastic_service_composition.composition_mdp import comp_mdp, composition_mdp
+    from stochastic_service_composition.services import build_system_service
+
+    stages: Dict[str, float] = {}
+    peak_rss: Dict[str, float] = {}
+
+    def timed(stage, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        stages[stage] = time.perf_counter() - start
+        peak_rss[stage] = peak_rss_mb()
+        return result
+
+    services = timed("services", process_services, mode, size)
+    # the composition reuses the system service, so that its stage only times the composition
+    system_service = timed("system_service", build_system_service, *services)
+    if mode == "automata":
+        target = timed("dfa", target_service_automata)
+        mdp = timed("composition", composition_mdp, target, *services, gamma=gamma, system_service=system_service)
+    else:
+        target = timed("dfa", target_service_ltlf)
+        mdp = timed("composition", comp_mdp, target, services, gamma=gamma, system_service=system_service)
+
+    validation = None
+    if solver == "dp":
+        from mdp_dp_rl.algorithms.dp.dp_analytic import DPAnalytic
+
+        timed("solving", lambda: DPAnalytic(mdp, 1e-4).get_optimal_policy_vi())
+    else:
+        from stochastic_service_composition.compact_encoding import compact_variant, validate_compact_variant
+        from stochastic_service_composition.compact_mdp import CompactMDP
+        from stochastic_service_composition.parallel_solver import parallel_value_iteration
+        from stochastic_service_composition.sparse_solvers import value_iteration
+
+        solve = value_iteration if solver == "sparse" else parallel_value_iteration
+        compact = CompactMDP.from_mdp(mdp)
+        variant = compact_variant(compact, dtype, palette) if dtype != "float64" or palette else compact
+        timed("solving", solve, variant)
+        if variant is not compact:
+            # not timed: it solves both MDPs again
+            validation = validate_compact_variant(compact, variant)
+
+    return {
+        "mode": mode,
+        "size": size,
+        "gamma": gamma,
+        "solver": solver,
+        "dtype": dtype,
+        "palette": palette,
+        "validation": validation,
+        "nb_services": len(services),
+        "nb_states": len(mdp.all_states),
+        "nb_transitions": count_transitions(mdp),
+        "stages": stages,
+        "peak_rss_mb": peak_rss,
+    }
+
+
+def run_grid(
+    sizes: List[str],
+    modes: List[str],
+    gammas: List[float],
+    solver: str,
+    dtype: str = "float64",
+    palette: bool = False,
+) -> List[Dict]:
+    """Run every configuration of the grid, each one in a fresh process."""
+    results = []
+    for size in sizes:
+        for mode in modes:
+            for gamma in gammas:
+                print(f"Running mode={mode}, size={size}, gamma={gamma}, solver={solver}...")
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                    try:
+                        result = executor.submit(
+                            run_configuration, mode, size, gamma, solver, dtype, palette
+                        ).result()
+                    except Exception as e:
+                        result = {
+                            "mode": mode,
+                            "size": size,
+                            "gamma": gamma,
+                            "solver": solver,
+                            "dtype": dtype,
+                            "palette": palette,
+                            "error": repr(e),
+                        }
+                print(json.dumps(result))
+                results.append(result)
+    return results
+
+
+def _key(result: Dict):
+    """Get the key of a configuration, to match results across runs."""
+    return (
+        result["mode"],
+        result["size"],
+        result["gamma"],
+        result["solver"],
+        result.get("dtype", "float64"),
+        result.get("palette", False),
+    )
+
+
+def policy_mismatches(results: List[Dict]) -> List[str]:
+    """Get the description of each configuration whose compact variant does not yield the float64 policy."""
+    mismatches = []
+    for result in results:
+        validation = result.get("validation")
+        if validation is not None and not validation["policy_matches"]:
+            name = "mode={}, size={}, gamma={}, solver={}, dtype={}, palette={}".format(*_key(result))
+            mismatches.append(f"{name}: max regret {validation['max_regret']:.3g}")
+    return mismatches
+
+
+def compare(
+    results: List[Dict],
+    baseline: List[Dict],
+    threshold: float = DEFAULT_THRESHOLD,
+    min_seconds: float = DEFAULT_MIN_SECONDS,
+) -> List[str]:
+    """
+    Compare the results against a baseline.
+
+    :param results: the current results.
+    :param baseline: the baseline results.
+    :param threshold: the maximum allowed relative slowdown (or memory increase) of a stage.
+    :param min_seconds: the minimum absolute slowdown of a stage to be reported.
+    :return: the description of each regression.
+    """
+    baseline_by_key = {_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        reference = baseline_by_key.get(_key(result))
+        if reference is None or "error" in reference:
+            continue
+        name = "mode={}, size={}, gamma={}, solver={}, dtype={}, palette={}".format(*_key(result))
+        if "error" in result:
+            regressions.append(f"{name}: failed ({result['error']})")
+            continue
+        for stage in STAGES:
+            current, previous = result["stages"].get(stage), reference["stages"].get(stage)
+            if current is None or previous is None:
+                continue
+            if current > previous * (1 + threshold) and current - previous > min_seconds:
+                regressions.append(f"{name}, {stage}: {previous:.2f} s -> {current:.2f} s")
+        current_rss, previous_rss = max(result["peak_rss_mb"].values()), max(reference["peak_rss_mb"].values())
+        if current_rss > previous_rss * (1 + threshold):
+            regressions.append(f"{name}, peak RSS: {previous_rss:.0f} MB -> {current_rss:.0f} MB")
+        for count in ["nb_states", "nb_transitions"]:
+            if result[count] != reference[count]:
+                regressions.append(f"{name}, {count}: {reference[count]} -> {result[count]}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=SIZES)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--gammas", nargs="+", type=float, default=GAMMAS)
+    parser.add_argument("--solver", choices=SOLVERS, default="dp")
+    parser.add_argument("--dtype", choices=DTYPES, default="float64", help="with the sparse and parallel solvers")
+    parser.add_argument("--palette", action="store_true", help="dictionary-encode probabilities and rewards")
+    parser.add_argument("--output", default="experimental_restults/benchmark.json")
+    parser.add_argument("--baseline", default=None, help="the results to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--save-baseline", action="store_true", help="also write the results as the baseline")
+    args = parser.parse_args(argv)
+
+    if args.solver == "dp" and (args.dtype != "float64" or args.palette):
+        parser.error("--dtype and --palette require the sparse or the parallel solver")
+    if args.save_baseline and args.baseline is None:
+        parser.error("--save-baseline requires --baseline, the path of the baseline to write")
+    if args.baseline is not None and not args.save_baseline and not os.path.exists(args.baseline):
+        parser.error(f"baseline {args.baseline} not found; create it with --save-baseline")
+    results = run_grid(args.sizes, args.modes, args.gammas, args.solver, args.dtype, args.palette)
+    content = {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(content, f, indent=2)
+    print(f"Results written to {args.output}")
+    mismatches = policy_mismatches(results)
+    for mismatch in mismatches:
+        print(f"POLICY MISMATCH: {mismatch}")
+
+    if args.baseline is None:
+        return 1 if len(mismatches) > 0 else 0
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(content, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return 1 if len(mismatches) > 0 else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, threshold=args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    if len(regressions) == 0:
+        print("No regressions.")
+    return 1 if len(regressions) > 0 or len(mismatches) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,10 +2,10 @@
 # coding: utf-8
 import time, json
 from datetime import datetime
-from memory_profiler import profile
 from stochastic_service_composition.declare_utils import *
 from stochastic_service_composition.composition_mdp import composition_mdp
 from stochastic_service_composition.composition_mdp import comp_mdp
+from stochastic_service_composition.profiling import PhaseProfiler
 from mdp_dp_rl.algorithms.dp.dp_analytic import DPAnalytic
 from docs.notebooks.utils import print_policy_data
 import os
@@ -21,6 +21,8 @@ mode = config_json['mode']
 size = config_json['size']
 gamma = config_json['gamma']
 serialize = config_json['serialize']
+profile = config_json.get('profile', False)
+trace_memory = config_json.get('trace_memory', False)
 
 version = config_json['version']
 if version == "v2":
@@ -33,28 +35,27 @@ elif version == "v4":
 now = datetime.now().strftime("%d_%m_%Y-%H_%M_%S")
 
 file_name = f"experimental_results/{now}_time_profiler_{mode}_{size}_{gamma}_{version}.txt"
-fp_compMDP = f"experimental_results/{now}_memory_profiler_composition_{mode}_{size}_{gamma}_{version}.log"
-fp_DPAnalytic = f"experimental_results/{now}_memory_profiler_policy_{mode}_{size}_{gamma}_{version}.log"
+fp_profiler = f"experimental_results/{now}_phase_profiler_{mode}_{size}_{gamma}_{version}.json"
+
+profiler = PhaseProfiler(enabled=profile, trace_memory=trace_memory)
 
 # AUTOMATA
-@profile(stream=open(fp_compMDP, "w+"))
 def execute_composition_automata(target, services):
-    mdp = composition_mdp(target, *services, gamma=gamma)
+    mdp = composition_mdp(target, *services, gamma=gamma, profiler=profiler)
     return mdp
 
 # LTLf
-@profile(stream=open(fp_compMDP, "w+"))
 def execute_composition_ltlf(declare_automaton, services):
     print("Composition MDP computing...")
-    mdp = comp_mdp(declare_automaton, services, gamma=gamma)
+    mdp = comp_mdp(declare_automaton, services, gamma=gamma, profiler=profiler)
     return mdp
 
 # POLICY
-@profile(stream=open(fp_DPAnalytic, "w+"))
 def execute_policy(mdp):
     mdp.gamma = gamma
-    opn = DPAnalytic(mdp, 1e-4)
-    opt_policy = opn.get_optimal_policy_vi()
+    with profiler.phase("policy"):
+        opn = DPAnalytic(mdp, 1e-4)
+        opt_policy = opn.get_optimal_policy_vi()
     return opt_policy
     
 def main():
@@ -149,7 +150,11 @@ def main():
             
 if __name__ == '__main__':
     try:
-        main()
+        with profiler:
+            main()
+        if profile:
+            print(profiler)
+            profiler.write_json(fp_profiler)
     except Exception as e:
         with open(file_name, "w+") as f:
             to_write = f"Esecuzione fallita: {e}"
@@ -2,6 +2,9 @@
 import functools
 import tempfile
 from pathlib import Path
+from typing import Optional
+
+import numpy as np
 
 from IPython.lib.display import FileLink
 from graphviz import Digraph
@@ -12,11 +15,15 @@ from mdp_dp_rl.processes.mdp import MDP
 from mdp_dp_rl.processes.policy import Policy
 from mdp_dp_rl.utils.standard_typevars import VFDictType, QFDictType
 
+from stochastic_service_composition.compact_mdp import CompactMDP
 from stochastic_service_composition.dfa_target import MdpDfa
+from stochastic_service_composition.policy_table import CompactPolicy
+from stochastic_service_composition.q_queries import state_q_values, top_k_actions
 from stochastic_service_composition.rendering import service_to_graphviz, target_to_graphviz, mdp_to_graphviz, \
     mdp_to_graphviz2
 from stochastic_service_composition.services import Service
 from stochastic_service_composition.target import Target
+from stochastic_service_composition.types import State
 
 _image_classes = {
     "png": Image,
@@ -73,7 +80,7 @@ def print_policy_data(policy: Policy):
 
 
 @print_policy_data.register(DetPolicy)
-def print_policy_data(policy: DetPolicy, file_name):
+def _print_det_policy_data(policy: DetPolicy, file_name):
     with open(file_name, "a") as f:
         f.write("Policy:")
         for state, action_probs in policy.policy_data.items():
@@ -82,6 +89,15 @@ def print_policy_data(policy: DetPolicy, file_name):
     return
 
 
+@print_policy_data.register(CompactPolicy)
+def _print_compact_policy_data(policy: CompactPolicy, file_name):
+    with open(file_name, "a") as f:
+        f.write("Policy:\n")
+        for state, unique_action in policy.items():
+            f.write(f"State={state},\tAction={unique_action}\n")
+    return
+
+
 def print_value_function(value_function: VFDictType):
     print("Value function:")
     for state, value in value_function.items():
@@ -95,3 +111,18 @@ def print_q_value_function(q_value_function: QFDictType):
         for action, value in action_value.items():
             print(f"\tAction={action},\tValue={value}")
         print()
+
+
+def print_state_q_values(mdp: CompactMDP, values: np.ndarray, *states: State, k: Optional[int] = None):
+    """Print the Q-values of the given states only (the best k actions, if k is given)."""
+    print("Q-value function:")
+    for state in states:
+        q_values = (
+            top_k_actions(mdp, values, state, k)
+            if k is not None
+            else state_q_values(mdp, values, state).items()
+        )
+        print(f"State={state}:")
+        for action, value in q_values:
+            print(f"\tAction={action},\tValue={value}")
+        print()
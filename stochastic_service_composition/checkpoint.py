@@ -0,0 +1,242 @@
+"""
+This module implements the checkpoints of the long-running computations.
+
+CompositionCheckpoint stores the states expanded by the composition builders,
+with their transitions, in an append-only file of pickled batches: writing a
+checkpoint only appends the states expanded since the previous one, in a
+background thread. On resume, the expanded states are loaded back, and the
+frontier is rebuilt as the set of their successors (and of the seed states)
+that have not been expanded yet. A batch truncated by a crash is discarded.
+
+SolverCheckpoint stores the arrays of a solver (e.g. the value vector) and
+its iteration count, with the name of the solver, its parameters, and the
+fingerprint of the MDP (see CompactMDP.fingerprint); the file is replaced
+atomically. A checkpoint is only restored by the same solver, with the same
+parameters, on the same MDP.
+"""
+import json
+import os
+import pickle
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from stochastic_service_composition.types import Action, Prob, Reward, State
+
+Transitions = Dict[Action, Tuple[Dict[State, Prob], Reward]]
+
+TRANSITIONS_FILE_NAME = "transitions.pkl"
+DEFAULT_CHECKPOINT_STATES = 100000
+DEFAULT_CHECKPOINT_SECONDS = 300.0
+DEFAULT_CHECKPOINT_ITERATIONS = 10
+# the names of the metadata in a solver checkpoint
+_METADATA_NAMES = ("solver", "fingerprint", "parameters")
+
+
+class CompositionCheckpoint:
+    """An append-only checkpoint of the states expanded by a composition builder."""
+
+    def __init__(
+        self,
+        directory: str,
+        every_states: int = DEFAULT_CHECKPOINT_STATES,
+        every_seconds: float = DEFAULT_CHECKPOINT_SECONDS,
+    ):
+        """
+        Initialize the checkpoint.
+
+        :param directory: the directory of the checkpoint; it is created if it does not exist.
+        :param every_states: write a batch when this number of states have been expanded...
+        :param every_seconds: ...or when this time has passed since the previous batch.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, TRANSITIONS_FILE_NAME)
+        self.every_states = every_states
+        self.every_seconds = every_seconds
+        self._batch: List[Tuple[State, Transitions]] = []
+        self._last_time = time.perf_counter()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: Optional[Future] = None
+
+    def load(self) -> Dict[State, Transitions]:
+        """
+        Load the expanded states and their transitions.
+
+        A truncated batch at the end of the file (e.g. after a crash) is discarded.
+
+        :return: the transitions of the expanded states, in expansion order.
+        """
+        result: Dict[State, Transitions] = {}
+        if not os.path.exists(self.path):
+            return result
+        with open(self.path, "rb") as f:
+            valid_size = 0
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError, ValueError, AttributeError):
+                    break
+                result.update(batch)
+                valid_size = f.tell()
+        if valid_size < os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_size)
+        return result
+
+    def _write(self, batch: List[Tuple[State, Transitions]]) -> None:
+        """Append a batch to the file, and sync it to the disk."""
+        with open(self.path, "ab") as f:
+            pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def add(self, state: State, transitions: Transitions) -> None:
+        """
+        Record an expanded state; the transitions must not be modified afterwards.
+
+        :param state: the expanded state.
+        :param transitions: its transitions.
+        """
+        self._batch.append((state, transitions))
+        if len(self._batch) >= self.every_states or (
+            len(self._batch) % 1024 == 0
+            and time.perf_counter() - self._last_time >= self.every_seconds
+        ):
+            self.flush(wait=False)
+
+    def flush(self, wait: bool = True) -> None:
+        """
+        Write the states recorded since the previous batch.
+
+        :param wait: whether to wait for the write to complete.
+        """
+        if self._pending is not None:
+            # at most one write at a time, to keep the batches in order
+            self._pending.result()
+            self._pending = None
+        if len(self._batch) > 0:
+            batch, self._batch = self._batch, []
+            self._last_time = time.perf_counter()
+            self._pending = self._executor.submit(self._write, batch)
+        if wait and self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def close(self) -> None:
+        """Write the remaining states, and stop the background writer."""
+        self.flush(wait=True)
+        self._executor.shutdown()
+
+
+def resume_frontier(
+    transition_function: Dict[State, Transitions], seed_states: List[State]
+) -> List[State]:
+    """
+    Rebuild the frontier of a breadth-first exploration from its expanded states.
+
+    :param transition_function: the transitions of the expanded states.
+    :param seed_states: the states the exploration starts from.
+    :return: the states to be expanded: the seed states and the successors
+      of the expanded states, not expanded yet, without duplicates.
+    """
+    frontier: Dict[State, None] = {}
+    for state in seed_states:
+        if state not in transition_function:
+            frontier[state] = None
+    for transitions in transition_function.values():
+        for next_states, _reward in transitions.values():
+            for next_state in next_states.keys():
+                if next_state not in transition_function:
+                    frontier[next_state] = None
+    return list(frontier.keys())
+
+
+class SolverCheckpoint:
+    """A checkpoint of the arrays and the iteration count of a solver."""
+
+    def __init__(self, path: str, every_iterations: int = DEFAULT_CHECKPOINT_ITERATIONS):
+        """
+        Initialize the checkpoint.
+
+        :param path: the path of the checkpoint file (a .npz archive).
+        :param every_iterations: the number of sweeps between two checkpoints.
+        """
+        self.path = path if path.endswith(".npz") else path + ".npz"
+        self.every_iterations = every_iterations
+        # the solver, its parameters and the fingerprint of the MDP, recorded by restore
+        self.metadata: Optional[Dict[str, Any]] = None
+
+    def load(self) -> Optional[Tuple[int, Dict[str, np.ndarray], Dict[str, Any]]]:
+        """Load the iteration count, the arrays and the metadata (empty if missing), if a checkpoint exists."""
+        if not os.path.exists(self.path):
+            return None
+        with np.load(self.path) as archive:
+            arrays = {name: archive[name] for name in archive.files}
+        metadata = {name: str(arrays.pop(name)) for name in _METADATA_NAMES if name in arrays}
+        if "parameters" in metadata:
+            metadata["parameters"] = json.loads(metadata["parameters"])
+        return int(arrays.pop("iterations")), arrays, metadata
+
+    def save(self, iterations: int, **arrays: np.ndarray) -> None:
+        """
+        Write the iteration count and the arrays, replacing the previous checkpoint atomically.
+
+        The metadata recorded by restore are written too.
+        """
+        metadata = {}
+        if self.metadata is not None:
+            metadata = {
+                "solver": np.array(self.metadata["solver"]),
+                "fingerprint": np.array(self.metadata["fingerprint"]),
+                "parameters": np.array(json.dumps(self.metadata["parameters"], sort_keys=True)),
+            }
+        tmp_path = self.path[: -len(".npz")] + ".tmp.npz"
+        np.savez(tmp_path, iterations=np.array(iterations), **metadata, **arrays)
+        os.replace(tmp_path, self.path)
+
+    def maybe_save(self, iterations: int, **arrays: np.ndarray) -> None:
+        """Write a checkpoint, if the iteration count is a multiple of the checkpoint interval."""
+        if iterations % self.every_iterations == 0:
+            self.save(iterations, **arrays)
+
+    def restore(
+        self, n_states: int, solver: str, fingerprint: str, **parameters: Any
+    ) -> Optional[Tuple[int, Dict[str, np.ndarray]]]:
+        """
+        Load the checkpoint, checking that it was written by the same solver, with the same parameters, on the same MDP.
+
+        The solver, the parameters and the fingerprint are recorded, and written with the next checkpoints.
+
+        :param n_states: the number of states of the MDP being solved.
+        :param solver: the name of the solver.
+        :param fingerprint: the fingerprint of the MDP being solved (see CompactMDP.fingerprint).
+        :param parameters: the parameters of the solver that the arrays depend on (e.g. epsilon).
+        :return: the iteration count and the arrays, if a checkpoint exists.
+        :raises ValueError: if the checkpoint exists, but it does not match.
+        """
+        self.metadata = {"solver": solver, "fingerprint": fingerprint, "parameters": parameters}
+        checkpoint = self.load()
+        if checkpoint is None:
+            return None
+        iterations, arrays, metadata = checkpoint
+        if len(metadata) != len(_METADATA_NAMES):
+            raise ValueError(f"the checkpoint {self.path} has no solver metadata; delete it to start over")
+        if metadata["solver"] != solver:
+            raise ValueError(f"the checkpoint {self.path} was written by {metadata['solver']}, not by {solver}")
+        if metadata["fingerprint"] != fingerprint:
+            raise ValueError(f"the checkpoint {self.path} was written for another MDP")
+        # the parameters go through JSON, as when they are written
+        if metadata["parameters"] != json.loads(json.dumps(parameters)):
+            raise ValueError(
+                f"the checkpoint {self.path} was written with the parameters {metadata['parameters']}, "
+                f"not {parameters}"
+            )
+        for name, array in arrays.items():
+            if name != "active" and len(array) != n_states:
+                raise ValueError(
+                    f"the checkpoint has {len(array)} states, but the MDP has {n_states}"
+                )
+        return iterations, arrays
@@ -0,0 +1,270 @@
+"""
+This module implements the compact encodings of the probabilities and the rewards of a CompactMDP.
+
+The probabilities of the composition come from a handful of constants of the
+services (and their complements), and the rewards from a small table of
+costs; hence, besides storing them in float32 (CompactMDP.astype), they can
+be dictionary-encoded: every probability (reward) is stored as a uint8 or
+uint16 index into a small palette of distinct values. PaletteCompactMDP
+decodes the probabilities one cache-sized chunk of rows at a time during the
+Bellman backups, so the memory traffic of a sweep is the indices and the
+codes, not the floating-point probabilities. The solvers that back up
+through q_values (value_iteration, interval_iteration) and
+parallel_value_iteration, which shares the codes and the palettes with its
+workers, never decode the whole matrix; action_elimination_iteration, which
+slices the decoded matrix, rejects it.
+
+Since float32 rounds the values, validate_compact_variant solves both the
+float64 MDP and its compact variant, and checks that the policies match.
+"""
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+
+from stochastic_service_composition.compact_mdp import CompactMDP
+from stochastic_service_composition.sparse_solvers import DEFAULT_EPSILON, value_iteration
+
+MAX_PALETTE_SIZE = np.iinfo(np.uint16).max + 1
+# the number of transitions decoded at once during a backup
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+
+def palette_encode(array: np.ndarray, dtype=np.float64) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Dictionary-encode an array of floating-point numbers.
+
+    :param array: the array.
+    :param dtype: the floating-point type of the palette.
+    :return: the codes (uint8 or uint16) and the palette, such that palette[codes] == array.
+    """
+    palette, codes = np.unique(np.asarray(array), return_inverse=True)
+    if len(palette) > MAX_PALETTE_SIZE:
+        raise ValueError(
+            f"{len(palette)} distinct values, but a palette holds at most {MAX_PALETTE_SIZE}"
+        )
+    code_dtype = np.uint8 if len(palette) <= np.iinfo(np.uint8).max + 1 else np.uint16
+    return codes.astype(code_dtype).reshape(np.shape(array)), palette.astype(dtype)
+
+
+def chunk_bounds(indptr: np.ndarray, chunk_size: int) -> np.ndarray:
+    """
+    Split the rows of a CSR matrix into chunks of about chunk_size transitions.
+
+    :param indptr: the row offsets of the matrix.
+    :param chunk_size: the number of transitions of a chunk.
+    :return: the bounds of the chunks: chunk i is the rows bounds[i], ..., bounds[i+1] - 1.
+    """
+    targets = np.arange(0, indptr[-1], chunk_size)
+    starts = np.searchsorted(indptr, targets, side="right") - 1
+    return np.unique(np.concatenate([[0], starts, [len(indptr) - 1]]))
+
+
+def add_palette_product(
+    out: np.ndarray,
+    scale: float,
+    probability_codes: np.ndarray,
+    probability_palette: np.ndarray,
+    indices: np.ndarray,
+    indptr: np.ndarray,
+    bounds: np.ndarray,
+    n_columns: int,
+    values: np.ndarray,
+) -> None:
+    """
+    Add scale times the product of a dictionary-encoded CSR matrix and a vector to out, one chunk of rows at a time.
+
+    :param out: the vector to add to, one entry per row.
+    :param scale: the factor of the product (e.g. the discount factor).
+    :param probability_codes: the codes of the non-zero entries.
+    :param probability_palette: the palette of the non-zero entries.
+    :param indices: the column of each non-zero entry.
+    :param indptr: the row offsets.
+    :param bounds: the bounds of the chunks of rows (see chunk_bounds).
+    :param n_columns: the number of columns.
+    :param values: the vector.
+    """
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        nz_start, nz_stop = indptr[start], indptr[stop]
+        chunk = sp.csr_matrix(
+            (
+                probability_palette[probability_codes[nz_start:nz_stop]],
+                indices[nz_start:nz_stop],
+                (indptr[start : stop + 1] - nz_start).astype(indices.dtype),
+            ),
+            shape=(stop - start, n_columns),
+            copy=False,
+        )
+        out[start:stop] += scale * (chunk @ values)
+
+
+class PaletteCompactMDP(CompactMDP):
+    """A CompactMDP whose probabilities and rewards are dictionary-encoded."""
+
+    # the transitions property decodes the whole matrix
+    decodes_transitions = True
+
+    def __init__(
+        self,
+        *args: Any,
+        dtype=np.float64,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        **kwargs: Any,
+    ):
+        """
+        Initialize the MDP; the arguments are the ones of CompactMDP, and the rewards and the transitions are encoded.
+
+        :param dtype: the floating-point type of the palettes (and of the values).
+        :param chunk_size: the number of transitions decoded at once during a backup.
+        """
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        super().__init__(*args, **kwargs)
+
+    @classmethod
+    def from_compact_mdp(cls, mdp: CompactMDP, dtype=np.float64, **kwargs: Any) -> "PaletteCompactMDP":
+        """Encode a CompactMDP; the states and the structure are shared."""
+        return cls(
+            mdp.states,
+            mdp.actions,
+            mdp.sa_ptr,
+            mdp.sa_action,
+            mdp.rewards,
+            mdp.transitions,
+            mdp.gamma,
+            mdp.initial_state,
+            dtype=dtype,
+            **kwargs,
+        )
+
+    @property
+    def rewards(self) -> np.ndarray:
+        """Get the (decoded) reward of each state-action pair."""
+        return self.reward_palette[self.reward_codes]
+
+    @rewards.setter
+    def rewards(self, rewards: np.ndarray) -> None:
+        """Encode the rewards."""
+        self.reward_codes, self.reward_palette = palette_encode(rewards, self.dtype)
+
+    @property
+    def transitions(self) -> sp.csr_matrix:
+        """Get the (decoded) transition matrix; the backups do not use it."""
+        return sp.csr_matrix(
+            (self.probability_palette[self.probability_codes], self.indices, self.indptr),
+            shape=self.shape,
+            copy=False,
+        )
+
+    @transitions.setter
+    def transitions(self, transitions: sp.csr_matrix) -> None:
+        """Encode the transition matrix, and split its rows into chunks of about chunk_size transitions."""
+        self.shape = transitions.shape
+        self.indices = transitions.indices
+        self.indptr = transitions.indptr
+        self.probability_codes, self.probability_palette = palette_encode(transitions.data, self.dtype)
+        self._chunk_bounds = chunk_bounds(self.indptr, self.chunk_size)
+
+    @property
+    def value_dtype(self) -> np.dtype:
+        """Get the floating-point type of the palettes, used for the values too."""
+        return self.dtype
+
+    @property
+    def n_transitions(self) -> int:
+        """Get the number of (non-zero) transitions."""
+        return len(self.indices)
+
+    @property
+    def nbytes(self) -> int:
+        """Get the memory used by the arrays of the MDP, in bytes (the states are not counted)."""
+        return (
+            self.sa_ptr.nbytes
+            + self.sa_action.nbytes
+            + self.reward_codes.nbytes
+            + self.reward_palette.nbytes
+            + self.probability_codes.nbytes
+            + self.probability_palette.nbytes
+            + self.indices.nbytes
+            + self.indptr.nbytes
+        )
+
+    def _fingerprint_arrays(self) -> List[np.ndarray]:
+        """Get the codes and the palettes of the transitions and the rewards, without decoding them."""
+        return [
+            self.indptr,
+            self.indices,
+            self.probability_codes,
+            self.probability_palette,
+            self.reward_codes,
+            self.reward_palette,
+        ]
+
+    def q_values(self, values: np.ndarray) -> np.ndarray:
+        """Compute the Q-value of every state-action pair, decoding the probabilities chunk by chunk."""
+        q_values = self.reward_palette[self.reward_codes]
+        add_palette_product(
+            q_values,
+            self.gamma,
+            self.probability_codes,
+            self.probability_palette,
+            self.indices,
+            self.indptr,
+            self._chunk_bounds,
+            self.shape[1],
+            values,
+        )
+        return q_values
+
+
+def compact_variant(mdp: CompactMDP, dtype=np.float32, palette: bool = False) -> CompactMDP:
+    """
+    Get a compact variant of a (float64) CompactMDP.
+
+    :param mdp: the compact MDP.
+    :param dtype: the floating-point type of the probabilities, the rewards and the values.
+    :param palette: whether to dictionary-encode the probabilities and the rewards.
+    :return: the compact variant.
+    """
+    if palette:
+        return PaletteCompactMDP.from_compact_mdp(mdp, dtype=dtype)
+    return mdp.astype(dtype)
+
+
+def validate_compact_variant(
+    mdp: CompactMDP,
+    variant: CompactMDP,
+    epsilon: float = DEFAULT_EPSILON,
+) -> Dict[str, Any]:
+    """
+    Check that the policy computed on a compact variant is optimal for the float64 MDP.
+
+    Both MDPs are solved with value_iteration.
+    The policies may differ among actions whose Q-values are equal up to the
+    rounding; hence, a policy matches if each of its actions is optimal, up to
+    the tolerance, with respect to the float64 Q-values.
+
+    :param mdp: the float64 compact MDP.
+    :param variant: its compact variant.
+    :param epsilon: the tolerance of value_iteration, also used to compare the Q-values.
+    :return: the outcome: whether the policy matches, the number of states where
+      the chosen actions differ, the maximum regret of the variant policy with
+      respect to the float64 Q-values, the maximum value difference, and the memory of both MDPs.
+    """
+    reference_result = value_iteration(mdp, epsilon=epsilon)
+    reference_values = reference_result.values
+    variant_result = value_iteration(variant, epsilon=epsilon)
+    variant_best_sa = variant_result.best_sa
+    q_values = mdp.q_values(reference_values)
+    best_q_values, _ = mdp.state_max(q_values)
+    regret = best_q_values - q_values[variant_best_sa]
+    max_regret = float(regret.max()) if mdp.n_states > 0 else 0.0
+    differences = np.abs(reference_values - variant_result.values.astype(np.float64))
+    return {
+        "policy_matches": max_regret <= 2 * epsilon,
+        "nb_different_actions": int(np.count_nonzero(variant_best_sa != reference_result.best_sa)),
+        "max_regret": max_regret,
+        "max_value_difference": float(differences.max()) if mdp.n_states > 0 else 0.0,
+        "nbytes": variant.nbytes,
+        "reference_nbytes": mdp.nbytes,
+    }
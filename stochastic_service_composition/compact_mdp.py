@@ -0,0 +1,261 @@
+"""
+This module implements a compact, array-based representation of an MDP.
+
+States are mapped to dense integer ids, and actions to integer codes.
+The state-action pairs of state s are the rows sa_ptr[s], ..., sa_ptr[s+1] - 1
+of a sparse matrix of shape (n_state_actions, n_states), holding the
+next-state distributions, and of a reward vector of length n_state_actions.
+With this layout, a Bellman backup is one sparse matrix-vector product
+followed by a segmented maximum.
+"""
+import hashlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+from mdp_dp_rl.processes.det_policy import DetPolicy
+from mdp_dp_rl.processes.mdp import MDP
+
+from stochastic_service_composition.types import Action, State
+
+
+class CompactMDP:
+    """An MDP in compressed sparse row form."""
+
+    # whether the transitions attribute is decoded on every access (see compact_encoding.PaletteCompactMDP)
+    decodes_transitions = False
+
+    def __init__(
+        self,
+        states: Sequence[State],
+        actions: List[Action],
+        sa_ptr: np.ndarray,
+        sa_action: np.ndarray,
+        rewards: np.ndarray,
+        transitions: sp.csr_matrix,
+        gamma: float,
+        initial_state: Optional[int] = None,
+    ):
+        """
+        Initialize the compact MDP.
+
+        :param states: the states, indexed by id (any sequence, e.g. a lazy decoder)
+        :param actions: the actions, indexed by code
+        :param sa_ptr: the offsets of the state-action pairs of each state, of length n_states + 1
+        :param sa_action: the action code of each state-action pair
+        :param rewards: the reward of each state-action pair
+        :param transitions: the next-state distribution of each state-action pair,
+          as a sparse matrix of shape (n_state_actions, n_states)
+        :param gamma: the discount factor
+        :param initial_state: the id of the initial state, if any
+        """
+        self.states = states
+        self.actions = actions
+        self.sa_ptr = sa_ptr
+        self.sa_action = sa_action
+        self.rewards = rewards
+        self.transitions = transitions
+        self.gamma = gamma
+        self.initial_state = initial_state
+        self._state_index: Optional[Dict[State, int]] = None
+        self.action_index: Dict[Action, int] = {
+            action: code for code, action in enumerate(actions)
+        }
+        self.sa_state = np.repeat(
+            np.arange(self.n_states, dtype=np.int64), np.diff(sa_ptr)
+        )
+
+    @property
+    def state_index(self) -> Dict[State, int]:
+        """Get the id of each state (the mapping is built on first use)."""
+        if self._state_index is None:
+            self._state_index = {state: index for index, state in enumerate(self.states)}
+        return self._state_index
+
+    @property
+    def n_states(self) -> int:
+        """Get the number of states."""
+        return len(self.states)
+
+    @property
+    def n_state_actions(self) -> int:
+        """Get the number of state-action pairs."""
+        return len(self.sa_action)
+
+    @property
+    def n_transitions(self) -> int:
+        """Get the number of (non-zero) transitions."""
+        return self.transitions.nnz
+
+    @property
+    def value_dtype(self) -> np.dtype:
+        """Get the floating-point type of the rewards, used for the values too."""
+        return self.rewards.dtype
+
+    @property
+    def nbytes(self) -> int:
+        """Get the memory used by the arrays of the MDP, in bytes (the states are not counted)."""
+        return (
+            self.sa_ptr.nbytes
+            + self.sa_action.nbytes
+            + self.rewards.nbytes
+            + self.transitions.data.nbytes
+            + self.transitions.indices.nbytes
+            + self.transitions.indptr.nbytes
+        )
+
+    def _fingerprint_arrays(self) -> List[np.ndarray]:
+        """Get the arrays of the transitions and the rewards, hashed by fingerprint."""
+        transitions = self.transitions
+        return [transitions.indptr, transitions.indices, transitions.data, self.rewards]
+
+    def fingerprint(self) -> str:
+        """
+        Get a digest of the MDP, to match it with checkpoints.
+
+        The digest covers the sizes, the discount factor, the state-action
+        pairs (sa_ptr and sa_action), the transition matrix and the rewards,
+        so two MDPs with the same structure but different probabilities or
+        rewards have different fingerprints.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(np.array([self.n_states, self.n_state_actions, self.n_transitions], dtype=np.int64).tobytes())
+        digest.update(np.array([self.gamma], dtype=np.float64).tobytes())
+        digest.update(np.ascontiguousarray(self.sa_ptr, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(self.sa_action, dtype=np.int64).tobytes())
+        for array in self._fingerprint_arrays():
+            array = np.ascontiguousarray(array)
+            digest.update(array.dtype.str.encode())
+            digest.update(memoryview(array).cast("B"))
+        return digest.hexdigest()
+
+    def astype(self, dtype) -> "CompactMDP":
+        """
+        Get a copy of the MDP whose probabilities and rewards (hence, values) have another floating-point type.
+
+        :param dtype: the floating-point type, e.g. np.float32.
+        :return: the new compact MDP; the states and the structure are shared.
+        """
+        return CompactMDP(
+            self.states,
+            self.actions,
+            self.sa_ptr,
+            self.sa_action,
+            np.asarray(self.rewards, dtype=dtype),
+            self.transitions.astype(dtype),
+            self.gamma,
+            self.initial_state,
+        )
+
+    @classmethod
+    def from_mdp(cls, mdp: MDP) -> "CompactMDP":
+        """
+        Build the compact form of an MDP.
+
+        :param mdp: the MDP (e.g. computed by comp_mdp).
+        :return: the compact MDP.
+        """
+        states = list(mdp.transitions.keys())
+        state_index = {state: index for index, state in enumerate(states)}
+        action_index: Dict[Action, int] = {}
+        sa_ptr = [0]
+        sa_action: List[int] = []
+        rewards: List[float] = []
+        indptr = [0]
+        indices: List[int] = []
+        data: List[float] = []
+        for state in states:
+            for action, next_states in mdp.transitions[state].items():
+                sa_action.append(action_index.setdefault(action, len(action_index)))
+                rewards.append(mdp.rewards[state][action])
+                for next_state, prob in next_states.items():
+                    indices.append(state_index[next_state])
+                    data.append(prob)
+                indptr.append(len(indices))
+            sa_ptr.append(len(sa_action))
+        transitions = sp.csr_matrix(
+            (
+                np.asarray(data, dtype=np.float64),
+                np.asarray(indices, dtype=np.int64),
+                np.asarray(indptr, dtype=np.int64),
+            ),
+            shape=(len(sa_action), len(states)),
+        )
+        initial_state = getattr(mdp, "initial_state", None)
+        return cls(
+            states,
+            list(action_index.keys()),
+            np.asarray(sa_ptr, dtype=np.int64),
+            np.asarray(sa_action, dtype=np.int64),
+            np.asarray(rewards, dtype=np.float64),
+            transitions,
+            mdp.gamma,
+            state_index.get(initial_state) if initial_state is not None else None,
+        )
+
+    def q_values(self, values: np.ndarray) -> np.ndarray:
+        """Compute the Q-value of every state-action pair, given the state values."""
+        return self.rewards + self.gamma * (self.transitions @ values)
+
+    def state_max(self, q_values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Compute the maximum over the actions of every state.
+
+        :param q_values: a vector of length n_state_actions.
+        :return: the maximum of each state, and the (first) state-action pair achieving it.
+        """
+        starts = self.sa_ptr[:-1]
+        values = np.maximum.reduceat(q_values, starts)
+        is_max = q_values == values[self.sa_state]
+        candidates = np.where(is_max, np.arange(len(q_values)), len(q_values))
+        best_sa = np.minimum.reduceat(candidates, starts)
+        return values, best_sa
+
+    def bellman(self, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Apply the Bellman optimality operator; return the new values and the greedy state-action pairs."""
+        return self.state_max(self.q_values(values))
+
+    def state_action(self, state_id: int, action: Action) -> int:
+        """Get the index of the state-action pair of a state and an action."""
+        code = self.action_index[action]
+        start, end = self.sa_ptr[state_id], self.sa_ptr[state_id + 1]
+        (offsets,) = np.nonzero(self.sa_action[start:end] == code)
+        if len(offsets) == 0:
+            raise ValueError(f"action {action} not available in state {self.states[state_id]}")
+        return int(start + offsets[0])
+
+    def policy_state_actions(self, policy: DetPolicy) -> np.ndarray:
+        """
+        Get the state-action pair chosen by a deterministic policy in every state.
+
+        :param policy: the deterministic policy; it must be defined on all the states.
+        :return: the chosen state-action pair of each state.
+        """
+        return np.fromiter(
+            (
+                self.state_action(state_id, policy.get_action_for_state(state))
+                for state_id, state in enumerate(self.states)
+            ),
+            dtype=np.int64,
+            count=self.n_states,
+        )
+
+    def value_dict(self, values: np.ndarray) -> Dict[State, float]:
+        """Convert a value vector into a dictionary indexed by state."""
+        return {state: float(value) for state, value in zip(self.states, values)}
+
+    def det_policy(self, best_sa: np.ndarray, state_ids: Optional[Sequence[int]] = None) -> DetPolicy:
+        """
+        Convert the chosen state-action pairs into a deterministic policy.
+
+        :param best_sa: the chosen state-action pair of each state.
+        :param state_ids: the states to include (default: all).
+        :return: the deterministic policy.
+        """
+        state_ids = range(self.n_states) if state_ids is None else state_ids
+        return DetPolicy(
+            {
+                self.states[state_id]: self.actions[self.sa_action[best_sa[state_id]]]
+                for state_id in state_ids
+            }
+        )
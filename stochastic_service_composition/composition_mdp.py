@@ -1,14 +1,24 @@
 """This module implements the algorithm to compute the system-target MDP."""
 import time
 from collections import deque
-from typing import Deque, Dict, List, Set, Tuple
+from typing import Collection, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
 
 from mdp_dp_rl.processes.mdp import MDP
 from pythomata import SimpleDFA
 
+from stochastic_service_composition.checkpoint import CompositionCheckpoint, resume_frontier
+from stochastic_service_composition.instrumentation import ProgressReporter
+from stochastic_service_composition.kronecker import build_system_service_kronecker
+from stochastic_service_composition.profiling import (
+    PHASE_FRONTIER_EXPANSION,
+    PHASE_MDP_CONSTRUCTION,
+    PHASE_SYSTEM_PRODUCT,
+    PHASE_TRANSITION_STORAGE,
+    PhaseProfiler,
+)
 from stochastic_service_composition.services import Service, build_system_service
 from stochastic_service_composition.target import Target
-from stochastic_service_composition.types import Action, State, MDPDynamics
+from stochastic_service_composition.types import Action, MDPDynamics, Prob, Reward, State
 
 COMPOSITION_MDP_INITIAL_STATE = 0
 COMPOSITION_MDP_INITIAL_ACTION = "initial"
@@ -19,7 +29,14 @@ COMPOSITION_MDP_SINK_STATE = -1
 
 
 def composition_mdp(
-    target: Target, *services: Service, gamma: float = DEFAULT_GAMMA
+    target: Target,
+    *services: Service,
+    gamma: float = DEFAULT_GAMMA,
+    kronecker: bool = False,
+    progress: Optional[ProgressReporter] = None,
+    profiler: Optional[PhaseProfiler] = None,
+    checkpoint: Optional[CompositionCheckpoint] = None,
+    system_service: Optional[Service] = None,
 ) -> MDP:
     """
     Compute the composition MDP.
@@ -27,10 +44,25 @@ def composition_mdp(
     :param target: the target service.
     :param services: the community of services.
     :param gamma: the discount factor.
+    :param kronecker: if True, compute the system transitions on demand from the
+      Kronecker structure of the system service, instead of exploring it upfront.
+    :param progress: an optional progress reporter, notified of every expanded state.
+    :param profiler: an optional profiler of the phases of the computation.
+    :param checkpoint: an optional checkpoint of the expanded states; if it already
+      contains some states, the computation resumes from them.
+    :param system_service: the system service of the services, if already built
+      (e.g. to time it separately); kronecker is then ignored.
     :return: the composition MDP.
     """
-
-    system_service = build_system_service(*services)
+    profiler = profiler if profiler is not None else PhaseProfiler(enabled=False)
+
+    if system_service is None:
+        with profiler.phase(PHASE_SYSTEM_PRODUCT, snapshot=True):
+            system_service = (
+                build_system_service_kronecker(*services)
+                if kronecker
+                else build_system_service(*services)
+            )
 
     initial_state = COMPOSITION_MDP_INITIAL_STATE
     # one action per service (1..n) + the initial action (0)
@@ -41,23 +73,38 @@ def composition_mdp(
     # add an 'undefined' action for sink states
     actions.add(COMPOSITION_MDP_UNDEFINED_ACTION)
 
-    transition_function: MDPDynamics = {}
+    transition_function: MDPDynamics = checkpoint.load() if checkpoint is not None else {}
 
     visited = set()
     to_be_visited = set()
     queue: Deque = deque()
 
-    # add initial transitions
-    transition_function[initial_state] = {}
-    initial_transition_dist = {}
-    symbols_from_initial_state = target.policy[target.initial_state].keys()
-    for symbol in symbols_from_initial_state:
-        next_state = (system_service.initial_state, target.initial_state, symbol)
-        next_prob = target.policy[target.initial_state][symbol]
-        initial_transition_dist[next_state] = next_prob
-        queue.append(next_state)
-        to_be_visited.add(next_state)
-    transition_function[initial_state][initial_action] = (initial_transition_dist, 0.0)  # type: ignore
+    if len(transition_function) > 0:
+        # resume from the checkpoint
+        visited.update(transition_function.keys())
+        visited.discard(initial_state)
+        queue.extend(resume_frontier(transition_function, []))
+        to_be_visited.update(queue)
+        nb_transitions = sum(
+            len(next_states)
+            for transitions in transition_function.values()
+            for next_states, _reward in transitions.values()
+        )
+    else:
+        # add initial transitions
+        transition_function[initial_state] = {}
+        initial_transition_dist = {}
+        symbols_from_initial_state = target.policy[target.initial_state].keys()
+        for symbol in symbols_from_initial_state:
+            next_state = (system_service.initial_state, target.initial_state, symbol)
+            next_prob = target.policy[target.initial_state][symbol]
+            initial_transition_dist[next_state] = next_prob
+            queue.append(next_state)
+            to_be_visited.add(next_state)
+        transition_function[initial_state][initial_action] = (initial_transition_dist, 0.0)  # type: ignore
+        nb_transitions = len(initial_transition_dist)
+        if checkpoint is not None:
+            checkpoint.add(initial_state, transition_function[initial_state])
 
     while len(queue) > 0:
         current_state = queue.popleft()
@@ -119,11 +166,186 @@ def composition_mdp(
         # TODO check correctness
         # if next state distribution is empty, add loops
 
-    return MDP(transition_function, gamma)
+        if checkpoint is not None:
+            checkpoint.add(current_state, transition_function[current_state])
+        if progress is not None:
+            nb_transitions += sum(
+                len(next_states) for next_states, _reward in transition_function[current_state].values()
+            )
+            progress.expanded(len(visited), len(queue), nb_transitions)
+
+    if checkpoint is not None:
+        checkpoint.flush()
+    if progress is not None:
+        progress.expanded(len(visited), 0, nb_transitions, force=True)
+    with profiler.phase(PHASE_MDP_CONSTRUCTION, snapshot=True):
+        result = MDP(transition_function, gamma)
+    return result
+
+
+class LazyCompositionMDP:
+    """
+    The composition MDP of comp_mdp, whose transitions are computed on demand.
+
+    The states are pairs (system state, DFA state), plus COMPOSITION_MDP_SINK_STATE;
+    the actions are the system symbols (action, service id), plus
+    COMPOSITION_MDP_UNDEFINED_ACTION for the states without any allowed service.
+    """
+
+    def __init__(
+        self,
+        dfa: SimpleDFA,
+        services: Sequence[Service],
+        gamma: float = DEFAULT_GAMMA,
+        kronecker: bool = False,
+        partial_order_reduction: bool = False,
+        system_service: Optional[Service] = None,
+    ):
+        """
+        Initialize the lazy composition MDP.
+
+        :param dfa: the target DFA.
+        :param services: the community of services.
+        :param gamma: the discount factor.
+        :param kronecker: if True, compute the system transitions on demand from the
+          Kronecker structure of the system service, instead of exploring it upfront.
+        :param partial_order_reduction: if True, explore only one representative
+          ordering of independent service-internal (tau) actions. See _ample_tau_symbol for the conditions.
+        :param system_service: the system service of the services, if already built; kronecker is then ignored.
+        """
+        self.dfa = dfa.trim()
+        self.services = services
+        self.gamma = gamma
+        self.partial_order_reduction = partial_order_reduction
+        if partial_order_reduction:
+            _check_partial_order_reduction_applicable(self.dfa, services)
+        if system_service is None:
+            system_service = (
+                build_system_service_kronecker(*services)
+                if kronecker
+                else build_system_service(*services)
+            )
+        self.system_service = system_service
+        self.initial_state = (self.system_service.initial_state, self.dfa.initial_state)
+
+        service_id_to_target_action = {
+            service_id: set(self.dfa.alphabet).intersection(service.actions)
+            for service_id, service in enumerate(services)
+        }
+        self.target_action_to_service_id: Dict[Action, Set[int]] = {}
+        for service_id, supported_actions in service_id_to_target_action.items():
+            assert len(supported_actions) == 1
+            supported_action = list(supported_actions)[0]
+            self.target_action_to_service_id.setdefault(supported_action, set()).add(service_id)
+
+    def seed_states(self) -> Iterator[State]:
+        """
+        Iterate over the states the exploration starts from.
+
+        The initial state comes first; then, every system state paired with
+        the initial DFA state, unless partial-order reduction is enabled
+        (in that case, only the states reachable from the initial state are explored).
+        """
+        yield self.initial_state
+        if self.partial_order_reduction:
+            return
+        for system_service_state in self.system_service.states:
+            if system_service_state == self.system_service.initial_state:
+                continue
+            yield system_service_state, self.dfa.initial_state
+
+    def allowed_services(self, dfa_state: State) -> Set[int]:
+        """Get the services that can do one of the next DFA actions."""
+        next_dfa_actions = set(self.dfa.transition_function.get(dfa_state, {}).keys())
+        allowed_services: Set[int] = set()
+        for next_dfa_action in next_dfa_actions:
+            allowed_services.update(self.target_action_to_service_id[next_dfa_action])
+        return allowed_services
+
+    def transitions(self, cur_state: State) -> Dict[Action, Tuple[Dict[State, Prob], Reward]]:
+        """
+        Compute the outgoing transitions of a state.
+
+        :param cur_state: the composition state.
+        :return: the transitions, in the same format of the MDP dynamics.
+        """
+        if cur_state == COMPOSITION_MDP_SINK_STATE:
+            return {COMPOSITION_MDP_UNDEFINED_ACTION: ({COMPOSITION_MDP_SINK_STATE: 1.0}, 0.0)}
+        dfa = self.dfa
+        system_service = self.system_service
+        cur_system_state, cur_dfa_state = cur_state
+        trans_dist: Dict[Action, Tuple[Dict[State, Prob], Reward]] = {}
+
+        next_system_state_trans = system_service.transition_function[
+            cur_system_state
+        ].items()
+
+        # optimization: filter services, consider only the ones that can do the next DFA action
+        allowed_services = self.allowed_services(cur_dfa_state)
+
+        if len(allowed_services) == 0:
+            trans_dist[COMPOSITION_MDP_UNDEFINED_ACTION] = ({COMPOSITION_MDP_SINK_STATE: 1}, 0.0)
+            return trans_dist
+
+        if self.partial_order_reduction:
+            ample_symbol = _ample_tau_symbol(
+                cur_system_state, allowed_services, self.services, dfa.alphabet
+            )
+            if ample_symbol is not None:
+                next_system_state_trans = [  # type: ignore
+                    (ample_symbol, system_service.transition_function[cur_system_state][ample_symbol])
+                ]
+        # iterate over all available actions of system service
+        # in case symbol is in DFA available actions, progress DFA state component
+        for (symbol, service_id), next_state_info in next_system_state_trans:
+
+            if service_id not in allowed_services:
+                # this service id cannot do any of the next dfa actions
+                continue
+
+            next_system_state_distr, reward_vector = next_state_info
+            system_reward = reward_vector
+
+            # if symbol is a tau action, next dfa state remains the same
+            if symbol not in dfa.alphabet:
+                next_dfa_state = cur_dfa_state
+                goal_reward = 0.0
+            # if there are no outgoing transitions from DFA state:
+            elif cur_dfa_state not in dfa.transition_function:
+                trans_dist[COMPOSITION_MDP_UNDEFINED_ACTION] = ({COMPOSITION_MDP_SINK_STATE: 1}, 0.0)
+                continue
+            # symbols not in the transition function of the target
+            # are considered as "other"; however, when we add the
+            # MDP transition, we will label it with the original
+            # symbol.
+            elif symbol in dfa.transition_function[cur_dfa_state]:
+                symbol_to_next_dfa_states = dfa.transition_function[cur_dfa_state]
+                next_dfa_state = symbol_to_next_dfa_states[symbol]
+                goal_reward = 1.0 if dfa.is_accepting(next_dfa_state) else 0.0
+            else:
+                # if invalid target action, skip
+                continue
+            final_rewards = (goal_reward + system_reward)
+
+            for next_system_state, prob in next_system_state_distr.items():
+                assert prob > 0.0
+                next_state = (next_system_state, next_dfa_state)
+                trans_dist.setdefault((symbol, service_id), ({}, final_rewards))[0][
+                    next_state
+                ] = prob
+        return trans_dist
 
 
 def comp_mdp(
-    dfa: SimpleDFA, services: Service, gamma: float = DEFAULT_GAMMA
+    dfa: SimpleDFA,
+    services: Service,
+    gamma: float = DEFAULT_GAMMA,
+    kronecker: bool = False,
+    partial_order_reduction: bool = False,
+    progress: Optional[ProgressReporter] = None,
+    profiler: Optional[PhaseProfiler] = None,
+    checkpoint: Optional[CompositionCheckpoint] = None,
+    system_service: Optional[Service] = None,
 ) -> MDP:
     """
     Compute the composition MDP.
@@ -131,109 +353,167 @@ def comp_mdp(
     :param target: the target service.
     :param services: the community of services.
     :param gamma: the discount factor.
+    :param kronecker: if True, compute the system transitions on demand from the
+      Kronecker structure of the system service, instead of exploring it upfront.
+    :param partial_order_reduction: if True, explore only one representative
+      ordering of independent service-internal (tau) actions, and only the states
+      reachable from the initial state. See _ample_tau_symbol for the conditions.
+    :param progress: an optional progress reporter, notified of every expanded state.
+    :param profiler: an optional profiler of the phases of the computation.
+    :param checkpoint: an optional checkpoint of the expanded states; if it already
+      contains some states, the computation resumes from them.
+    :param system_service: the system service of the services, if already built
+      (e.g. to time it separately); kronecker is then ignored.
     :return: the composition MDP.
     """
-    dfa = dfa.trim()
-    system_service = build_system_service(*services)
+    profiler = profiler if profiler is not None else PhaseProfiler(enabled=False)
+    with profiler.phase(PHASE_SYSTEM_PRODUCT, snapshot=True):
+        model = LazyCompositionMDP(
+            dfa,
+            services,  # type: ignore
+            gamma=gamma,
+            kronecker=kronecker,
+            partial_order_reduction=partial_order_reduction,
+            system_service=system_service,
+        )
 
-    transition_function: MDPDynamics = {}
+    transition_function: MDPDynamics = checkpoint.load() if checkpoint is not None else {}
 
-    visited = set()
+    visited = set(transition_function.keys())
     to_be_visited = set()
     queue: Deque = deque()
+    nb_transitions = 0
+
+    if len(transition_function) > 0:
+        # resume from the checkpoint
+        seed_states: Iterable[State] = resume_frontier(transition_function, list(model.seed_states()))
+        nb_transitions = sum(
+            len(next_states)
+            for transitions in transition_function.values()
+            for next_states, _reward in transitions.values()
+        )
+    else:
+        seed_states = model.seed_states()
 
     # add initial transitions
-    initial_state = (system_service.initial_state, dfa.initial_state)
-    queue.append(initial_state)
-    to_be_visited.add(initial_state)
-    for system_service_state in system_service.states:
-        if system_service_state == system_service.initial_state:
-            continue
-        new_initial_state = (system_service_state, dfa.initial_state)
-        queue.append(new_initial_state)
-        to_be_visited.add(new_initial_state)
-
-    service_id_to_target_action = {
-        service_id: set(dfa.alphabet).intersection(service.actions)
-        for service_id, service in enumerate(services)
-    }
-    target_action_to_service_id = {}
-    for service_id, supported_actions in service_id_to_target_action.items():
-        assert len(supported_actions) == 1
-        supported_action = list(supported_actions)[0]
-        target_action_to_service_id.setdefault(supported_action, set()).add(service_id)
-
-    mdp_sink_state_used = False
+    for seed_state in seed_states:
+        queue.append(seed_state)
+        to_be_visited.add(seed_state)
+
     while len(queue) > 0:
-        cur_state = queue.popleft()
-        to_be_visited.remove(cur_state)
-        visited.add(cur_state)
-        cur_system_state, cur_dfa_state = cur_state
-        trans_dist = {}
+        # the states are expanded, and then stored, in batches, so that the
+        # phases are entered once per batch, not once per state
+        batch: List[Tuple[State, Dict]] = []
+        with profiler.phase(PHASE_FRONTIER_EXPANSION):
+            while len(queue) > 0 and len(batch) < profiler.batch_size:
+                cur_state = queue.popleft()
+                to_be_visited.remove(cur_state)
+                visited.add(cur_state)
+                trans_dist = model.transitions(cur_state)
+                for next_state_distr, _reward in trans_dist.values():
+                    for next_state in next_state_distr.keys():
+                        if next_state not in visited and next_state not in to_be_visited:
+                            queue.append(next_state)
+                            to_be_visited.add(next_state)
+                batch.append((cur_state, trans_dist))
+
+        with profiler.phase(PHASE_TRANSITION_STORAGE):
+            for cur_state, trans_dist in batch:
+                transition_function[cur_state] = trans_dist
+                if checkpoint is not None:
+                    checkpoint.add(cur_state, trans_dist)
+        if progress is not None:
+            for _cur_state, trans_dist in batch:
+                nb_transitions += sum(len(next_states) for next_states, _reward in trans_dist.values())
+                progress.expanded(len(visited), len(queue), nb_transitions)
+
+    if checkpoint is not None:
+        checkpoint.flush()
+    if progress is not None:
+        progress.expanded(len(visited), 0, nb_transitions, force=True)
+    with profiler.phase(PHASE_MDP_CONSTRUCTION, snapshot=True):
+        result = MDP(transition_function, gamma)
+    result.initial_state = model.initial_state
+    return result
 
-        next_system_state_trans = system_service.transition_function[
-            cur_system_state
-        ].items()
 
-        # optimization: filter services, consider only the ones that can do the next DFA action
-        next_dfa_actions = set(dfa.transition_function.get(cur_dfa_state, {}).keys())
-        allowed_services = set()
-        for next_dfa_action in next_dfa_actions:
-            allowed_services.update(target_action_to_service_id[next_dfa_action])
+def resume_comp_mdp(
+    checkpoint_directory: str,
+    dfa: SimpleDFA,
+    services: Sequence[Service],
+    gamma: float = DEFAULT_GAMMA,
+    **kwargs,
+) -> MDP:
+    """
+    Compute the composition MDP, resuming from (and continuing to write) a checkpoint.
 
-        if len(allowed_services) == 0:
-            mdp_sink_state_used = True
-            trans_dist[COMPOSITION_MDP_UNDEFINED_ACTION] = ({COMPOSITION_MDP_SINK_STATE: 1}, 0.0)
-        else:
-            # iterate over all available actions of system service
-            # in case symbol is in DFA available actions, progress DFA state component
-            for (symbol, service_id), next_state_info in next_system_state_trans:
-
-                if service_id not in allowed_services:
-                    # this service id cannot do any of the next dfa actions
-                    continue
-
-                next_system_state_distr, reward_vector = next_state_info
-                system_reward = reward_vector
-
-                # if symbol is a tau action, next dfa state remains the same
-                if symbol not in dfa.alphabet:
-                    next_dfa_state = cur_dfa_state
-                    goal_reward = 0.0
-                # if there are no outgoing transitions from DFA state:
-                elif cur_dfa_state not in dfa.transition_function:
-                    mdp_sink_state_used = True
-                    trans_dist[COMPOSITION_MDP_UNDEFINED_ACTION] = ({COMPOSITION_MDP_SINK_STATE: 1}, 0.0)
-                    continue
-                # symbols not in the transition function of the target
-                # are considered as "other"; however, when we add the
-                # MDP transition, we will label it with the original
-                # symbol.
-                elif symbol in dfa.transition_function[cur_dfa_state]:
-                    symbol_to_next_dfa_states = dfa.transition_function[cur_dfa_state]
-                    next_dfa_state = symbol_to_next_dfa_states[symbol]
-                    goal_reward = 1.0 if dfa.is_accepting(next_dfa_state) else 0.0
-                else:
-                    # if invalid target action, skip
-                    continue
-                final_rewards = (goal_reward + system_reward)
-
-                for next_system_state, prob in next_system_state_distr.items():
-                    assert prob > 0.0
-                    next_state = (next_system_state, next_dfa_state)
-                    trans_dist.setdefault((symbol, service_id), ({}, final_rewards))[0][
-                        next_state
-                    ] = prob
-                    if next_state not in visited and next_state not in to_be_visited:
-                        queue.append(next_state)
-                        to_be_visited.add(next_state)
+    :param checkpoint_directory: the directory of the checkpoint.
+    :param dfa: the target DFA.
+    :param services: the community of services.
+    :param gamma: the discount factor.
+    :param kwargs: the other parameters of comp_mdp; they must be the same as the interrupted run.
+    :return: the composition MDP.
+    """
+    checkpoint = CompositionCheckpoint(checkpoint_directory)
+    try:
+        return comp_mdp(dfa, services, gamma=gamma, checkpoint=checkpoint, **kwargs)  # type: ignore
+    finally:
+        checkpoint.close()
 
-        transition_function[cur_state] = trans_dist
 
-    if mdp_sink_state_used:
-        transition_function[COMPOSITION_MDP_SINK_STATE] = {COMPOSITION_MDP_UNDEFINED_ACTION: ({COMPOSITION_MDP_SINK_STATE: 1.0}, 0.0)}
+def _check_partial_order_reduction_applicable(dfa: SimpleDFA, services: Sequence[Service]) -> None:
+    """
+    Check that partial-order reduction preserves the optimal values.
 
-    result = MDP(transition_function, gamma)
-    result.initial_state = initial_state
-    return result
+    The reduction is sound when no transition of the composition MDP has a
+    positive reward, i.e. when every service action, plus the goal reward
+    if the action belongs to the DFA alphabet, has a non-positive reward.
 
+    :param dfa: the (trimmed) target DFA.
+    :param services: the community of services.
+    """
+    goal_reward = 1.0 if len(dfa.accepting_states) > 0 else 0.0
+    for service_id, service in enumerate(services):
+        for transitions_by_action in service.transition_function.values():
+            for action, (_next_states, reward) in transitions_by_action.items():
+                max_reward = reward + (goal_reward if action in dfa.alphabet else 0.0)
+                if max_reward > 0.0:
+                    raise ValueError(
+                        f"partial-order reduction not applicable: action {action} of service {service_id} "
+                        f"can yield a positive reward {max_reward}"
+                    )
+
+
+def _ample_tau_symbol(
+    system_state: Tuple[State, ...],
+    allowed_services: Set[int],
+    services: Sequence[Service],
+    alphabet: Collection[Action],
+) -> Optional[Tuple[Action, int]]:
+    """
+    Find a service-internal (tau) action that can be taken before any other action.
+
+    The action (a, i) is returned if, in the current state of service i,
+    a is the only available action, it is not in the DFA alphabet and it has
+    zero reward. Such action is independent of the actions of the other
+    services, and it does not change the DFA state; moreover, if no transition
+    has a positive reward, taking it first is never worse than postponing it
+    (or not taking it at all): the discounting can only reduce the costs
+    collected in the meantime. Hence, the singleton {(a, i)} is an ample set
+    that contains an optimal action, and restricting the state to it preserves
+    the optimal values. Ties are broken by the lowest service id.
+
+    :param system_state: the current system state.
+    :param allowed_services: the services that can do the next DFA actions.
+    :param services: the community of services.
+    :param alphabet: the DFA alphabet.
+    :return: the system symbol (action, service id), or None if no such action exists.
+    """
+    for service_id in sorted(allowed_services):
+        local_transitions = services[service_id].transition_function[system_state[service_id]]
+        if len(local_transitions) != 1:
+            continue
+        ((action, (_next_states, reward)),) = local_transitions.items()
+        if action not in alphabet and reward == 0.0:
+            return action, service_id
+    return None
@@ -0,0 +1,331 @@
+"""
+This module implements a distributed computation of the composition MDP, coordinated through Redis.
+
+The composition is explored by worker processes, on one or more machines,
+that share a Redis server and a directory (e.g. a network file system):
+
+- the frontier is a Redis list of state keys (see external_composition.StateCodec);
+  the workers pop batches of keys from it, expand them, and push the new keys;
+- the discovered states are deduplicated with Redis sets, sharded by key:
+  a key is pushed to the frontier only by the worker whose SADD added it;
+- the transitions are written by each worker to chunk files of the shared
+  directory, in the format of external_composition, so the result is loaded
+  with load_external_composition;
+- an in-flight counter is incremented before new keys are pushed, and
+  decremented after the batch that discovered them has been expanded: when
+  it drops to zero, the coordinator signals the end of the exploration.
+
+The coordinator publishes the problem (the DFA, the services and the
+parameters), seeds the frontier, optionally starts local workers, and waits
+for the termination, e.g. on a single box:
+
+    nb_states = distributed_comp_mdp(directory, dfa, services, nb_local_workers=8)
+    mdp = load_external_composition(directory)
+
+The workers of the other machines are started with
+
+    python -m stochastic_service_composition.distributed_composition --redis-url redis://host:6379/0
+
+The workers must import the modules of the services and of the DFA, as the
+problem is exchanged as a pickle. A worker that dies during a batch leaves
+the in-flight counter above zero: the run has to be restarted.
+"""
+import argparse
+import multiprocessing
+import os
+import pickle
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from pythomata import SimpleDFA
+
+from stochastic_service_composition.composition_mdp import (
+    COMPOSITION_MDP_UNDEFINED_ACTION,
+    DEFAULT_GAMMA,
+    LazyCompositionMDP,
+)
+from stochastic_service_composition.external_composition import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_MEMORY_BUDGET_MB,
+    ChunkWriter,
+    StateCodec,
+    write_composition_meta,
+)
+from stochastic_service_composition.kronecker import KroneckerSystem
+from stochastic_service_composition.services import Service
+from stochastic_service_composition.types import Action
+
+DEFAULT_REDIS_URL = "redis://localhost:6379/0"
+DEFAULT_NAMESPACE = "ssc"
+DEFAULT_NB_SHARDS = 16
+DEFAULT_POLL_INTERVAL = 0.1
+
+
+def _connect(redis_url: str):
+    """Connect to the Redis server."""
+    try:
+        import redis
+    except ImportError as e:
+        raise ImportError("the distributed composition requires the redis package") from e
+    return redis.Redis.from_url(redis_url)
+
+
+class _Keys:
+    """The names of the Redis keys of a run."""
+
+    def __init__(self, namespace: str):
+        """Initialize the names."""
+        self.namespace = namespace
+        self.problem = f"{namespace}:problem"
+        self.frontier = f"{namespace}:frontier"
+        self.in_flight = f"{namespace}:in_flight"
+        self.done = f"{namespace}:done"
+        self.chunks = f"{namespace}:chunks"
+        self.workers = f"{namespace}:workers"
+        self.finished = f"{namespace}:finished"
+
+    def visited(self, shard: int) -> str:
+        """Get the name of a shard of the visited set."""
+        return f"{self.namespace}:visited:{shard}"
+
+
+def _action_index(system: KroneckerSystem) -> Dict[Action, int]:
+    """Get the action codes, the same in every worker: the system symbols, then the undefined action."""
+    actions: List[Action] = list(system.symbols) + [COMPOSITION_MDP_UNDEFINED_ACTION]
+    return {action: index for index, action in enumerate(actions)}
+
+
+class _RedisChunkWriter(ChunkWriter):
+    """A chunk writer whose chunk indices are allocated by Redis, to be unique among the workers."""
+
+    def __init__(self, directory: str, max_bytes: int, client: Any, keys: _Keys):
+        """Initialize the writer."""
+        super().__init__(directory, max_bytes)
+        self.client = client
+        self.keys = keys
+
+    def _next_chunk_index(self) -> int:
+        """Allocate the index of the next chunk file."""
+        return int(self.client.incr(self.keys.chunks)) - 1
+
+
+def _claim(client: Any, keys: _Keys, candidates: np.ndarray, nb_shards: int) -> List[int]:
+    """Add keys to the sharded visited set, and get the ones that were not in it."""
+    pipeline = client.pipeline(transaction=False)
+    for key in candidates:
+        pipeline.sadd(keys.visited(int(key) % nb_shards), int(key))
+    added = pipeline.execute()
+    return [int(key) for key, is_new in zip(candidates, added) if is_new]
+
+
+def _pop_batch(client: Any, keys: _Keys, batch_size: int) -> List[int]:
+    """Pop a batch of keys from the frontier, atomically."""
+    pipeline = client.pipeline(transaction=True)
+    pipeline.lrange(keys.frontier, 0, batch_size - 1)
+    pipeline.ltrim(keys.frontier, batch_size, -1)
+    batch, _ = pipeline.execute()
+    return [int(key) for key in batch]
+
+
+def run_worker(
+    redis_url: str = DEFAULT_REDIS_URL,
+    namespace: str = DEFAULT_NAMESPACE,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+) -> int:
+    """
+    Run a worker of a distributed composition, until the coordinator signals its end.
+
+    :param redis_url: the URL of the Redis server.
+    :param namespace: the prefix of the Redis keys of the run.
+    :param poll_interval: the time to wait when the frontier is empty, in seconds.
+    :return: the number of states expanded by this worker.
+    """
+    client = _connect(redis_url)
+    keys = _Keys(namespace)
+    problem_data = None
+    while problem_data is None:
+        problem_data = client.get(keys.problem)
+        if problem_data is None:
+            time.sleep(poll_interval)
+    # register only once the run is published, as the coordinator resets the namespace first
+    client.incr(keys.workers)
+    try:
+        problem = pickle.loads(problem_data)
+        model = LazyCompositionMDP(
+            problem["dfa"],
+            problem["services"],
+            gamma=problem["gamma"],
+            kronecker=True,
+            partial_order_reduction=problem["partial_order_reduction"],
+        )
+        system = KroneckerSystem(*problem["services"])
+        codec = StateCodec(system, sorted(model.dfa.states, key=str))
+        action_index = _action_index(system)
+        writer = _RedisChunkWriter(problem["directory"], problem["max_chunk_bytes"], client, keys)
+        nb_shards, batch_size = problem["nb_shards"], problem["batch_size"]
+
+        nb_expanded = 0
+        while True:
+            batch = _pop_batch(client, keys, batch_size)
+            if len(batch) == 0:
+                if client.exists(keys.done):
+                    break
+                time.sleep(poll_interval)
+                continue
+            successors: List[int] = []
+            for key in batch:
+                writer.add_state(key, model.transitions(codec.decode(key)), codec, action_index, successors)
+            new_keys = _claim(client, keys, np.unique(np.asarray(successors, dtype=np.int64)), nb_shards)
+            # the new keys are counted before the batch is discounted, so the counter is zero only at the end
+            if len(new_keys) > 0:
+                client.incrby(keys.in_flight, len(new_keys))
+                client.rpush(keys.frontier, *new_keys)
+            client.decrby(keys.in_flight, len(batch))
+            nb_expanded += len(batch)
+        writer.flush()
+        return nb_expanded
+    finally:
+        client.incr(keys.finished)
+
+
+def distributed_comp_mdp(
+    directory: str,
+    dfa: SimpleDFA,
+    services: Sequence[Service],
+    gamma: float = DEFAULT_GAMMA,
+    redis_url: str = DEFAULT_REDIS_URL,
+    namespace: str = DEFAULT_NAMESPACE,
+    nb_local_workers: int = 0,
+    nb_shards: int = DEFAULT_NB_SHARDS,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB,
+    partial_order_reduction: bool = False,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    timeout: Optional[float] = None,
+) -> int:
+    """
+    Coordinate the distributed computation of the composition MDP of comp_mdp.
+
+    The keys of the namespace are deleted at the start and at the end of the run.
+
+    :param directory: the output directory, shared with the workers; it is created if it does not exist.
+    :param dfa: the target DFA.
+    :param services: the community of services.
+    :param gamma: the discount factor.
+    :param redis_url: the URL of the Redis server.
+    :param namespace: the prefix of the Redis keys of the run.
+    :param nb_local_workers: the number of worker processes to start on this machine.
+    :param nb_shards: the number of shards of the visited set.
+    :param batch_size: the number of states popped from the frontier at once.
+    :param memory_budget_mb: the memory budget of the transition buffer of each worker, in MB.
+    :param partial_order_reduction: see comp_mdp.
+    :param poll_interval: the interval between two checks of the termination, in seconds.
+    :param timeout: the maximum duration of the run, in seconds (default: no limit).
+    :return: the number of states.
+    """
+    os.makedirs(directory, exist_ok=True)
+    client = _connect(redis_url)
+    keys = _Keys(namespace)
+    _delete_namespace(client, namespace)
+
+    model = LazyCompositionMDP(
+        dfa, services, gamma=gamma, kronecker=True, partial_order_reduction=partial_order_reduction
+    )
+    system = KroneckerSystem(*services)
+    codec = StateCodec(system, sorted(model.dfa.states, key=str))
+    initial_key = codec.encode(model.initial_state)
+    seeds = [codec.encode(state) for state in model.seed_states()]
+    client.set(
+        keys.problem,
+        pickle.dumps(
+            {
+                "dfa": dfa,
+                "services": list(services),
+                "gamma": gamma,
+                "partial_order_reduction": partial_order_reduction,
+                "directory": os.path.abspath(directory),
+                "nb_shards": nb_shards,
+                "batch_size": batch_size,
+                "max_chunk_bytes": int(memory_budget_mb * 1024 ** 2),
+            },
+            pickle.HIGHEST_PROTOCOL,
+        ),
+    )
+    new_keys = _claim(client, keys, np.unique(np.asarray(seeds, dtype=np.int64)), nb_shards)
+    client.incrby(keys.in_flight, len(new_keys))
+    client.rpush(keys.frontier, *new_keys)
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(redis_url, namespace, poll_interval))
+        for _ in range(nb_local_workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        start_time = time.perf_counter()
+        while int(client.get(keys.in_flight)) > 0:
+            _check_workers(client, keys, processes, expanding=True)
+            if timeout is not None and time.perf_counter() - start_time > timeout:
+                raise TimeoutError(f"the distributed composition did not complete in {timeout} seconds")
+            time.sleep(poll_interval)
+        client.set(keys.done, 1)
+        # wait for the workers to write their last chunk
+        while int(client.get(keys.finished) or 0) < int(client.get(keys.workers) or 0):
+            _check_workers(client, keys, processes, expanding=False)
+            time.sleep(poll_interval)
+        _check_workers(client, keys, processes, expanding=False)
+    finally:
+        client.set(keys.done, 1)
+        for process in processes:
+            process.join()
+
+    nb_states = sum(int(client.scard(keys.visited(shard))) for shard in range(nb_shards))
+    nb_chunks = int(client.get(keys.chunks) or 0)
+    write_composition_meta(
+        directory, codec, list(_action_index(system).keys()), gamma, initial_key, nb_chunks, nb_states
+    )
+    _delete_namespace(client, namespace)
+    return nb_states
+
+
+def _check_workers(client: Any, keys: _Keys, processes: List[Any], expanding: bool) -> None:
+    """
+    Check that no worker failed.
+
+    :param client: the Redis client.
+    :param keys: the Redis keys of the run.
+    :param processes: the local worker processes.
+    :param expanding: whether states are still in flight; the workers only
+      finish once the coordinator signals the end, so a worker that finished
+      meanwhile (local or remote) failed, and its states would never be discounted.
+    :raises RuntimeError: if a worker failed.
+    """
+    for process in processes:
+        if process.exitcode is not None and process.exitcode != 0:
+            raise RuntimeError(f"a worker of the distributed composition failed (exit code {process.exitcode})")
+    if expanding and int(client.get(keys.finished) or 0) > 0:
+        raise RuntimeError("a worker of the distributed composition stopped while states were still in flight")
+
+
+def _delete_namespace(client: Any, namespace: str) -> None:
+    """Delete the Redis keys of a run."""
+    names = list(client.scan_iter(match=f"{namespace}:*"))
+    if len(names) > 0:
+        client.delete(*names)
+
+
+def main() -> None:
+    """Run a worker from the command line."""
+    parser = argparse.ArgumentParser(description="Run a worker of a distributed composition.")
+    parser.add_argument("--redis-url", default=DEFAULT_REDIS_URL, help="the URL of the Redis server")
+    parser.add_argument("--namespace", default=DEFAULT_NAMESPACE, help="the prefix of the Redis keys of the run")
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL)
+    arguments = parser.parse_args()
+    nb_expanded = run_worker(arguments.redis_url, arguments.namespace, arguments.poll_interval)
+    print(f"Expanded {nb_expanded} states.")
+
+
+if __name__ == "__main__":
+    main()
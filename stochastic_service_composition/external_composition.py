@@ -0,0 +1,703 @@
+"""
+This module implements an external-memory (out-of-core) computation of the composition MDP.
+
+The composition is explored breadth-first, layer by layer, with the successor
+logic of LazyCompositionMDP over the Kronecker form of the system service.
+States are encoded as integer keys: the mixed-radix encoding of the system
+state (as in KroneckerSystem), times the number of DFA states, plus the index
+of the DFA state; the sink state gets the key right after the product space.
+
+Duplicates are detected once per layer (delayed duplicate detection): every
+layer is a sorted run of keys on disk, and so are the visited states (the
+previous layers, merged from time to time). The keys of the successors of the
+expanded states are buffered in memory, and spilled to disk as sorted runs
+when the buffer is full; at the end of the layer, the successor runs are
+merged, and the visited runs are subtracted from them, in a single streaming
+pass over sorted blocks, which gives the next layer. The transitions are
+streamed to disk in chunks as they are generated. Hence, the memory used by
+the construction is bounded by the budget, plus one block per run.
+
+The result is a directory, which load_external_composition turns into a
+CompactMDP whose arrays are memory-mapped files, to be solved with the
+sparse solvers; the table from the keys to the state ids is built by merging
+the sorted keys of the chunks, without sorting all the keys in memory.
+"""
+import glob
+import itertools
+import os
+import pickle
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+from pythomata import SimpleDFA
+
+from stochastic_service_composition.compact_mdp import CompactMDP
+from stochastic_service_composition.composition_mdp import (
+    COMPOSITION_MDP_SINK_STATE,
+    DEFAULT_GAMMA,
+    LazyCompositionMDP,
+)
+from stochastic_service_composition.kronecker import KroneckerSystem
+from stochastic_service_composition.services import Service
+from stochastic_service_composition.types import Action, State
+
+DEFAULT_MEMORY_BUDGET_MB = 1024.0
+DEFAULT_BATCH_SIZE = 10000
+META_FILE_NAME = "meta.pkl"
+CHUNK_FILE_PATTERN = "chunk_{:06d}.npz"
+RUN_FILE_PATTERN = "run_{:06d}.bin"
+KEYS_FILE_NAME = "keys.bin"
+SORTED_KEYS_FILE_NAME = "sorted_keys.bin"
+SORTED_IDS_FILE_NAME = "sorted_ids.bin"
+# the maximum number of visited runs, above which they are merged into one
+MAX_VISITED_RUNS = 8
+# the minimum number of keys of a block, during the merges
+_MIN_BLOCK_SIZE = 1024
+
+# estimated sizes of the buffered records, in bytes
+_STATE_RECORD_SIZE = 16
+_STATE_ACTION_RECORD_SIZE = 24
+_TRANSITION_RECORD_SIZE = 32
+
+
+class StateCodec:
+    """The encoding of the composition states as integer keys."""
+
+    def __init__(self, system: KroneckerSystem, dfa_states: Sequence[State]):
+        """
+        Initialize the codec.
+
+        :param system: the Kronecker form of the system service.
+        :param dfa_states: the DFA states, in encoding order.
+        """
+        self.system = system
+        self.dfa_states = list(dfa_states)
+        self.dfa_index = {state: index for index, state in enumerate(self.dfa_states)}
+        self.n_dfa_states = len(self.dfa_states)
+        self.sink_key = system.n_states * self.n_dfa_states
+
+    def encode(self, state: State) -> int:
+        """Encode a composition state as an integer key."""
+        if state == COMPOSITION_MDP_SINK_STATE:
+            return self.sink_key
+        system_state, dfa_state = state
+        return self.system.encode(system_state) * self.n_dfa_states + self.dfa_index[dfa_state]
+
+    def decode(self, key: int) -> State:
+        """Decode an integer key into a composition state."""
+        if key == self.sink_key:
+            return COMPOSITION_MDP_SINK_STATE
+        system_index, dfa_index = divmod(int(key), self.n_dfa_states)
+        return self.system.decode(system_index), self.dfa_states[dfa_index]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Pickle only what decoding needs (the local state tables), not the services."""
+        return {
+            "local_states": self.system.local_states,
+            "strides": self.system.strides,
+            "shape": self.system.shape,
+            "n_system_states": self.system.n_states,
+            "dfa_states": self.dfa_states,
+        }
+
+    def __setstate__(self, data: Dict[str, Any]) -> None:
+        """Restore a decoding-only codec."""
+        self.system = _SystemDecoder(
+            data["local_states"], data["strides"], data["shape"], data["n_system_states"]
+        )  # type: ignore
+        self.dfa_states = data["dfa_states"]
+        self.dfa_index = {state: index for index, state in enumerate(self.dfa_states)}
+        self.n_dfa_states = len(self.dfa_states)
+        self.sink_key = data["n_system_states"] * self.n_dfa_states
+
+
+class _SystemDecoder:
+    """The mixed-radix encoding of the system states, without the services."""
+
+    def __init__(self, local_states, strides, shape, n_states):
+        """Initialize the decoder."""
+        self.local_states = local_states
+        self.local_index = [
+            {state: index for index, state in enumerate(states)} for states in local_states
+        ]
+        self.strides = strides
+        self.shape = shape
+        self.n_states = n_states
+
+    def encode(self, state: Tuple[State, ...]) -> int:
+        """Encode a system state as an integer."""
+        return sum(
+            self.local_index[i][component] * self.strides[i]
+            for i, component in enumerate(state)
+        )
+
+    def decode(self, index: int) -> Tuple[State, ...]:
+        """Decode an integer into a system state."""
+        return tuple(
+            self.local_states[i][(index // self.strides[i]) % self.shape[i]]
+            for i in range(len(self.shape))
+        )
+
+
+def _read_run(path: str, dtype=np.int64) -> np.ndarray:
+    """Memory-map a run written by _RunWriter (an empty array, if the run is empty)."""
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+class _RunWriter:
+    """Append arrays to a raw binary file, e.g. the sorted blocks of a run."""
+
+    def __init__(self, path: str, dtype=np.int64):
+        """Create the file."""
+        self.path = path
+        self.dtype = dtype
+        self.size = 0
+        self._file = open(path, "wb")
+
+    def write(self, array: np.ndarray) -> None:
+        """Append an array."""
+        np.ascontiguousarray(array, dtype=self.dtype).tofile(self._file)
+        self.size += len(array)
+
+    def close(self) -> None:
+        """Close the file."""
+        self._file.close()
+
+
+class _RunFiles:
+    """The allocation of the names of the temporary runs of a directory."""
+
+    def __init__(self, directory: str):
+        """Initialize the allocator."""
+        self.directory = directory
+        self.nb_runs = 0
+
+    def next_path(self) -> str:
+        """Get the path of a new run."""
+        path = os.path.join(self.directory, RUN_FILE_PATTERN.format(self.nb_runs))
+        self.nb_runs += 1
+        return path
+
+
+def _merge_runs(
+    runs: Sequence[np.ndarray], block_size: int, payloads: Optional[Sequence[np.ndarray]] = None
+) -> Iterator[Tuple[np.ndarray, Optional[np.ndarray]]]:
+    """
+    Merge sorted runs of keys, block by block.
+
+    At each step, every run contributes its keys up to the smallest of the
+    last keys of the next blocks of the runs; hence, the equal keys are
+    merged in the same step, and every step consumes a whole block of some run.
+
+    :param runs: the sorted runs (e.g. memory-mapped).
+    :param block_size: the number of keys read at once from each run.
+    :param payloads: optionally, an array aligned with each run (e.g. the ids of the keys).
+    :return: the sorted blocks of unique keys, in increasing order, with the
+      payload of the first occurrence of each key (None, without payloads).
+    """
+    cursors = [0] * len(runs)
+    while True:
+        bound = None
+        for run, cursor in zip(runs, cursors):
+            if cursor < len(run):
+                last_key = run[min(cursor + block_size, len(run)) - 1]
+                bound = last_key if bound is None else min(bound, last_key)
+        if bound is None:
+            return
+        key_parts, payload_parts = [], []
+        for index, run in enumerate(runs):
+            start = cursors[index]
+            window = np.asarray(run[start : start + block_size])
+            stop = start + int(np.searchsorted(window, bound, side="right"))
+            key_parts.append(window[: stop - start])
+            if payloads is not None:
+                payload_parts.append(np.asarray(payloads[index][start:stop]))
+            cursors[index] = stop
+        keys, first = np.unique(np.concatenate(key_parts), return_index=True)
+        yield keys, np.concatenate(payload_parts)[first] if payloads is not None else None
+
+
+def _subtract_runs(
+    blocks: Iterator[np.ndarray], runs: Sequence[np.ndarray], block_size: int
+) -> Iterator[np.ndarray]:
+    """
+    Remove the keys of sorted runs from increasing sorted blocks of unique keys, in a single pass over the runs.
+
+    :param blocks: the sorted blocks, in increasing order.
+    :param runs: the sorted runs of the keys to remove.
+    :param block_size: the number of keys read at once from each run.
+    :return: the filtered blocks.
+    """
+    cursors = [0] * len(runs)
+    for keys in blocks:
+        if len(keys) == 0:
+            continue
+        keep = np.ones(len(keys), dtype=bool)
+        for index, run in enumerate(runs):
+            # the blocks are increasing, so the keys of the run below the block are never needed again
+            while cursors[index] < len(run):
+                window = np.asarray(run[cursors[index] : cursors[index] + block_size])
+                keep &= ~np.isin(keys, window, assume_unique=True)
+                if window[-1] > keys[-1]:
+                    cursors[index] += int(np.searchsorted(window, keys[-1], side="right"))
+                    break
+                cursors[index] += len(window)
+        yield keys[keep]
+
+
+class _SortedRunBuffer:
+    """Buffer keys in memory, and spill them to disk as sorted runs without duplicates when the buffer is full."""
+
+    def __init__(self, run_files: _RunFiles, memory_budget_bytes: int):
+        """Initialize the buffer."""
+        self.run_files = run_files
+        self.memory_budget_bytes = memory_budget_bytes
+        self.parts: List[np.ndarray] = []
+        self.nb_keys = 0
+        self.paths: List[str] = []
+
+    def add(self, keys: np.ndarray) -> None:
+        """Buffer some keys."""
+        self.parts.append(keys)
+        self.nb_keys += len(keys)
+        if self.nb_keys * keys.itemsize > self.memory_budget_bytes:
+            self.spill()
+
+    def spill(self) -> None:
+        """Write the buffered keys as a sorted run."""
+        if self.nb_keys == 0:
+            return
+        writer = _RunWriter(self.run_files.next_path())
+        writer.write(np.unique(np.concatenate(self.parts)))
+        writer.close()
+        self.paths.append(writer.path)
+        self.parts, self.nb_keys = [], 0
+
+
+def _block_size(memory_budget_bytes: int, nb_runs: int) -> int:
+    """Get the number of keys read at once from each run, so that one block per run fits in the budget."""
+    return max(_MIN_BLOCK_SIZE, memory_budget_bytes // (2 * np.dtype(np.int64).itemsize * (nb_runs + 1)))
+
+
+def _merge_to_run(
+    paths: Sequence[str], exclude_paths: Sequence[str], run_files: _RunFiles, memory_budget_bytes: int
+) -> str:
+    """
+    Merge sorted runs into a new sorted run without duplicates, minus the keys of other sorted runs.
+
+    :param paths: the paths of the runs to merge.
+    :param exclude_paths: the paths of the runs of the keys to remove.
+    :param run_files: the allocator of the new run.
+    :param memory_budget_bytes: the memory budget of the blocks.
+    :return: the path of the new run.
+    """
+    block_size = _block_size(memory_budget_bytes, len(paths) + len(exclude_paths))
+    blocks = (keys for keys, _ in _merge_runs([_read_run(path) for path in paths], block_size))
+    writer = _RunWriter(run_files.next_path())
+    for keys in _subtract_runs(blocks, [_read_run(path) for path in exclude_paths], block_size):
+        writer.write(keys)
+    writer.close()
+    return writer.path
+
+
+def _seed_keys(codec: "StateCodec", dfa_state: State, block_size: int) -> Iterator[np.ndarray]:
+    """
+    Generate the keys of the reachable system states paired with a DFA state, in increasing blocks.
+
+    The leading services are enumerated, and the trailing ones are broadcast, so
+    that each block has at most block_size keys (unless a single service has more states).
+    """
+    system = codec.system
+    reachable = [
+        np.asarray([system.local_index[i][state] for state in states], dtype=np.int64)
+        for i, states in enumerate(system.reachable_local_states)  # type: ignore
+    ]
+    split, trailing_size = len(reachable), 1
+    while split > 0 and trailing_size * len(reachable[split - 1]) <= block_size:
+        split -= 1
+        trailing_size *= len(reachable[split])
+    # the mixed-radix keys of the trailing services, in increasing order
+    trailing = np.zeros(1, dtype=np.int64)
+    for i in range(split, len(reachable)):
+        trailing = (trailing[:, None] + reachable[i][None, :] * system.strides[i]).reshape(-1)
+    dfa_index = codec.dfa_index[dfa_state]
+    for prefix in itertools.product(*reachable[:split]):
+        base = sum(int(index) * system.strides[i] for i, index in enumerate(prefix))
+        yield (base + trailing) * codec.n_dfa_states + dfa_index
+
+
+class ChunkWriter:
+    """Buffer the transitions of the expanded states, and write them to disk in chunks."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        """Initialize the writer."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.nb_chunks = 0
+        self._reset()
+
+    def _reset(self) -> None:
+        """Empty the buffers."""
+        self.state_keys: List[int] = []
+        self.nb_actions: List[int] = []
+        self.actions: List[int] = []
+        self.rewards: List[float] = []
+        self.nb_next_states: List[int] = []
+        self.next_keys: List[int] = []
+        self.probs: List[float] = []
+
+    @property
+    def buffered_bytes(self) -> int:
+        """Get an estimate of the size of the buffers."""
+        return (
+            _STATE_RECORD_SIZE * len(self.state_keys)
+            + _STATE_ACTION_RECORD_SIZE * len(self.actions)
+            + _TRANSITION_RECORD_SIZE * len(self.next_keys)
+        )
+
+    def add_state(
+        self,
+        key: int,
+        transitions: Dict[Action, Tuple[Dict[State, float], float]],
+        codec: StateCodec,
+        action_index: Dict[Action, int],
+        successors: List[int],
+    ) -> None:
+        """
+        Buffer the transitions of an expanded state, and flush them if the buffers are full.
+
+        :param key: the key of the state.
+        :param transitions: its transitions.
+        :param codec: the state codec.
+        :param action_index: the action codes; the new actions are added to it.
+        :param successors: the list the keys of the next states are appended to.
+        """
+        self.state_keys.append(int(key))
+        self.nb_actions.append(len(transitions))
+        for action, (next_states, reward) in transitions.items():
+            self.actions.append(action_index.setdefault(action, len(action_index)))
+            self.rewards.append(reward)
+            self.nb_next_states.append(len(next_states))
+            for next_state, prob in next_states.items():
+                next_key = codec.encode(next_state)
+                self.next_keys.append(next_key)
+                self.probs.append(prob)
+                successors.append(next_key)
+        if self.buffered_bytes > self.max_bytes:
+            self.flush()
+
+    def _next_chunk_index(self) -> int:
+        """Get the index of the next chunk file."""
+        return self.nb_chunks
+
+    def flush(self) -> None:
+        """Write the buffered transitions as a chunk."""
+        if len(self.state_keys) == 0:
+            return
+        np.savez(
+            os.path.join(self.directory, CHUNK_FILE_PATTERN.format(self._next_chunk_index())),
+            state_keys=np.asarray(self.state_keys, dtype=np.int64),
+            nb_actions=np.asarray(self.nb_actions, dtype=np.int32),
+            actions=np.asarray(self.actions, dtype=np.int32),
+            rewards=np.asarray(self.rewards, dtype=np.float64),
+            nb_next_states=np.asarray(self.nb_next_states, dtype=np.int32),
+            next_keys=np.asarray(self.next_keys, dtype=np.int64),
+            probs=np.asarray(self.probs, dtype=np.float64),
+        )
+        self.nb_chunks += 1
+        self._reset()
+
+
+def external_comp_mdp(
+    directory: str,
+    dfa: SimpleDFA,
+    services: Sequence[Service],
+    gamma: float = DEFAULT_GAMMA,
+    memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    partial_order_reduction: bool = False,
+) -> int:
+    """
+    Compute the composition MDP of comp_mdp out of core, and write it to a directory.
+
+    :param directory: the output directory; it is created if it does not exist.
+    :param dfa: the target DFA.
+    :param services: the community of services.
+    :param gamma: the discount factor.
+    :param memory_budget_mb: the memory budget of the buffer of the successors
+      (and of the blocks of the merges), and of the buffer of the transitions (half each), in MB.
+    :param batch_size: the number of states expanded at once.
+    :param partial_order_reduction: see comp_mdp.
+    :return: the number of states.
+    """
+    os.makedirs(directory, exist_ok=True)
+    model = LazyCompositionMDP(
+        dfa, services, gamma=gamma, kronecker=True, partial_order_reduction=partial_order_reduction
+    )
+    system = KroneckerSystem(*services)
+    codec = StateCodec(system, sorted(model.dfa.states, key=str))
+    budget_bytes = int(memory_budget_mb * 1024 ** 2 / 2)
+    writer = ChunkWriter(directory, budget_bytes)
+    run_files = _RunFiles(directory)
+    action_index: Dict[Action, int] = {}
+
+    initial_key = codec.encode(model.initial_state)
+    layer_writer = _RunWriter(run_files.next_path())
+    if partial_order_reduction:
+        layer_writer.write(np.array([initial_key], dtype=np.int64))
+    else:
+        # the seed states of comp_mdp: every reachable system state, paired with the initial DFA state
+        for keys in _seed_keys(codec, model.dfa.initial_state, _block_size(budget_bytes, 0)):
+            layer_writer.write(keys)
+    layer_writer.close()
+    layer_path = layer_writer.path
+    # the sorted runs of the visited states: the previous layers, merged from time to time
+    visited_paths: List[str] = []
+    nb_states = 0
+    while True:
+        layer = _read_run(layer_path)
+        if len(layer) == 0:
+            os.remove(layer_path)
+            break
+        visited_paths.append(layer_path)
+        successors = _SortedRunBuffer(run_files, budget_bytes)
+        for start in range(0, len(layer), batch_size):
+            batch_successors: List[int] = []
+            for key in layer[start : start + batch_size]:
+                writer.add_state(key, model.transitions(codec.decode(key)), codec, action_index, batch_successors)
+            successors.add(np.unique(np.asarray(batch_successors, dtype=np.int64)))
+        successors.spill()
+        nb_states += len(layer)
+        del layer
+        # delayed duplicate detection, for the whole layer
+        layer_path = _merge_to_run(successors.paths, visited_paths, run_files, budget_bytes)
+        for path in successors.paths:
+            os.remove(path)
+        if len(visited_paths) > MAX_VISITED_RUNS:
+            merged_path = _merge_to_run(visited_paths, [], run_files, budget_bytes)
+            for path in visited_paths:
+                os.remove(path)
+            visited_paths = [merged_path]
+    writer.flush()
+    for path in visited_paths:
+        os.remove(path)
+
+    write_composition_meta(
+        directory, codec, list(action_index.keys()), gamma, initial_key, writer.nb_chunks, nb_states
+    )
+    return nb_states
+
+
+def write_composition_meta(
+    directory: str,
+    codec: StateCodec,
+    actions: List[Action],
+    gamma: float,
+    initial_key: int,
+    nb_chunks: int,
+    nb_states: int,
+) -> None:
+    """
+    Write the metadata of an external composition, read by load_external_composition.
+
+    :param directory: the directory of the composition.
+    :param codec: the state codec.
+    :param actions: the actions, indexed by code.
+    :param gamma: the discount factor.
+    :param initial_key: the key of the initial state.
+    :param nb_chunks: the number of chunk files.
+    :param nb_states: the number of states.
+    """
+    with open(os.path.join(directory, META_FILE_NAME), "wb") as f:
+        pickle.dump(
+            {
+                "codec": codec,
+                "actions": actions,
+                "gamma": gamma,
+                "initial_key": initial_key,
+                "nb_chunks": nb_chunks,
+                "nb_states": nb_states,
+            },
+            f,
+            pickle.HIGHEST_PROTOCOL,
+        )
+
+
+class DecodedStates(Sequence):
+    """The states of an external composition, decoded on demand from their keys."""
+
+    def __init__(self, keys: np.ndarray, codec: StateCodec):
+        """
+        Initialize the sequence.
+
+        :param keys: the key of each state, indexed by state id.
+        :param codec: the state codec.
+        """
+        self.keys = keys
+        self.codec = codec
+
+    def __getitem__(self, index):
+        """Decode the state of an id."""
+        if isinstance(index, slice):
+            return [self.codec.decode(key) for key in self.keys[index]]
+        return self.codec.decode(self.keys[index])
+
+    def __len__(self) -> int:
+        """Get the number of states."""
+        return len(self.keys)
+
+
+def _memmap(directory: str, name: str, dtype, length: int) -> np.ndarray:
+    """Create a memory-mapped array in a directory."""
+    return np.lib.format.open_memmap(
+        os.path.join(directory, f"{name}.npy"), mode="w+", dtype=dtype, shape=(length,)
+    )
+
+
+def _key_table(
+    directory: str, chunk_paths: Sequence[str], memory_budget_bytes: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Build the table from the state keys to the state ids, by merging the sorted keys of the chunks.
+
+    :param directory: the directory of the composition.
+    :param chunk_paths: the paths of the chunks, in state id order.
+    :param memory_budget_bytes: the memory budget of the blocks of the merge.
+    :return: the key of each state id, the sorted keys, and the id of each sorted key (all memory-mapped).
+    """
+    run_files = _RunFiles(directory)
+    keys_writer = _RunWriter(os.path.join(directory, KEYS_FILE_NAME))
+    run_paths = []
+    for path in chunk_paths:
+        with np.load(path) as chunk:
+            state_keys = chunk["state_keys"]
+        order = np.argsort(state_keys, kind="stable")
+        key_run, id_run = _RunWriter(run_files.next_path()), _RunWriter(run_files.next_path())
+        key_run.write(state_keys[order])
+        id_run.write(keys_writer.size + order)
+        key_run.close()
+        id_run.close()
+        run_paths.append((key_run.path, id_run.path))
+        keys_writer.write(state_keys)
+    keys_writer.close()
+
+    sorted_keys_writer = _RunWriter(os.path.join(directory, SORTED_KEYS_FILE_NAME))
+    sorted_ids_writer = _RunWriter(os.path.join(directory, SORTED_IDS_FILE_NAME))
+    merged = _merge_runs(
+        [_read_run(key_path) for key_path, _ in run_paths],
+        _block_size(memory_budget_bytes, 2 * len(run_paths)),
+        [_read_run(id_path) for _, id_path in run_paths],
+    )
+    for keys, ids in merged:
+        sorted_keys_writer.write(keys)
+        sorted_ids_writer.write(ids)
+    sorted_keys_writer.close()
+    sorted_ids_writer.close()
+    for key_path, id_path in run_paths:
+        os.remove(key_path)
+        os.remove(id_path)
+    if sorted_keys_writer.size != keys_writer.size:
+        raise ValueError("the chunks contain the same state more than once")
+    return (
+        _read_run(keys_writer.path),
+        _read_run(sorted_keys_writer.path),
+        _read_run(sorted_ids_writer.path),
+    )
+
+
+def _lookup_ids(keys: np.ndarray, sorted_keys: np.ndarray, sorted_ids: np.ndarray) -> np.ndarray:
+    """Get the state ids of some keys, looking them up in increasing order to scan the table sequentially."""
+    order = np.argsort(keys)
+    ids = np.empty(len(keys), dtype=np.int64)
+    ids[order] = sorted_ids[np.searchsorted(sorted_keys, keys[order])]
+    return ids
+
+
+def load_external_composition(
+    directory: str, memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB
+) -> CompactMDP:
+    """
+    Load an external composition as a CompactMDP backed by memory-mapped arrays.
+
+    The first call assembles the CSR arrays from the chunks into .npy files of
+    the directory; the states are decoded from their keys on demand. The
+    next state ids are looked up in a table of the sorted keys, built by
+    merging the sorted keys of the chunks, so the memory used is that of a
+    chunk, plus one block per chunk during the merge.
+
+    :param directory: the directory written by external_comp_mdp.
+    :param memory_budget_mb: the memory budget of the blocks of the merge, in MB.
+    :return: the compact MDP; the state ids follow the order of the chunks (e.g. the expansion order).
+    """
+    with open(os.path.join(directory, META_FILE_NAME), "rb") as f:
+        meta = pickle.load(f)
+    chunk_paths = [
+        os.path.join(directory, CHUNK_FILE_PATTERN.format(index)) for index in range(meta["nb_chunks"])
+    ]
+    keys, sorted_keys, sorted_ids = _key_table(directory, chunk_paths, int(memory_budget_mb * 1024 ** 2))
+
+    # first pass: the sizes of the arrays
+    nb_state_actions, nb_transitions = 0, 0
+    for path in chunk_paths:
+        with np.load(path) as chunk:
+            nb_state_actions += len(chunk["actions"])
+            nb_transitions += len(chunk["next_keys"])
+    n_states = len(keys)
+    index_dtype = np.int32 if max(n_states, nb_transitions) < np.iinfo(np.int32).max else np.int64
+
+    # second pass: the memory-mapped arrays, in state id order
+    sa_ptr = _memmap(directory, "sa_ptr", np.int64, n_states + 1)
+    sa_action = _memmap(directory, "sa_action", np.int32, nb_state_actions)
+    rewards = _memmap(directory, "rewards", np.float64, nb_state_actions)
+    indptr = _memmap(directory, "indptr", index_dtype, nb_state_actions + 1)
+    indices = _memmap(directory, "indices", index_dtype, nb_transitions)
+    data = _memmap(directory, "data", np.float64, nb_transitions)
+    sa_ptr[0], indptr[0] = 0, 0
+    state_offset, sa_offset, transition_offset = 0, 0, 0
+    for path in chunk_paths:
+        with np.load(path) as chunk:
+            nb_chunk_states = len(chunk["state_keys"])
+            nb_chunk_sa = len(chunk["actions"])
+            nb_chunk_transitions = len(chunk["next_keys"])
+            sa_ptr[state_offset + 1 : state_offset + nb_chunk_states + 1] = sa_offset + np.cumsum(
+                chunk["nb_actions"]
+            )
+            sa_action[sa_offset : sa_offset + nb_chunk_sa] = chunk["actions"]
+            rewards[sa_offset : sa_offset + nb_chunk_sa] = chunk["rewards"]
+            indptr[sa_offset + 1 : sa_offset + nb_chunk_sa + 1] = transition_offset + np.cumsum(
+                chunk["nb_next_states"]
+            )
+            indices[transition_offset : transition_offset + nb_chunk_transitions] = _lookup_ids(
+                chunk["next_keys"], sorted_keys, sorted_ids
+            )
+            data[transition_offset : transition_offset + nb_chunk_transitions] = chunk["probs"]
+            state_offset += nb_chunk_states
+            sa_offset += nb_chunk_sa
+            transition_offset += nb_chunk_transitions
+    for array in (sa_ptr, sa_action, rewards, indptr, indices, data):
+        array.flush()
+
+    transitions = sp.csr_matrix((data, indices, indptr), shape=(nb_state_actions, n_states), copy=False)
+    initial_state = _lookup_ids(np.array([meta["initial_key"]], dtype=np.int64), sorted_keys, sorted_ids)[0]
+    return CompactMDP(
+        DecodedStates(keys, meta["codec"]),
+        meta["actions"],
+        sa_ptr,
+        sa_action,
+        rewards,
+        transitions,
+        meta["gamma"],
+        int(initial_state),
+    )
+
+
+def delete_external_composition(directory: str) -> None:
+    """Delete the files written by external_comp_mdp and load_external_composition."""
+    for path in glob.glob(os.path.join(directory, "*.np[yz]")) + glob.glob(os.path.join(directory, "*.bin")) + [
+        os.path.join(directory, META_FILE_NAME)
+    ]:
+        if os.path.exists(path):
+            os.remove(path)
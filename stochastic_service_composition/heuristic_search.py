@@ -0,0 +1,249 @@
+"""
+This module implements a goal-directed heuristic search solver for the composition MDP.
+
+The solver is Labeled RTDP (Bonet and Geffner, 2003): it expands the
+composition lazily, from the initial state only, using the successor logic
+of LazyCompositionMDP, and it only touches the states reachable under the
+greedy policies it tries. Since rewards are maximized, the heuristic must be
+admissible in the sense of being an upper bound of the optimal value.
+"""
+import random
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from mdp_dp_rl.processes.det_policy import DetPolicy
+from pythomata import SimpleDFA
+
+from stochastic_service_composition.composition_mdp import (
+    COMPOSITION_MDP_SINK_STATE,
+    LazyCompositionMDP,
+)
+from stochastic_service_composition.types import Action, Prob, Reward, State
+
+Heuristic = Callable[[State], float]
+Transitions = Dict[Action, Tuple[Dict[State, Prob], Reward]]
+
+DEFAULT_EPSILON = 1e-4
+DEFAULT_MAX_DEPTH = 1000
+
+
+def dfa_distances(dfa: SimpleDFA) -> Dict[State, int]:
+    """
+    Compute, for each DFA state, the minimum number of transitions to reach an accepting state.
+
+    At least one transition is required, also from accepting states.
+    States that cannot reach an accepting state are not included.
+
+    :param dfa: the DFA.
+    :return: the distances, indexed by DFA state.
+    """
+    predecessors: Dict[State, Set[State]] = {}
+    for start, transitions_by_symbol in dfa.transition_function.items():
+        for end in transitions_by_symbol.values():
+            predecessors.setdefault(end, set()).add(start)
+    distances: Dict[State, int] = {}
+    queue: Deque[State] = deque()
+    for accepting_state in dfa.accepting_states:
+        for predecessor in predecessors.get(accepting_state, set()):
+            if predecessor not in distances:
+                distances[predecessor] = 1
+                queue.append(predecessor)
+    while len(queue) > 0:
+        state = queue.popleft()
+        for predecessor in predecessors.get(state, set()):
+            if predecessor not in distances:
+                distances[predecessor] = distances[state] + 1
+                queue.append(predecessor)
+    return distances
+
+
+def goal_distance_heuristic(model: LazyCompositionMDP, goal_reward: float = 1.0) -> Heuristic:
+    """
+    Build an admissible heuristic from the DFA distance to acceptance.
+
+    Every transition yields at most c, the highest reward of a service action
+    (or zero, the reward of the sink), plus the goal reward when it reaches an
+    accepting DFA state; from a DFA state at distance d, this cannot happen
+    before d steps. Hence, the optimal value is at most
+
+        c / (1 - gamma) + goal_reward * gamma^(d-1) / (1 - gamma).
+
+    :param model: the lazy composition MDP.
+    :param goal_reward: the reward of the transitions to accepting states.
+    :return: the heuristic.
+    """
+    gamma = model.gamma
+    distances = dfa_distances(model.dfa)
+    max_reward = max(
+        [0.0]
+        + [
+            reward
+            for service in model.services
+            for transitions_by_action in service.transition_function.values()
+            for _next_states, reward in transitions_by_action.values()
+        ]
+    )
+    base_value = max_reward / (1.0 - gamma)
+
+    def heuristic(state: State) -> float:
+        if state == COMPOSITION_MDP_SINK_STATE:
+            return 0.0
+        _system_state, dfa_state = state
+        distance = distances.get(dfa_state)
+        if distance is None:
+            return base_value
+        return base_value + goal_reward * gamma ** (distance - 1) / (1.0 - gamma)
+
+    return heuristic
+
+
+class LRTDP:
+    """Labeled RTDP over a lazily expanded composition MDP."""
+
+    def __init__(
+        self,
+        model: LazyCompositionMDP,
+        heuristic: Optional[Heuristic] = None,
+        epsilon: float = DEFAULT_EPSILON,
+        max_depth: int = DEFAULT_MAX_DEPTH,
+        seed: Optional[int] = None,
+    ):
+        """
+        Initialize the solver.
+
+        :param model: the lazy composition MDP.
+        :param heuristic: an upper bound of the optimal value (default: goal_distance_heuristic).
+        :param epsilon: the residual under which a state is considered solved.
+        :param max_depth: the maximum length of a trial.
+        :param seed: the seed of the random generator used to sample the trials.
+        """
+        self.model = model
+        self.heuristic = heuristic if heuristic is not None else goal_distance_heuristic(model)
+        self.epsilon = epsilon
+        self.max_depth = max_depth
+        self.random = random.Random(seed)
+        self.values: Dict[State, float] = {}
+        self.solved: Set[State] = set()
+        self._transitions: Dict[State, Transitions] = {}
+
+    @property
+    def nb_expanded_states(self) -> int:
+        """Get the number of states expanded so far."""
+        return len(self._transitions)
+
+    def _get_transitions(self, state: State) -> Transitions:
+        """Get the transitions of a state, expanding it if needed."""
+        transitions = self._transitions.get(state)
+        if transitions is None:
+            transitions = self.model.transitions(state)
+            self._transitions[state] = transitions
+        return transitions
+
+    def _value(self, state: State) -> float:
+        """Get the current value of a state, initialized with the heuristic."""
+        value = self.values.get(state)
+        if value is None:
+            value = self.heuristic(state)
+            self.values[state] = value
+        return value
+
+    def _greedy(self, state: State) -> Tuple[Action, float]:
+        """Get the greedy action of a state and its Q-value."""
+        gamma = self.model.gamma
+        best_action, best_value = None, float("-inf")
+        for action, (next_states, reward) in self._get_transitions(state).items():
+            q_value = reward + gamma * sum(
+                prob * self._value(next_state) for next_state, prob in next_states.items()
+            )
+            if q_value > best_value:
+                best_action, best_value = action, q_value
+        return best_action, best_value
+
+    def _sample(self, state: State, action: Action) -> State:
+        """Sample a successor of a state-action pair."""
+        next_states, _reward = self._get_transitions(state)[action]
+        threshold = self.random.random()
+        cumulative = 0.0
+        next_state = state
+        for next_state, prob in next_states.items():
+            cumulative += prob
+            if threshold < cumulative:
+                break
+        return next_state
+
+    def _check_solved(self, state: State) -> bool:
+        """Label the states of the greedy graph of a state as solved, if all of them are epsilon-consistent."""
+        result = True
+        open_states: List[State] = [] if state in self.solved else [state]
+        closed_states: List[State] = []
+        in_graph = set(open_states)
+        while len(open_states) > 0:
+            current_state = open_states.pop()
+            closed_states.append(current_state)
+            action, q_value = self._greedy(current_state)
+            if abs(q_value - self._value(current_state)) > self.epsilon:
+                result = False
+                continue
+            next_states, _reward = self._get_transitions(current_state)[action]
+            for next_state in next_states.keys():
+                if next_state not in self.solved and next_state not in in_graph:
+                    in_graph.add(next_state)
+                    open_states.append(next_state)
+        if result:
+            self.solved.update(closed_states)
+        else:
+            while len(closed_states) > 0:
+                current_state = closed_states.pop()
+                self.values[current_state] = self._greedy(current_state)[1]
+        return result
+
+    def _trial(self, state: State) -> None:
+        """Run a trial from a state, then label the visited states backwards."""
+        visited: List[State] = []
+        while state not in self.solved and len(visited) < self.max_depth:
+            visited.append(state)
+            action, q_value = self._greedy(state)
+            self.values[state] = q_value
+            state = self._sample(state, action)
+        while len(visited) > 0:
+            if not self._check_solved(visited.pop()):
+                break
+
+    def solve(self, max_trials: Optional[int] = None) -> Tuple[DetPolicy, Dict[State, float]]:
+        """
+        Run the trials until the initial state is solved.
+
+        :param max_trials: the maximum number of trials (default: unbounded).
+        :return: the greedy policy over the solved states, and their values.
+        """
+        initial_state = self.model.initial_state
+        nb_trials = 0
+        while initial_state not in self.solved and (
+            max_trials is None or nb_trials < max_trials
+        ):
+            self._trial(initial_state)
+            nb_trials += 1
+        policy_data = {state: self._greedy(state)[0] for state in self.solved}
+        values = {state: self.values[state] for state in self.solved}
+        return DetPolicy(policy_data), values
+
+
+def lrtdp(
+    model: LazyCompositionMDP,
+    heuristic: Optional[Heuristic] = None,
+    epsilon: float = DEFAULT_EPSILON,
+    max_trials: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> Tuple[DetPolicy, Dict[State, float]]:
+    """
+    Compute a policy for the initial state of the composition with Labeled RTDP.
+
+    :param model: the lazy composition MDP.
+    :param heuristic: an upper bound of the optimal value (default: goal_distance_heuristic).
+    :param epsilon: the residual under which a state is considered solved.
+    :param max_trials: the maximum number of trials (default: unbounded).
+    :param seed: the seed of the random generator used to sample the trials.
+    :return: the greedy policy over the solved states, and their values.
+    """
+    solver = LRTDP(model, heuristic=heuristic, epsilon=epsilon, seed=seed)
+    return solver.solve(max_trials=max_trials)
@@ -0,0 +1,217 @@
+"""
+This module implements the progress reporting of the composition builders and of the solvers.
+
+The long-running functions (comp_mdp, composition_mdp and the sparse solvers)
+accept an optional progress reporter. When given, they notify it of every
+expanded state or every sweep; the reporter emits an event to its sinks at
+most once per interval, e.g.
+
+    progress = ProgressReporter(LoggingSink(), JsonlSink("progress.jsonl"))
+    mdp = comp_mdp(dfa, services, progress=progress)
+
+When no reporter is given, the only overhead is a check against None.
+"""
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+
+Event = Dict[str, Any]
+
+DEFAULT_INTERVAL = 5.0
+# the number of notifications between two clock reads, during the composition
+DEFAULT_CHECK_EVERY = 1024
+
+
+def current_rss_mb() -> float:
+    """Get the current resident set size of the process, in MB (the peak one, if not available)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return max_rss / 1024 ** 2 if sys.platform == "darwin" else max_rss / 1024
+
+
+class Sink(ABC):
+    """A destination of the progress events."""
+
+    @abstractmethod
+    def emit(self, event: Event) -> None:
+        """Emit an event."""
+
+    def close(self) -> None:
+        """Release the resources of the sink."""
+
+
+class LoggingSink(Sink):
+    """Write the events to a logger."""
+
+    def __init__(self, logger: Optional[logging.Logger] = None, level: int = logging.INFO):
+        """
+        Initialize the sink.
+
+        :param logger: the logger (default: the logger of this module).
+        :param level: the logging level of the events.
+        """
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.level = level
+
+    def emit(self, event: Event) -> None:
+        """Emit an event."""
+        fields = ", ".join(
+            f"{key}={value:.4g}" if isinstance(value, float) else f"{key}={value}"
+            for key, value in event.items()
+            if key not in ("stage", "time")
+        )
+        self.logger.log(self.level, "%s: %s", event["stage"], fields)
+
+
+class JsonlSink(Sink):
+    """Append the events to a JSON Lines file."""
+
+    def __init__(self, path: str):
+        """
+        Initialize the sink.
+
+        :param path: the path of the file.
+        """
+        self.file = open(path, "a")
+
+    def emit(self, event: Event) -> None:
+        """Emit an event."""
+        self.file.write(json.dumps(event) + "\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        """Close the file."""
+        self.file.close()
+
+
+class PrometheusSink(Sink):
+    """Expose the last values of the events as Prometheus gauges, on a local HTTP endpoint."""
+
+    def __init__(self, port: int = 8000, prefix: str = "ssc"):
+        """
+        Initialize the sink, and start the HTTP server.
+
+        :param port: the port of the endpoint.
+        :param prefix: the prefix of the metric names.
+        """
+        try:
+            import prometheus_client
+        except ImportError as e:
+            raise ImportError("PrometheusSink requires the prometheus-client package") from e
+        self._prometheus_client = prometheus_client
+        self.prefix = prefix
+        self.registry = prometheus_client.CollectorRegistry()
+        self.gauges: Dict[str, Any] = {}
+        prometheus_client.start_http_server(port, registry=self.registry)
+
+    def emit(self, event: Event) -> None:
+        """Emit an event."""
+        for key, value in event.items():
+            if not isinstance(value, (int, float)) or key == "time":
+                continue
+            name = f"{self.prefix}_{event['stage']}_{key}"
+            gauge = self.gauges.get(name)
+            if gauge is None:
+                gauge = self._prometheus_client.Gauge(name, key, registry=self.registry)
+                self.gauges[name] = gauge
+            gauge.set(value)
+
+
+class ProgressReporter:
+    """Collect the notifications of the builders and the solvers, and periodically emit events."""
+
+    def __init__(
+        self,
+        *sinks: Sink,
+        interval: float = DEFAULT_INTERVAL,
+        check_every: int = DEFAULT_CHECK_EVERY,
+    ):
+        """
+        Initialize the reporter.
+
+        :param sinks: the destinations of the events.
+        :param interval: the minimum time between two events, in seconds.
+        :param check_every: the number of expanded states between two clock reads.
+        """
+        self.sinks = sinks
+        self.interval = interval
+        self.check_every = check_every
+        self._nb_calls = 0
+        self._start_time = time.perf_counter()
+        self._last_time = self._start_time
+        self._last_count = 0
+        self._last_sweep_time = self._start_time
+
+    def _emit(self, event: Event) -> None:
+        """Send an event to all the sinks."""
+        event["time"] = time.time()
+        event["elapsed"] = time.perf_counter() - self._start_time
+        event["rss_mb"] = current_rss_mb()
+        for sink in self.sinks:
+            sink.emit(event)
+
+    def expanded(
+        self, nb_expanded: int, frontier_size: int, nb_transitions: int, force: bool = False
+    ) -> None:
+        """
+        Notify the expansion of a state during the composition.
+
+        :param nb_expanded: the number of states expanded so far.
+        :param frontier_size: the number of states waiting to be expanded.
+        :param nb_transitions: the number of transitions generated so far.
+        :param force: emit an event regardless of the interval (e.g. at the end).
+        """
+        self._nb_calls += 1
+        if not force and self._nb_calls % self.check_every != 0:
+            return
+        now = time.perf_counter()
+        if not force and now - self._last_time < self.interval:
+            return
+        rate = (nb_expanded - self._last_count) / max(now - self._last_time, 1e-9)
+        self._last_time, self._last_count = now, nb_expanded
+        self._emit(
+            {
+                "stage": "composition",
+                "expanded": nb_expanded,
+                "expanded_per_second": rate,
+                "frontier": frontier_size,
+                "transitions": nb_transitions,
+            }
+        )
+
+    def sweep(self, iteration: int, residual: float, force: bool = False) -> None:
+        """
+        Notify the end of a sweep of a solver.
+
+        :param iteration: the number of sweeps performed so far.
+        :param residual: the current residual (e.g. the max difference, or the gap between the bounds).
+        :param force: emit an event regardless of the interval (e.g. at the end).
+        """
+        now = time.perf_counter()
+        sweep_time = now - self._last_sweep_time
+        self._last_sweep_time = now
+        if not force and now - self._last_time < self.interval:
+            return
+        self._last_time = now
+        self._emit(
+            {
+                "stage": "solver",
+                "iteration": iteration,
+                "residual": float(residual),
+                "sweep_seconds": sweep_time,
+            }
+        )
+
+    def close(self) -> None:
+        """Close all the sinks."""
+        for sink in self.sinks:
+            sink.close()
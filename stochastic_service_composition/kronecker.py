@@ -0,0 +1,329 @@
+"""
+This module implements a Kronecker-structured view of the system service.
+
+The system service computed by build_system_service is an interleaving product:
+at each step exactly one service i moves, while all the others stay put.
+Hence, for each system symbol (action, i), the system transition matrix is
+
+    I ⊗ ... ⊗ P_i(action) ⊗ ... ⊗ I
+
+where P_i(action) is the (small) local transition matrix of service i.
+The KroneckerSystem class exploits this structure: system states are encoded
+in a mixed-radix fashion, the per-symbol sparse matrices are built with
+vectorized operations, and the transitions of a single system state are
+computed on demand from the component services, without any breadth-first
+search over tuples.
+
+Since the services move independently, a system state is reachable from the
+initial state if and only if each of its components is reachable from the
+initial state of its service. Hence, the states of the system service (see
+to_service) are the product of the locally reachable states, which is the
+same set explored by build_system_service. The encoding and the per-symbol
+matrices, instead, range over the full product of the local states.
+"""
+import itertools
+from typing import AbstractSet, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+
+from stochastic_service_composition.services import Service
+from stochastic_service_composition.types import Action, Prob, Reward, State
+
+SystemSymbol = Tuple[Action, int]
+
+
+class _LocalAction:
+    """The local dynamics of one action of one service, in matrix form."""
+
+    def __init__(self, matrix: np.ndarray, reward: np.ndarray, enabled: np.ndarray):
+        """
+        Initialize the local action.
+
+        :param matrix: the (dense) local transition matrix, of shape (n_i, n_i)
+        :param reward: the reward vector, of shape (n_i,)
+        :param enabled: the boolean mask of the states in which the action is enabled
+        """
+        self.matrix = matrix
+        self.reward = reward
+        self.enabled = enabled
+
+
+def _reachable_local_states(service: Service, states: Sequence[State]) -> List[State]:
+    """Get the states of a service reachable from its initial state, in the order of states."""
+    reachable = {service.initial_state}
+    stack = [service.initial_state]
+    while len(stack) > 0:
+        state = stack.pop()
+        for next_states, _reward in service.transition_function.get(state, {}).values():
+            for next_state in next_states:
+                if next_state not in reachable:
+                    reachable.add(next_state)
+                    stack.append(next_state)
+    return [state for state in states if state in reachable]
+
+
+class KroneckerSystem:
+    """The system service of a community of services, in Kronecker-structured form."""
+
+    def __init__(self, *services: Service):
+        """
+        Initialize the Kronecker system.
+
+        :param services: a list of service instances
+        """
+        assert len(services) >= 2, "at least two services"
+        self.services: Sequence[Service] = services
+        self.local_states: List[List[State]] = [
+            sorted(service.states, key=str) for service in services
+        ]
+        self.local_index: List[Dict[State, int]] = [
+            {state: index for index, state in enumerate(states)}
+            for states in self.local_states
+        ]
+        self.shape: Tuple[int, ...] = tuple(len(states) for states in self.local_states)
+        self.n_states = int(np.prod(self.shape, dtype=np.int64))
+        self.strides: Tuple[int, ...] = tuple(
+            int(np.prod(self.shape[i + 1 :], dtype=np.int64))
+            for i in range(len(services))
+        )
+        self.initial_state: Tuple[State, ...] = tuple(
+            service.initial_state for service in services
+        )
+        self.initial_index = self.encode(self.initial_state)
+        self.reachable_local_states: List[List[State]] = [
+            _reachable_local_states(service, states)
+            for service, states in zip(services, self.local_states)
+        ]
+        self.n_reachable_states = int(
+            np.prod([len(states) for states in self.reachable_local_states], dtype=np.int64)
+        )
+
+        self._local_actions: Dict[SystemSymbol, _LocalAction] = {}
+        for i, service in enumerate(services):
+            for action in sorted(service.actions, key=str):
+                self._local_actions[(action, i)] = self._build_local_action(i, action)
+        self.symbols: List[SystemSymbol] = list(self._local_actions.keys())
+
+    def _build_local_action(self, i: int, action: Action) -> _LocalAction:
+        """Build the matrix form of the action of the i-th service."""
+        service = self.services[i]
+        index = self.local_index[i]
+        n = self.shape[i]
+        matrix = np.zeros((n, n))
+        reward = np.zeros(n)
+        enabled = np.zeros(n, dtype=bool)
+        for state, transitions_by_action in service.transition_function.items():
+            if action not in transitions_by_action:
+                continue
+            next_states, action_reward = transitions_by_action[action]
+            start = index[state]
+            enabled[start] = True
+            reward[start] = action_reward
+            for next_state, prob in next_states.items():
+                matrix[start, index[next_state]] = prob
+        return _LocalAction(matrix, reward, enabled)
+
+    def encode(self, state: Tuple[State, ...]) -> int:
+        """Encode a system state (a tuple of service states) as an integer."""
+        return sum(
+            self.local_index[i][component] * self.strides[i]
+            for i, component in enumerate(state)
+        )
+
+    def decode(self, index: int) -> Tuple[State, ...]:
+        """Decode an integer into a system state (a tuple of service states)."""
+        return tuple(
+            self.local_states[i][(index // self.strides[i]) % self.shape[i]]
+            for i in range(len(self.shape))
+        )
+
+    def states(self) -> Iterator[Tuple[State, ...]]:
+        """Iterate over the reachable system states, in encoding order."""
+        return itertools.product(*self.reachable_local_states)
+
+    def transitions_from(
+        self, state: Tuple[State, ...]
+    ) -> Dict[SystemSymbol, Tuple[Dict[Tuple[State, ...], Prob], Reward]]:
+        """
+        Compute the outgoing transitions of a system state.
+
+        The result has the same shape (and ordering) as the transitions
+        computed by build_system_service for the same state.
+
+        :param state: the system state
+        :return: the transitions, indexed by system symbol
+        """
+        result: Dict[SystemSymbol, Tuple[Dict[Tuple[State, ...], Prob], Reward]] = {}
+        for i, service in enumerate(self.services):
+            for action, (next_service_states, reward) in service.transition_function[
+                state[i]
+            ].items():
+                next_states = {}
+                for next_service_state, prob in next_service_states.items():
+                    next_state = state[:i] + (next_service_state,) + state[i + 1 :]
+                    next_states[next_state] = prob
+                result[(action, i)] = (next_states, reward)
+        return result
+
+    def matrix(self, symbol: SystemSymbol) -> sp.csr_matrix:
+        """
+        Get the system transition matrix of a system symbol.
+
+        Rows of states in which the symbol is not enabled are empty.
+
+        :param symbol: the system symbol (action, service id)
+        :return: the sparse matrix of shape (n_states, n_states)
+        """
+        _action, i = symbol
+        local = self._local_actions[symbol]
+        left = int(np.prod(self.shape[:i], dtype=np.int64))
+        right = self.strides[i]
+        result = sp.kron(
+            sp.identity(left, format="csr"),
+            sp.kron(sp.csr_matrix(local.matrix), sp.identity(right, format="csr")),
+            format="csr",
+        )
+        return result
+
+    def _broadcast(self, symbol: SystemSymbol, local_vector: np.ndarray) -> np.ndarray:
+        """Broadcast a local vector of the i-th service to the whole system."""
+        _action, i = symbol
+        view_shape = [1] * len(self.shape)
+        view_shape[i] = self.shape[i]
+        return np.broadcast_to(local_vector.reshape(view_shape), self.shape).reshape(-1)
+
+    def reward(self, symbol: SystemSymbol) -> np.ndarray:
+        """Get the reward vector of a system symbol, of shape (n_states,)."""
+        return self._broadcast(symbol, self._local_actions[symbol].reward)
+
+    def enabled(self, symbol: SystemSymbol) -> np.ndarray:
+        """Get the boolean mask of the system states in which the symbol is enabled."""
+        return self._broadcast(symbol, self._local_actions[symbol].enabled)
+
+    def apply(self, symbol: SystemSymbol, vector: np.ndarray) -> np.ndarray:
+        """
+        Compute the product between the transition matrix of a symbol and a vector.
+
+        The matrix is applied implicitly, i.e. only the local matrix of the
+        moving service is used, along the corresponding axis of the system tensor.
+
+        :param symbol: the system symbol (action, service id)
+        :param vector: a vector of shape (n_states,)
+        :return: the vector P(symbol) @ vector
+        """
+        _action, i = symbol
+        tensor = vector.reshape(self.shape)
+        result = np.tensordot(self._local_actions[symbol].matrix, tensor, axes=([1], [i]))
+        return np.moveaxis(result, 0, i).reshape(-1)
+
+    @property
+    def transition_function(self) -> Mapping[Tuple[State, ...], Dict]:
+        """Get the (lazily computed) transition function of the system service."""
+        return _LazyTransitionFunction(self)
+
+    def to_service(self) -> Service:
+        """
+        Get the system service, with a lazily computed transition function.
+
+        The system states are the combinations of the reachable service states,
+        i.e. the states reachable from the initial state, as in build_system_service;
+        the final states are the ones whose components are all final. Both sets
+        are views over the product, i.e. they are not materialized.
+
+        :return: the system service
+        """
+        states = _ProductSet(self.reachable_local_states)
+        final_states = _ProductSet(
+            [
+                [state for state in local_states if state in service.final_states]
+                for local_states, service in zip(self.reachable_local_states, self.services)
+            ]
+        )
+        return Service(
+            states=states,
+            actions=set(self.symbols),
+            final_states=final_states,
+            initial_state=self.initial_state,
+            transition_function=self.transition_function,  # type: ignore
+        )
+
+
+class _LazyTransitionFunction(Mapping):
+    """A read-only mapping from system states to their outgoing transitions."""
+
+    def __init__(self, system: KroneckerSystem):
+        """Initialize the mapping."""
+        self._system = system
+        self._last_key: Optional[Tuple[State, ...]] = None
+        self._last_value: Optional[Dict] = None
+
+    def __getitem__(self, state: Tuple[State, ...]) -> Dict:
+        """Get the transitions from a system state (the last lookup is cached)."""
+        if state != self._last_key:
+            self._last_value = self._system.transitions_from(state)
+            self._last_key = state
+        return self._last_value  # type: ignore
+
+    def __iter__(self) -> Iterator[Tuple[State, ...]]:
+        """Iterate over the reachable system states."""
+        return self._system.states()
+
+    def __len__(self) -> int:
+        """Get the number of reachable system states."""
+        return self._system.n_reachable_states
+
+
+class _ProductSet(AbstractSet):
+    """A read-only set of tuples, the Cartesian product of some sets of components."""
+
+    def __init__(self, components: Sequence[Sequence[State]]):
+        """Initialize the set."""
+        self._components = [list(component) for component in components]
+        self._component_sets = [set(component) for component in components]
+
+    def __contains__(self, item: object) -> bool:
+        """Check whether a tuple belongs to the product."""
+        return (
+            isinstance(item, tuple)
+            and len(item) == len(self._component_sets)
+            and all(value in values for value, values in zip(item, self._component_sets))
+        )
+
+    def __iter__(self) -> Iterator[Tuple[State, ...]]:
+        """Iterate over the tuples, in lexicographic order of the components."""
+        return itertools.product(*self._components)
+
+    def __len__(self) -> int:
+        """Get the number of tuples."""
+        return int(np.prod([len(component) for component in self._components], dtype=np.int64))
+
+
+def build_system_service_kronecker(*services: Service) -> Service:
+    """
+    Build the system service without exploring the product state space.
+
+    The states are the same as the ones of build_system_service (the reachable
+    system states), but they are enumerated as the product of the reachable
+    states of each service.
+
+    :param services: a list of service instances
+    :return: the system service, with a lazily computed transition function
+    """
+    return KroneckerSystem(*services).to_service()
+
+
+def system_matrices(
+    *services: Service,
+) -> Dict[SystemSymbol, Tuple[sp.csr_matrix, np.ndarray]]:
+    """
+    Build the per-symbol transition matrices and reward vectors of the system service.
+
+    :param services: a list of service instances
+    :return: a mapping from system symbol (action, service id) to (matrix, reward vector)
+    """
+    system = KroneckerSystem(*services)
+    return {
+        symbol: (system.matrix(symbol), system.reward(symbol))
+        for symbol in system.symbols
+    }
@@ -0,0 +1,280 @@
+"""
+This module implements the compilation of service-internal chains into macro actions.
+
+Breakable services have deterministic maintenance chains, e.g.
+br --res--> rep --rep--> re, in which every intermediate state has exactly one,
+deterministic, service-internal (tau) action. Such states are "transient",
+and they multiply the size of the system service. The compilation removes
+them: every transition entering a transient state is redirected to the state
+in which its chain ends, and the rewards collected along the chain are
+accumulated (discounted) into the reward of the redirected action.
+
+The compiled model is an approximation of the composition MDP, not an
+equivalent rewrite:
+
+- in the composition MDP, the tau actions are choices of the controller,
+  which may postpone a chain, or never take it, e.g. leave a broken service
+  broken and use another service that can do the same target action; after
+  the compilation, the chain is always taken, and its cost always paid;
+- the chain is executed in a single step of the compiled service; hence, the
+  states reached after a macro transition are discounted as if the chain took
+  no time.
+
+Hence, the compiled policy may be suboptimal for the original services;
+validate_compiled_policy measures its loss on the primitive composition MDP.
+"""
+from typing import Any, Collection, Dict, List, Sequence, Set, Tuple
+
+import numpy as np
+from pythomata import SimpleDFA
+
+from stochastic_service_composition.compact_mdp import CompactMDP
+from stochastic_service_composition.composition_mdp import (
+    COMPOSITION_MDP_SINK_STATE,
+    COMPOSITION_MDP_UNDEFINED_ACTION,
+    LazyCompositionMDP,
+    comp_mdp,
+)
+from stochastic_service_composition.constants import DEFAULT_GAMMA
+from stochastic_service_composition.services import (
+    Service,
+    build_service_from_transitions,
+)
+from stochastic_service_composition.sparse_solvers import (
+    DEFAULT_EPSILON,
+    evaluate_policy,
+    value_iteration,
+)
+from stochastic_service_composition.types import Action, MDPDynamics, Reward, State
+
+MacroExpansion = Dict[State, Tuple[Tuple[Action, ...], State]]
+
+
+def _is_transient(
+    service: Service, state: State, target_actions: Collection[Action]
+) -> bool:
+    """Check whether a service state is transient."""
+    if state == service.initial_state or state in service.final_states:
+        return False
+    transitions_by_action = service.transition_function.get(state, {})
+    if len(transitions_by_action) != 1:
+        return False
+    ((action, (next_states, _reward)),) = transitions_by_action.items()
+    return action not in target_actions and len(next_states) == 1
+
+
+def _resolve_chain(
+    service: Service, state: State, transient_states: Set[State], gamma: float
+) -> Tuple[State, Reward, Tuple[Action, ...]]:
+    """
+    Follow the chain of tau actions from a transient state.
+
+    :param service: the service
+    :param state: the transient state the chain starts from
+    :param transient_states: the set of transient states
+    :param gamma: the discount factor
+    :return: the state where the chain ends, the discounted reward
+      collected along the chain, and the sequence of primitive actions.
+    """
+    actions: List[Action] = []
+    reward = 0.0
+    discount = 1.0
+    current_state = state
+    while current_state in transient_states:
+        ((action, (next_states, action_reward)),) = service.transition_function[
+            current_state
+        ].items()
+        (next_state,) = next_states.keys()
+        actions.append(action)
+        reward += discount * action_reward
+        discount *= gamma
+        current_state = next_state
+    return current_state, reward, tuple(actions)
+
+
+def compile_macro_actions(
+    service: Service,
+    target_actions: Collection[Action],
+    gamma: float = DEFAULT_GAMMA,
+) -> Tuple[Service, MacroExpansion]:
+    """
+    Collapse the deterministic tau chains of a service into macro transitions.
+
+    The result is an approximation (see the module docstring): the chains
+    are forced, and they take a single step.
+
+    A state is transient if it is neither initial nor final, and it has
+    exactly one action, which is not a target action and leads
+    deterministically to a single next state. Chains of transient states
+    forming a cycle are left untouched.
+
+    :param service: the service
+    :param target_actions: the actions of the target (e.g. the DFA alphabet);
+      all the other actions are considered service-internal.
+    :param gamma: the discount factor used to accumulate the rewards along the chains.
+    :return: the compiled service, and the mapping from each removed state
+      to the primitive actions to execute from it and the state they lead to.
+    """
+    transient_states = {
+        state
+        for state in service.states
+        if _is_transient(service, state, target_actions)
+    }
+    # transient states on a cycle of transient states cannot be removed
+    for state in list(transient_states):
+        current_state, seen = state, set()
+        while current_state in transient_states and current_state not in seen:
+            seen.add(current_state)
+            ((_action, (next_states, _reward)),) = service.transition_function[
+                current_state
+            ].items()
+            (current_state,) = next_states.keys()
+        if current_state in seen:
+            transient_states.difference_update(seen)
+
+    expansion: MacroExpansion = {}
+    chain_rewards: Dict[State, Reward] = {}
+    for state in transient_states:
+        end_state, reward, actions = _resolve_chain(
+            service, state, transient_states, gamma
+        )
+        expansion[state] = (actions, end_state)
+        chain_rewards[state] = reward
+
+    new_transition_function: MDPDynamics = {}
+    for state, transitions_by_action in service.transition_function.items():
+        if state in transient_states:
+            continue
+        new_transition_function[state] = {}
+        for action, (next_states, reward) in transitions_by_action.items():
+            new_next_states: Dict[State, float] = {}
+            new_reward = reward
+            for next_state, prob in next_states.items():
+                if next_state in transient_states:
+                    _actions, end_state = expansion[next_state]
+                    new_reward += gamma * prob * chain_rewards[next_state]
+                else:
+                    end_state = next_state
+                new_next_states[end_state] = new_next_states.get(end_state, 0.0) + prob
+            new_transition_function[state][action] = (new_next_states, new_reward)
+
+    new_service = build_service_from_transitions(
+        new_transition_function, service.initial_state, set(service.final_states)
+    )
+    return new_service, expansion
+
+
+def compile_services(
+    services: Sequence[Service],
+    target_actions: Collection[Action],
+    gamma: float = DEFAULT_GAMMA,
+) -> Tuple[List[Service], List[MacroExpansion]]:
+    """
+    Compile the macro actions of a community of services.
+
+    To be applied before build_system_service; the compiled composition is
+    an approximation of the original one (see validate_compiled_policy).
+    At execution time, after an
+    action of the i-th service, if the service ends up in a removed state s,
+    the controller executes the primitive actions in expansions[i][s].
+
+    :param services: the community of services.
+    :param target_actions: the actions of the target (e.g. the DFA alphabet).
+    :param gamma: the discount factor.
+    :return: the compiled services, and the macro expansions of each service.
+    """
+    new_services = []
+    expansions = []
+    for service in services:
+        new_service, expansion = compile_macro_actions(service, target_actions, gamma)
+        new_services.append(new_service)
+        expansions.append(expansion)
+    return new_services, expansions
+
+
+def _lifted_action(
+    state: State,
+    model: LazyCompositionMDP,
+    compiled_mdp: CompactMDP,
+    compiled_best_sa: np.ndarray,
+    expansions: Sequence[MacroExpansion],
+) -> Action:
+    """
+    Get the action of the compiled policy in a state of the primitive composition MDP.
+
+    If an allowed service is in a removed state, the next action of its chain
+    is executed, as the compiled model assumes; otherwise, the removed states
+    are replaced by the end of their chains, and the action of the compiled
+    policy in that state is taken.
+    """
+    if state == COMPOSITION_MDP_SINK_STATE:
+        return COMPOSITION_MDP_UNDEFINED_ACTION
+    system_state, dfa_state = state
+    allowed_services = model.allowed_services(dfa_state)
+    compiled_system_state = []
+    for service_id, service_state in enumerate(system_state):
+        if service_state not in expansions[service_id]:
+            compiled_system_state.append(service_state)
+            continue
+        actions, end_state = expansions[service_id][service_state]
+        if service_id in allowed_services:
+            return actions[0], service_id
+        compiled_system_state.append(end_state)
+    compiled_state = (tuple(compiled_system_state), dfa_state)
+    if compiled_state not in compiled_mdp.state_index:
+        raise ValueError(f"state {state} has no counterpart in the compiled composition")
+    state_id = compiled_mdp.state_index[compiled_state]
+    return compiled_mdp.actions[compiled_mdp.sa_action[compiled_best_sa[state_id]]]
+
+
+def validate_compiled_policy(
+    dfa: SimpleDFA,
+    services: Sequence[Service],
+    gamma: float = DEFAULT_GAMMA,
+    epsilon: float = DEFAULT_EPSILON,
+) -> Dict[str, Any]:
+    """
+    Measure the loss of the policy computed on the compiled services, on the primitive composition MDP.
+
+    Both composition MDPs are solved with value_iteration; the compiled
+    policy is lifted to the primitive states (the chains are executed as soon
+    as their service is allowed), and evaluated exactly on the primitive MDP.
+
+    :param dfa: the target DFA.
+    :param services: the (primitive) community of services.
+    :param gamma: the discount factor.
+    :param epsilon: the tolerance of value_iteration.
+    :return: the outcome: the optimal value of the initial state, the value
+      of the initial state in the compiled MDP, the value of the lifted
+      compiled policy, its loss with respect to the optimal value, and
+      whether the loss is within the tolerance.
+    """
+    compiled_services, expansions = compile_services(services, dfa.alphabet, gamma)
+    mdp = CompactMDP.from_mdp(comp_mdp(dfa, services, gamma=gamma))  # type: ignore
+    compiled_mdp = CompactMDP.from_mdp(comp_mdp(dfa, compiled_services, gamma=gamma))  # type: ignore
+    result = value_iteration(mdp, epsilon=epsilon)
+    compiled_result = value_iteration(compiled_mdp, epsilon=epsilon)
+
+    model = LazyCompositionMDP(dfa, services, gamma=gamma)
+    lifted_best_sa = np.fromiter(
+        (
+            mdp.state_action(
+                state_id, _lifted_action(state, model, compiled_mdp, compiled_result.best_sa, expansions)
+            )
+            for state_id, state in enumerate(mdp.states)
+        ),
+        dtype=np.int64,
+        count=mdp.n_states,
+    )
+    lifted_values = evaluate_policy(mdp, lifted_best_sa)
+    initial_id = mdp.initial_state
+    optimal_value = float(result.values[initial_id])
+    policy_value = float(lifted_values[initial_id])
+    loss = optimal_value - policy_value
+    return {
+        "optimal_value": optimal_value,
+        "compiled_value": float(compiled_result.values[compiled_mdp.initial_state]),
+        "policy_value": policy_value,
+        "loss": loss,
+        "policy_matches": loss <= 2 * epsilon,
+    }
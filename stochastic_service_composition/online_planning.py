@@ -0,0 +1,194 @@
+"""
+This module implements an anytime online planner for the composition MDP.
+
+The planner runs Monte Carlo tree search with the UCT selection rule over the
+composition dynamics generated on demand by LazyCompositionMDP, hence it never
+builds the whole composition. Given the current state and a wall-clock budget,
+it returns the best next system symbol (action, service id). The search tree
+is kept between consecutive decisions: after the action is executed and the
+next state is observed, the corresponding subtree becomes the new root.
+"""
+import math
+import random
+import time
+from typing import Dict, Optional, Tuple
+
+from stochastic_service_composition.composition_mdp import LazyCompositionMDP
+from stochastic_service_composition.types import Action, Prob, Reward, State
+
+DEFAULT_EXPLORATION = 1.0
+DEFAULT_ROLLOUT_DEPTH = 50
+DEFAULT_MAX_DEPTH = 100
+
+
+class _ChanceNode:
+    """A node of the search tree for a state-action pair."""
+
+    def __init__(self, reward: Reward, next_states: Dict[State, Prob]):
+        """Initialize the node."""
+        self.reward = reward
+        self.next_states = next_states
+        self.visits = 0
+        self.total_return = 0.0
+        self.children: Dict[State, "_DecisionNode"] = {}
+
+    @property
+    def mean_return(self) -> float:
+        """Get the average return observed from this node."""
+        return self.total_return / self.visits if self.visits > 0 else 0.0
+
+
+class _DecisionNode:
+    """A node of the search tree for a state."""
+
+    def __init__(self, state: State):
+        """Initialize the node."""
+        self.state = state
+        self.visits = 0
+        self.children: Optional[Dict[Action, _ChanceNode]] = None
+
+
+class UCTPlanner:
+    """Monte Carlo tree search with UCT over the lazily generated composition."""
+
+    def __init__(
+        self,
+        model: LazyCompositionMDP,
+        exploration: float = DEFAULT_EXPLORATION,
+        rollout_depth: int = DEFAULT_ROLLOUT_DEPTH,
+        max_depth: int = DEFAULT_MAX_DEPTH,
+        seed: Optional[int] = None,
+    ):
+        """
+        Initialize the planner.
+
+        :param model: the lazy composition MDP.
+        :param exploration: the UCT exploration constant; the bonus is scaled
+          by the range of the returns observed so far.
+        :param rollout_depth: the number of steps of the random rollouts from the leaves.
+        :param max_depth: the maximum depth of the tree descent.
+        :param seed: the seed of the random generator.
+        """
+        self.model = model
+        self.exploration = exploration
+        self.rollout_depth = rollout_depth
+        self.max_depth = max_depth
+        self.random = random.Random(seed)
+        self.root: Optional[_DecisionNode] = None
+        self._min_return = math.inf
+        self._max_return = -math.inf
+
+    def _expand(self, node: _DecisionNode) -> Dict[Action, _ChanceNode]:
+        """Generate the children of a decision node."""
+        if node.children is None:
+            node.children = {
+                action: _ChanceNode(reward, next_states)
+                for action, (next_states, reward) in self.model.transitions(
+                    node.state
+                ).items()
+            }
+        return node.children
+
+    def _sample(self, next_states: Dict[State, Prob]) -> State:
+        """Sample a next state from a distribution."""
+        threshold = self.random.random()
+        cumulative = 0.0
+        next_state = None
+        for next_state, prob in next_states.items():
+            cumulative += prob
+            if threshold < cumulative:
+                break
+        return next_state
+
+    def _select(self, node: _DecisionNode) -> Tuple[Action, _ChanceNode]:
+        """Select the action of a decision node with the UCB1 rule."""
+        children = self._expand(node)
+        scale = (
+            self._max_return - self._min_return
+            if self._max_return > self._min_return
+            else 1.0
+        )
+        log_visits = math.log(node.visits + 1)
+        best_score, best_item = -math.inf, None
+        for action, child in children.items():
+            if child.visits == 0:
+                return action, child
+            score = child.mean_return + self.exploration * scale * math.sqrt(
+                log_visits / child.visits
+            )
+            if score > best_score:
+                best_score, best_item = score, (action, child)
+        return best_item  # type: ignore
+
+    def _rollout(self, state: State) -> float:
+        """Estimate the value of a state with a uniformly random policy."""
+        gamma = self.model.gamma
+        total, discount = 0.0, 1.0
+        for _ in range(self.rollout_depth):
+            transitions = self.model.transitions(state)
+            action = self.random.choice(list(transitions.keys()))
+            next_states, reward = transitions[action]
+            total += discount * reward
+            discount *= gamma
+            state = self._sample(next_states)
+        return total
+
+    def _simulate(self, node: _DecisionNode, depth: int) -> float:
+        """Run one simulation from a decision node, and back up its return."""
+        if depth >= self.max_depth:
+            return 0.0
+        is_leaf = node.visits == 0
+        node.visits += 1
+        if is_leaf:
+            result = self._rollout(node.state)
+        else:
+            _action, child = self._select(node)
+            next_state = self._sample(child.next_states)
+            next_node = child.children.get(next_state)
+            if next_node is None:
+                next_node = _DecisionNode(next_state)
+                child.children[next_state] = next_node
+            result = child.reward + self.model.gamma * self._simulate(next_node, depth + 1)
+            child.visits += 1
+            child.total_return += result
+        self._min_return = min(self._min_return, result)
+        self._max_return = max(self._max_return, result)
+        return result
+
+    def plan(
+        self, state: State, time_budget: float, max_iterations: Optional[int] = None
+    ) -> Action:
+        """
+        Search from a state within a wall-clock budget, and return the best action.
+
+        The tree from previous decisions is reused if its root is the given state.
+
+        :param state: the current composition state (system state, DFA state).
+        :param time_budget: the search budget, in seconds.
+        :param max_iterations: an optional bound on the number of simulations.
+        :return: the most visited action from the state.
+        """
+        if self.root is None or self.root.state != state:
+            self.root = _DecisionNode(state)
+        deadline = time.perf_counter() + time_budget
+        nb_iterations = 0
+        while time.perf_counter() < deadline and (
+            max_iterations is None or nb_iterations < max_iterations
+        ):
+            self._simulate(self.root, 0)
+            nb_iterations += 1
+        children = self._expand(self.root)
+        return max(children.items(), key=lambda item: item[1].visits)[0]
+
+    def advance(self, action: Action, next_state: State) -> None:
+        """
+        Move the root of the tree after the execution of an action.
+
+        :param action: the executed action.
+        :param next_state: the observed next state.
+        """
+        if self.root is None or self.root.children is None:
+            self.root = None
+            return
+        child = self.root.children.get(action)
+        self.root = child.children.get(next_state) if child is not None else None
@@ -0,0 +1,353 @@
+"""
+This module implements a multi-process value iteration over shared memory.
+
+The arrays of the CompactMDP (the CSR transition matrix, the rewards and the
+state-action offsets) and the value vectors are placed once in
+multiprocessing.shared_memory blocks; the worker processes attach to them
+without copying. The states are partitioned into contiguous row blocks, with
+about the same number of transitions each, and every worker backs up the
+rows of its block: a sparse matrix-vector product on its slice of the
+matrix, followed by the segmented maximum of CompactMDP.state_max. For a
+PaletteCompactMDP, the codes and the palettes are shared instead of the
+decoded probabilities and rewards, and every worker decodes its slice one
+chunk of rows at a time, as PaletteCompactMDP.q_values does.
+
+In synchronous mode (Jacobi), every sweep reads one value vector and writes
+the other, and the workers and the coordinator synchronize on a barrier at
+the start and at the end of each sweep; the result is identical to
+sparse_solvers.value_iteration. In asynchronous mode, the workers update a
+single value vector in place, so they read the values of the other blocks
+as soon as they are written; the sweeps are still separated by a barrier,
+to check the stopping criterion.
+"""
+import multiprocessing
+from multiprocessing import shared_memory
+from threading import BrokenBarrierError
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+
+from stochastic_service_composition.checkpoint import SolverCheckpoint
+from stochastic_service_composition.compact_encoding import PaletteCompactMDP, add_palette_product, chunk_bounds
+from stochastic_service_composition.compact_mdp import CompactMDP
+from stochastic_service_composition.instrumentation import ProgressReporter
+from stochastic_service_composition.sparse_solvers import DEFAULT_EPSILON, SolverResult
+
+# the indices of the control array
+_CONTROL_STOP = 0
+_CONTROL_CURRENT = 1
+
+ArraySpec = Tuple[str, Tuple[int, ...], str]
+
+
+class _SharedArrays:
+    """A set of named arrays in shared memory blocks."""
+
+    def __init__(self):
+        """Initialize an empty set."""
+        self.blocks: Dict[str, shared_memory.SharedMemory] = {}
+        self.arrays: Dict[str, np.ndarray] = {}
+        self.owner = False
+
+    @classmethod
+    def create(cls, arrays: Dict[str, np.ndarray]) -> "_SharedArrays":
+        """Copy arrays into new shared memory blocks."""
+        result = cls()
+        result.owner = True
+        for name, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            shared[...] = array
+            result.blocks[name] = block
+            result.arrays[name] = shared
+        return result
+
+    @classmethod
+    def attach(cls, specs: Dict[str, ArraySpec]) -> "_SharedArrays":
+        """Attach to the shared memory blocks of another process."""
+        result = cls()
+        for name, (block_name, shape, dtype) in specs.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            result.blocks[name] = block
+            result.arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        return result
+
+    def specs(self) -> Dict[str, ArraySpec]:
+        """Get the description of the arrays, to attach to them from another process."""
+        return {
+            name: (self.blocks[name].name, array.shape, array.dtype.str)
+            for name, array in self.arrays.items()
+        }
+
+    def close(self) -> None:
+        """Release the blocks; the owner also destroys them."""
+        self.arrays = {}
+        for block in self.blocks.values():
+            try:
+                block.close()
+            except BufferError:
+                # views are still referenced (e.g. by a traceback): the mapping is released with them
+                pass
+            if self.owner:
+                block.unlink()
+        self.blocks = {}
+
+
+def _mdp_arrays(mdp: CompactMDP) -> Dict[str, np.ndarray]:
+    """Get the arrays of the MDP to share with the workers; an encoded MDP shares its codes and palettes."""
+    if isinstance(mdp, PaletteCompactMDP):
+        return {
+            "sa_ptr": np.asarray(mdp.sa_ptr, dtype=np.int64),
+            "reward_codes": mdp.reward_codes,
+            "reward_palette": mdp.reward_palette,
+            "indptr": np.asarray(mdp.indptr),
+            "indices": np.asarray(mdp.indices),
+            "probability_codes": mdp.probability_codes,
+            "probability_palette": mdp.probability_palette,
+        }
+    transitions = mdp.transitions
+    return {
+        "sa_ptr": np.asarray(mdp.sa_ptr, dtype=np.int64),
+        "rewards": np.asarray(mdp.rewards),
+        "indptr": np.asarray(transitions.indptr),
+        "indices": np.asarray(transitions.indices),
+        "data": np.asarray(transitions.data),
+    }
+
+
+def partition_states(mdp: CompactMDP, nb_blocks: int) -> np.ndarray:
+    """
+    Partition the states into contiguous blocks with about the same number of transitions.
+
+    :param mdp: the compact MDP.
+    :param nb_blocks: the number of blocks.
+    :return: the bounds of the blocks, of length nb_blocks + 1: block i is
+      the states bounds[i], ..., bounds[i+1] - 1.
+    """
+    indptr = mdp.indptr if isinstance(mdp, PaletteCompactMDP) else mdp.transitions.indptr
+    transitions_before = np.asarray(indptr)[mdp.sa_ptr]
+    targets = np.linspace(0, transitions_before[-1], nb_blocks + 1)
+    bounds = np.searchsorted(transitions_before, targets)
+    bounds[0], bounds[-1] = 0, mdp.n_states
+    return np.maximum.accumulate(bounds)
+
+
+class _Block:
+    """The rows of a block of states, as views of the shared arrays."""
+
+    def __init__(
+        self, arrays: Dict[str, np.ndarray], start: int, stop: int, gamma: float, chunk_size: Optional[int] = None
+    ):
+        """Initialize the views; only the row offsets of the block are copied."""
+        sa_ptr = arrays["sa_ptr"]
+        sa_start, sa_stop = int(sa_ptr[start]), int(sa_ptr[stop])
+        indptr = arrays["indptr"]
+        indices = arrays["indices"]
+        nz_start, nz_stop = int(indptr[sa_start]), int(indptr[sa_stop])
+        # the same index dtype as the indices, so that scipy does not copy them
+        local_indptr = (indptr[sa_start : sa_stop + 1] - nz_start).astype(indices.dtype)
+        self.n_states = len(sa_ptr) - 1
+        if "probability_codes" in arrays:
+            # the encoded MDP: the probabilities are decoded chunk by chunk, at every backup
+            self.transitions = None
+            self.indices, self.indptr = indices[nz_start:nz_stop], local_indptr
+            self.probability_codes = arrays["probability_codes"][nz_start:nz_stop]
+            self.probability_palette = arrays["probability_palette"]
+            self.reward_codes = arrays["reward_codes"][sa_start:sa_stop]
+            self.reward_palette = arrays["reward_palette"]
+            self.chunk_bounds = chunk_bounds(local_indptr, chunk_size)
+        else:
+            self.transitions = sp.csr_matrix(
+                (arrays["data"][nz_start:nz_stop], indices[nz_start:nz_stop], local_indptr),
+                shape=(sa_stop - sa_start, self.n_states),
+                copy=False,
+            )
+            self.rewards = arrays["rewards"][sa_start:sa_stop]
+        self.starts = (sa_ptr[start:stop] - sa_start).astype(np.int64)
+        self.sa_state = np.repeat(np.arange(stop - start), np.diff(sa_ptr[start : stop + 1]))
+        self.sa_start = sa_start
+        self.start, self.stop = start, stop
+        self.gamma = gamma
+
+    def q_values(self, values: np.ndarray) -> np.ndarray:
+        """Compute the Q-value of every state-action pair of the block."""
+        if self.transitions is not None:
+            return self.rewards + self.gamma * (self.transitions @ values)
+        q_values = self.reward_palette[self.reward_codes]
+        add_palette_product(
+            q_values,
+            self.gamma,
+            self.probability_codes,
+            self.probability_palette,
+            self.indices,
+            self.indptr,
+            self.chunk_bounds,
+            self.n_states,
+            values,
+        )
+        return q_values
+
+    def backup(self, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Compute the new values and the greedy state-action pairs of the block."""
+        if self.stop == self.start:
+            return np.empty(0), np.empty(0, dtype=np.int64)
+        q_values = self.q_values(values)
+        block_values = np.maximum.reduceat(q_values, self.starts)
+        is_max = q_values == block_values[self.sa_state]
+        candidates = np.where(is_max, np.arange(len(q_values)), len(q_values))
+        best_sa = np.minimum.reduceat(candidates, self.starts) + self.sa_start
+        return block_values, best_sa
+
+
+def _sweep_block(
+    arrays: Dict[str, np.ndarray],
+    worker_index: int,
+    start: int,
+    stop: int,
+    gamma: float,
+    synchronous: bool,
+    chunk_size: Optional[int],
+    barrier: Any,
+) -> None:
+    """Back up a block of states at every sweep, until the coordinator stops."""
+    block = _Block(arrays, start, stop, gamma, chunk_size)
+    control, residuals, best_sa = arrays["control"], arrays["residuals"], arrays["best_sa"]
+    while True:
+        barrier.wait()
+        if control[_CONTROL_STOP]:
+            return
+        current = int(control[_CONTROL_CURRENT])
+        values = arrays["values_0"] if current == 0 or not synchronous else arrays["values_1"]
+        target = arrays["values_1"] if current == 0 and synchronous else arrays["values_0"]
+        new_block_values, best_sa[start:stop] = block.backup(values)
+        residuals[worker_index] = (
+            np.max(np.abs(new_block_values - values[start:stop])) if stop > start else 0.0
+        )
+        target[start:stop] = new_block_values
+        barrier.wait()
+
+
+def _worker(specs: Dict[str, ArraySpec], barrier: Any, *args: Any) -> None:
+    """Attach to the shared arrays, and sweep a block of states."""
+    shared = _SharedArrays.attach(specs)
+    try:
+        _sweep_block(shared.arrays, *args, barrier=barrier)
+    except BaseException:
+        barrier.abort()
+        raise
+    finally:
+        shared.close()
+
+
+def _coordinate(
+    arrays: Dict[str, np.ndarray],
+    barrier: Any,
+    iterations: int,
+    epsilon: float,
+    max_iterations: Optional[int],
+    synchronous: bool,
+    progress: Optional[ProgressReporter],
+    checkpoint: Optional[SolverCheckpoint],
+) -> SolverResult:
+    """Run the sweeps of the workers, and check the stopping criterion after each of them."""
+    control = arrays["control"]
+    while True:
+        # the workers back up their blocks between the two barriers
+        barrier.wait()
+        barrier.wait()
+        iterations += 1
+        residual = float(arrays["residuals"].max())
+        if synchronous:
+            control[_CONTROL_CURRENT] = 1 - control[_CONTROL_CURRENT]
+        values = arrays["values_1"] if control[_CONTROL_CURRENT] == 1 else arrays["values_0"]
+        done = residual < epsilon or (max_iterations is not None and iterations >= max_iterations)
+        if checkpoint is not None:
+            checkpoint.maybe_save(iterations, values=values)
+        if progress is not None:
+            progress.sweep(iterations, residual, force=done)
+        if done:
+            control[_CONTROL_STOP] = 1
+            barrier.wait()
+            return SolverResult(values.copy(), arrays["best_sa"].copy(), iterations)
+
+
+def parallel_value_iteration(
+    mdp: CompactMDP,
+    epsilon: float = DEFAULT_EPSILON,
+    max_iterations: Optional[int] = None,
+    nb_workers: Optional[int] = None,
+    synchronous: bool = True,
+    progress: Optional[ProgressReporter] = None,
+    checkpoint: Optional[SolverCheckpoint] = None,
+) -> SolverResult:
+    """
+    Run value iteration over worker processes sharing the MDP in memory.
+
+    :param mdp: the compact MDP.
+    :param epsilon: the tolerance on the successive-iterate difference.
+    :param max_iterations: the maximum number of sweeps (default: unbounded).
+    :param nb_workers: the number of worker processes (default: the number of CPUs).
+    :param synchronous: if True, Jacobi sweeps, as in value_iteration; otherwise,
+      the blocks are updated in place, and read by the other workers as soon as written.
+    :param progress: an optional progress reporter, notified of every sweep.
+    :param checkpoint: an optional checkpoint of the iterates; if it already
+      exists, the iterations resume from it.
+    :return: the result.
+    """
+    if nb_workers is None:
+        nb_workers = multiprocessing.cpu_count()
+    values = np.zeros(mdp.n_states, dtype=mdp.value_dtype)
+    iterations = 0
+    restored = (
+        checkpoint.restore(mdp.n_states, "parallel_value_iteration", mdp.fingerprint(), epsilon=epsilon)
+        if checkpoint is not None
+        else None
+    )
+    if restored is not None:
+        iterations, restored_arrays = restored
+        values = restored_arrays["values"]
+    shared = _SharedArrays.create(
+        {
+            **_mdp_arrays(mdp),
+            "values_0": values,
+            "values_1": values,
+            "best_sa": np.zeros(mdp.n_states, dtype=np.int64),
+            "residuals": np.zeros(nb_workers),
+            "control": np.zeros(2, dtype=np.int64),
+        }
+    )
+    bounds = partition_states(mdp, nb_workers)
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(nb_workers + 1)
+    processes = [
+        context.Process(
+            target=_worker,
+            args=(
+                shared.specs(),
+                barrier,
+                worker_index,
+                int(bounds[worker_index]),
+                int(bounds[worker_index + 1]),
+                mdp.gamma,
+                synchronous,
+                mdp.chunk_size if isinstance(mdp, PaletteCompactMDP) else None,
+            ),
+        )
+        for worker_index in range(nb_workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        return _coordinate(
+            shared.arrays, barrier, iterations, epsilon, max_iterations, synchronous, progress, checkpoint
+        )
+    except BrokenBarrierError as e:
+        raise RuntimeError("a worker of the parallel value iteration failed") from e
+    except BaseException:
+        barrier.abort()
+        raise
+    finally:
+        for process in processes:
+            process.join()
+        shared.close()
@@ -0,0 +1,219 @@
+"""
+This module implements a parametric template of the composition MDP.
+
+The structure of the composition MDP (its states, actions and the support of
+the transitions) depends on the services only through their states, actions
+and the support of their transitions; the probabilities and the rewards are
+the ones of the service transitions that generated them. Hence, the template
+stores, for every transition of the composition, the index of the service
+probability it comes from (service id, local state, action, local next
+state), and for every state-action pair the index of the service reward
+(service id, local state, action), plus the goal reward of the DFA.
+
+A new set of service parameters, e.g. a different broken probability or
+cost, is then turned into a CompactMDP with one vectorized gather per array,
+without building the system service or the composition again:
+
+    template = parametric_comp_mdp(dfa, services)
+    for scenario_services in scenarios:
+        result = value_iteration(template.instantiate(scenario_services))
+
+The new services must have the same states, actions and transition supports
+(a probability may become zero, but not become positive); otherwise, the
+composition must be computed again.
+"""
+from typing import Any, List, Sequence, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+from pythomata import SimpleDFA
+
+from stochastic_service_composition.compact_mdp import CompactMDP
+from stochastic_service_composition.composition_mdp import (
+    COMPOSITION_MDP_UNDEFINED_ACTION,
+    DEFAULT_GAMMA,
+    comp_mdp,
+)
+from stochastic_service_composition.services import Service
+
+# the parameters of the transitions that do not come from a service (to the sink state)
+CONSTANT_PROBABILITY_PARAMETER = 0
+CONSTANT_REWARD_PARAMETER = 0
+
+RewardKey = Tuple[int, Any, Any]
+ProbabilityKey = Tuple[int, Any, Any, Any]
+
+
+def _parameter_keys(services: Sequence[Service]) -> Tuple[List[RewardKey], List[ProbabilityKey]]:
+    """Enumerate the reward and probability parameters of the services, after the constant ones."""
+    reward_keys: List[RewardKey] = [None]  # type: ignore
+    probability_keys: List[ProbabilityKey] = [None]  # type: ignore
+    for service_id, service in enumerate(services):
+        for state, transitions_by_action in service.transition_function.items():
+            for action, (next_states, _reward) in transitions_by_action.items():
+                reward_keys.append((service_id, state, action))
+                for next_state in next_states.keys():
+                    probability_keys.append((service_id, state, action, next_state))
+    return reward_keys, probability_keys
+
+
+class ParametricMDP:
+    """The structure of a composition MDP, with references to the service parameters instead of numbers."""
+
+    def __init__(
+        self,
+        mdp: CompactMDP,
+        reward_parameter: np.ndarray,
+        reward_offset: np.ndarray,
+        probability_parameter: np.ndarray,
+        reward_keys: List[RewardKey],
+        probability_keys: List[ProbabilityKey],
+    ):
+        """
+        Initialize the template.
+
+        :param mdp: the compact MDP the structure is taken from.
+        :param reward_parameter: the index of the service reward of each state-action pair.
+        :param reward_offset: the reward of each state-action pair that does not
+          depend on the services (the goal reward).
+        :param probability_parameter: the index of the service probability of each transition.
+        :param reward_keys: the (service id, state, action) of each reward parameter.
+        :param probability_keys: the (service id, state, action, next state) of each probability parameter.
+        """
+        self.states = mdp.states
+        self.actions = mdp.actions
+        self.sa_ptr = mdp.sa_ptr
+        self.sa_action = mdp.sa_action
+        self.indices = mdp.transitions.indices
+        self.indptr = mdp.transitions.indptr
+        self.shape = mdp.transitions.shape
+        self.gamma = mdp.gamma
+        self.initial_state = mdp.initial_state
+        self.reward_parameter = reward_parameter
+        self.reward_offset = reward_offset
+        self.probability_parameter = probability_parameter
+        self.reward_keys = reward_keys
+        self.probability_keys = probability_keys
+        self.reward_index = {key: index for index, key in enumerate(reward_keys)}
+        self.probability_index = {key: index for index, key in enumerate(probability_keys)}
+
+    @classmethod
+    def from_compact_mdp(cls, mdp: CompactMDP, dfa: SimpleDFA, services: Sequence[Service]) -> "ParametricMDP":
+        """
+        Build the template of a composition MDP.
+
+        :param mdp: the compact form of the composition MDP computed by comp_mdp.
+        :param dfa: the target DFA it was computed from.
+        :param services: the community of services it was computed from.
+        :return: the template.
+        """
+        dfa = dfa.trim()
+        reward_keys, probability_keys = _parameter_keys(services)
+        reward_index = {key: index for index, key in enumerate(reward_keys)}
+        probability_index = {key: index for index, key in enumerate(probability_keys)}
+        reward_parameter = np.zeros(mdp.n_state_actions, dtype=np.int64)
+        reward_offset = np.zeros(mdp.n_state_actions)
+        probability_parameter = np.zeros(mdp.n_transitions, dtype=np.int64)
+        indices, indptr = mdp.transitions.indices, mdp.transitions.indptr
+        for state_id, state in enumerate(mdp.states):
+            for sa in range(mdp.sa_ptr[state_id], mdp.sa_ptr[state_id + 1]):
+                action = mdp.actions[mdp.sa_action[sa]]
+                if action == COMPOSITION_MDP_UNDEFINED_ACTION:
+                    reward_parameter[sa] = CONSTANT_REWARD_PARAMETER
+                    probability_parameter[indptr[sa] : indptr[sa + 1]] = CONSTANT_PROBABILITY_PARAMETER
+                    continue
+                symbol, service_id = action
+                system_state, _dfa_state = state
+                local_state = system_state[service_id]
+                reward_parameter[sa] = reward_index[(service_id, local_state, symbol)]
+                for position in range(indptr[sa], indptr[sa + 1]):
+                    next_system_state, next_dfa_state = mdp.states[indices[position]]
+                    probability_parameter[position] = probability_index[
+                        (service_id, local_state, symbol, next_system_state[service_id])
+                    ]
+                # the goal reward, as in comp_mdp
+                if symbol in dfa.alphabet and dfa.is_accepting(next_dfa_state):
+                    reward_offset[sa] = 1.0
+        return cls(mdp, reward_parameter, reward_offset, probability_parameter, reward_keys, probability_keys)
+
+    def parameters(self, services: Sequence[Service]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Extract the parameter vectors of a set of services.
+
+        :param services: the services, with the same structure as the ones of the template.
+        :return: the probability and the reward parameter vectors.
+        """
+        probabilities = np.zeros(len(self.probability_keys))
+        rewards = np.zeros(len(self.reward_keys))
+        probabilities[CONSTANT_PROBABILITY_PARAMETER] = 1.0
+        rewards[CONSTANT_REWARD_PARAMETER] = 0.0
+        nb_rewards = 1
+        for service_id, service in enumerate(services):
+            for state, transitions_by_action in service.transition_function.items():
+                for action, (next_states, reward) in transitions_by_action.items():
+                    reward_key = (service_id, state, action)
+                    if reward_key not in self.reward_index:
+                        raise ValueError(f"transition {reward_key} not in the template; recompose the MDP")
+                    rewards[self.reward_index[reward_key]] = reward
+                    nb_rewards += 1
+                    for next_state, prob in next_states.items():
+                        probability_key = (service_id, state, action, next_state)
+                        if probability_key not in self.probability_index:
+                            if prob == 0.0:
+                                continue
+                            raise ValueError(
+                                f"transition {probability_key} not in the template; recompose the MDP"
+                            )
+                        probabilities[self.probability_index[probability_key]] = prob
+        if nb_rewards != len(self.reward_keys):
+            raise ValueError("some transitions of the template are missing from the services; recompose the MDP")
+        return probabilities, rewards
+
+    def instantiate_parameters(self, probabilities: np.ndarray, rewards: np.ndarray) -> CompactMDP:
+        """
+        Instantiate the template with parameter vectors.
+
+        :param probabilities: the probability parameter vector (see parameters).
+        :param rewards: the reward parameter vector (see parameters).
+        :return: the compact MDP; the states and the structure are shared with the template.
+        """
+        transitions = sp.csr_matrix(
+            (probabilities[self.probability_parameter], self.indices, self.indptr),
+            shape=self.shape,
+            copy=False,
+        )
+        return CompactMDP(
+            self.states,
+            self.actions,
+            self.sa_ptr,
+            self.sa_action,
+            self.reward_offset + rewards[self.reward_parameter],
+            transitions,
+            self.gamma,
+            self.initial_state,
+        )
+
+    def instantiate(self, services: Sequence[Service]) -> CompactMDP:
+        """
+        Instantiate the template with the parameters of a set of services.
+
+        :param services: the services, with the same structure as the ones of the template.
+        :return: the compact MDP.
+        """
+        return self.instantiate_parameters(*self.parameters(services))
+
+
+def parametric_comp_mdp(
+    dfa: SimpleDFA, services: Sequence[Service], gamma: float = DEFAULT_GAMMA, **kwargs: Any
+) -> ParametricMDP:
+    """
+    Compute the composition MDP, and return it as a parametric template.
+
+    :param dfa: the target DFA.
+    :param services: the community of services.
+    :param gamma: the discount factor.
+    :param kwargs: the other arguments of comp_mdp.
+    :return: the template.
+    """
+    mdp = CompactMDP.from_mdp(comp_mdp(dfa, services, gamma=gamma, **kwargs))  # type: ignore
+    return ParametricMDP.from_compact_mdp(mdp, dfa, services)
@@ -0,0 +1,363 @@
+"""
+This module implements the pipelined construction and solution of the composition MDP.
+
+The composition is explored depth-first, with an iterative version of
+Tarjan's algorithm over LazyCompositionMDP. Tarjan's algorithm closes the
+strongly connected components (SCCs) in reverse topological order: when an
+SCC is closed, all the successors of its states are either in the SCC, or in
+an SCC closed before. Hence, the values of its states only depend on values
+that are already known, and the SCC can be solved right away.
+
+The builder assigns the state ids in the order the SCCs are closed, encodes
+the transitions of the SCCs in the layout of CompactMDP, and sends them in
+batches to a solver process, that runs value iteration on each SCC in turn
+(topological value iteration), while the exploration goes on. The
+successors outside of an SCC contribute a constant to the Q-values of its
+state-action pairs, computed once; an SCC of one state without a self-loop
+is solved by a single backup. The end-to-end time approaches the maximum of
+the construction and solution times, instead of their sum.
+"""
+import multiprocessing
+import queue as queue_module
+import sys
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+from pythomata import SimpleDFA
+
+from stochastic_service_composition.compact_mdp import CompactMDP
+from stochastic_service_composition.composition_mdp import DEFAULT_GAMMA, LazyCompositionMDP
+from stochastic_service_composition.instrumentation import ProgressReporter
+from stochastic_service_composition.services import Service
+from stochastic_service_composition.sparse_solvers import DEFAULT_EPSILON, SolverResult
+from stochastic_service_composition.types import Action, State
+
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_QUEUE_SIZE = 16
+# the time between two checks that the solver process is alive, in seconds
+_POLL_INTERVAL = 1.0
+
+
+class _ComponentBatch:
+    """A batch of closed SCCs, in the layout of CompactMDP, with global state ids."""
+
+    def __init__(self, first_state: int, first_sa: int):
+        """Initialize an empty batch."""
+        self.first_state = first_state
+        self.first_sa = first_sa
+        self.states: List[State] = []
+        self.scc_ptr = [0]
+        self.sa_ptr = [0]
+        self.sa_action: List[int] = []
+        self.rewards: List[float] = []
+        self.indptr = [0]
+        self.indices: List[int] = []
+        self.data: List[float] = []
+
+    def arrays(self) -> Tuple[Any, ...]:
+        """Get the message for the solver process."""
+        return (
+            self.first_state,
+            np.asarray(self.scc_ptr, dtype=np.int64),
+            np.asarray(self.sa_ptr, dtype=np.int64),
+            np.asarray(self.rewards, dtype=np.float64),
+            np.asarray(self.indptr, dtype=np.int64),
+            np.asarray(self.indices, dtype=np.int64),
+            np.asarray(self.data, dtype=np.float64),
+        )
+
+
+def _put(queue: Any, message: Any, solver: Any) -> None:
+    """Send a message to the solver process, failing if it has died."""
+    while True:
+        try:
+            queue.put(message, timeout=_POLL_INTERVAL)
+            return
+        except queue_module.Full:
+            if not solver.is_alive():
+                raise RuntimeError("the solver process of the pipelined composition failed")
+
+
+def _get(queue: Any, solver: Any) -> Any:
+    """Receive a message from the solver process, failing if it has died."""
+    while True:
+        try:
+            return queue.get(timeout=_POLL_INTERVAL)
+        except queue_module.Empty:
+            if not solver.is_alive():
+                raise RuntimeError("the solver process of the pipelined composition failed")
+
+
+def _solve_component(
+    values: np.ndarray,
+    first_state: int,
+    stop_state: int,
+    sa_ptr: np.ndarray,
+    rewards: np.ndarray,
+    transitions: sp.csr_matrix,
+    gamma: float,
+    epsilon: float,
+) -> Tuple[np.ndarray, int]:
+    """
+    Run value iteration on an SCC, given the values of the SCCs closed before.
+
+    :return: the greedy state-action pairs (relative to the SCC), and the number of sweeps.
+    """
+    columns = transitions.indices
+    internal = columns >= first_state
+    rows = np.repeat(np.arange(transitions.shape[0]), np.diff(transitions.indptr))
+    n_states = stop_state - first_state
+    external_q = rewards + gamma * np.bincount(
+        rows[~internal],
+        weights=transitions.data[~internal] * values[columns[~internal]],
+        minlength=len(rewards),
+    )
+    starts = sa_ptr[:-1]
+    sa_state = np.repeat(np.arange(n_states), np.diff(sa_ptr))
+    internal_transitions = sp.csr_matrix(
+        (transitions.data[internal], (rows[internal], columns[internal] - first_state)),
+        shape=(len(rewards), n_states),
+    )
+    component_values = values[first_state:stop_state]
+    sweeps = 0
+    while True:
+        q_values = external_q + gamma * (internal_transitions @ component_values)
+        new_values = np.maximum.reduceat(q_values, starts)
+        sweeps += 1
+        residual = np.max(np.abs(new_values - component_values))
+        component_values = new_values
+        if internal_transitions.nnz == 0 or residual < epsilon:
+            break
+    values[first_state:stop_state] = component_values
+    is_max = q_values == component_values[sa_state]
+    candidates = np.where(is_max, np.arange(len(q_values)), len(q_values))
+    return np.minimum.reduceat(candidates, starts), sweeps
+
+
+def _solver_process(queue: Any, result_queue: Any, gamma: float, epsilon: float) -> None:
+    """Solve the SCCs received from the builder, until the end-of-stream marker."""
+    values = np.zeros(1024)
+    best_sa = np.zeros(1024, dtype=np.int64)
+    nb_state_actions = 0
+    n_states = 0
+    sweeps = 0
+    while True:
+        message = queue.get()
+        if message is None:
+            break
+        first_state, scc_ptr, sa_ptr, rewards, indptr, indices, data = message
+        stop_state = first_state + len(sa_ptr) - 1
+        if stop_state > len(values):
+            capacity = max(2 * len(values), stop_state)
+            values = np.concatenate([values, np.zeros(capacity - len(values))])
+            best_sa = np.concatenate([best_sa, np.zeros(capacity - len(best_sa), dtype=np.int64)])
+        for scc_start, scc_stop in zip(scc_ptr[:-1], scc_ptr[1:]):
+            sa_start, sa_stop = sa_ptr[scc_start], sa_ptr[scc_stop]
+            transitions = sp.csr_matrix(
+                (
+                    data[indptr[sa_start] : indptr[sa_stop]],
+                    indices[indptr[sa_start] : indptr[sa_stop]],
+                    indptr[sa_start : sa_stop + 1] - indptr[sa_start],
+                ),
+                shape=(sa_stop - sa_start, first_state + scc_stop),
+            )
+            component_best_sa, component_sweeps = _solve_component(
+                values,
+                first_state + scc_start,
+                first_state + scc_stop,
+                sa_ptr[scc_start : scc_stop + 1] - sa_start,
+                rewards[sa_start:sa_stop],
+                transitions,
+                gamma,
+                epsilon,
+            )
+            best_sa[first_state + scc_start : first_state + scc_stop] = (
+                component_best_sa + nb_state_actions + sa_start
+            )
+            sweeps += component_sweeps
+        nb_state_actions += sa_ptr[-1]
+        n_states = stop_state
+    result_queue.put((values[:n_states].copy(), best_sa[:n_states].copy(), sweeps))
+
+
+class _TarjanBuilder:
+    """Explore the composition with Tarjan's algorithm, and send the closed SCCs to the solver."""
+
+    def __init__(
+        self,
+        model: LazyCompositionMDP,
+        queue: Any,
+        solver: Any,
+        batch_size: int,
+        progress: Optional[ProgressReporter],
+    ):
+        """Initialize the builder."""
+        self.model = model
+        self.queue = queue
+        self.solver = solver
+        self.batch_size = batch_size
+        self.progress = progress
+        # the DFS index and the lowlink of the states on the stack
+        self.index: Dict[State, int] = {}
+        self.lowlink: Dict[State, int] = {}
+        self.transitions: Dict[State, Dict[Action, Tuple[Dict[State, float], float]]] = {}
+        self.stack: List[State] = []
+        self.counter = 0
+        # the global id of the states of the closed SCCs
+        self.state_id: Dict[State, int] = {}
+        self.action_index: Dict[Action, int] = {}
+        self.nb_state_actions = 0
+        self.nb_transitions = 0
+        self.sent: List[_ComponentBatch] = []
+        self.batch = _ComponentBatch(0, 0)
+
+    def _visit(self, state: State) -> Iterator[State]:
+        """Push a state on the stack, and get an iterator over its successors."""
+        self.index[state] = self.lowlink[state] = self.counter
+        self.counter += 1
+        self.stack.append(state)
+        transitions = self.model.transitions(state)
+        self.transitions[state] = transitions
+        self.nb_transitions += sum(len(next_states) for next_states, _ in transitions.values())
+        if self.progress is not None:
+            self.progress.expanded(self.counter, len(self.stack), self.nb_transitions)
+        return iter({next_state: None for next_states, _ in transitions.values() for next_state in next_states})
+
+    def explore(self, root: State) -> None:
+        """Explore the states reachable from a root, closing their SCCs."""
+        if root in self.index or root in self.state_id:
+            return
+        work = [(root, self._visit(root))]
+        while len(work) > 0:
+            state, successors = work[-1]
+            for next_state in successors:
+                if next_state in self.state_id:
+                    # in an SCC closed before
+                    continue
+                if next_state not in self.index:
+                    work.append((next_state, self._visit(next_state)))
+                    break
+                self.lowlink[state] = min(self.lowlink[state], self.index[next_state])
+            else:
+                work.pop()
+                if len(work) > 0:
+                    parent = work[-1][0]
+                    self.lowlink[parent] = min(self.lowlink[parent], self.lowlink[state])
+                if self.lowlink[state] == self.index[state]:
+                    self._close(state)
+
+    def _close(self, root: State) -> None:
+        """Pop the SCC of a root from the stack, and add it to the batch."""
+        position = len(self.stack) - 1
+        while self.stack[position] != root:
+            position -= 1
+        component = self.stack[position:]
+        del self.stack[position:]
+        for state in component:
+            self.state_id[state] = len(self.state_id)
+            del self.index[state]
+            del self.lowlink[state]
+        batch = self.batch
+        for state in component:
+            batch.states.append(state)
+            for action, (next_states, reward) in self.transitions.pop(state).items():
+                batch.sa_action.append(self.action_index.setdefault(action, len(self.action_index)))
+                batch.rewards.append(reward)
+                for next_state, prob in next_states.items():
+                    batch.indices.append(self.state_id[next_state])
+                    batch.data.append(prob)
+                batch.indptr.append(len(batch.indices))
+            batch.sa_ptr.append(len(batch.sa_action))
+        batch.scc_ptr.append(len(batch.states))
+        if len(batch.states) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Send the batch to the solver."""
+        batch = self.batch
+        if len(batch.states) == 0:
+            return
+        _put(self.queue, batch.arrays(), self.solver)
+        self.sent.append(batch)
+        self.nb_state_actions += len(batch.sa_action)
+        self.batch = _ComponentBatch(len(self.state_id), self.nb_state_actions)
+
+    def compact_mdp(self, gamma: float, initial_state: State) -> CompactMDP:
+        """Assemble the CompactMDP of the sent batches."""
+        states = [state for batch in self.sent for state in batch.states]
+        sa_ptr = [0]
+        indptr = [0]
+        for batch in self.sent:
+            sa_ptr.extend(np.asarray(batch.sa_ptr[1:]) + batch.first_sa)
+            indptr.extend(np.asarray(batch.indptr[1:]) + indptr[-1])
+        transitions = sp.csr_matrix(
+            (
+                np.concatenate([np.asarray(batch.data, dtype=np.float64) for batch in self.sent]),
+                np.concatenate([np.asarray(batch.indices, dtype=np.int64) for batch in self.sent]),
+                np.asarray(indptr, dtype=np.int64),
+            ),
+            shape=(self.nb_state_actions, len(states)),
+        )
+        return CompactMDP(
+            states,
+            list(self.action_index.keys()),
+            np.asarray(sa_ptr, dtype=np.int64),
+            np.concatenate([np.asarray(batch.sa_action, dtype=np.int64) for batch in self.sent]),
+            np.concatenate([np.asarray(batch.rewards, dtype=np.float64) for batch in self.sent]),
+            transitions,
+            gamma,
+            self.state_id[initial_state],
+        )
+
+
+def pipelined_comp_mdp(
+    dfa: SimpleDFA,
+    services: Sequence[Service],
+    gamma: float = DEFAULT_GAMMA,
+    epsilon: float = DEFAULT_EPSILON,
+    kronecker: bool = False,
+    partial_order_reduction: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    progress: Optional[ProgressReporter] = None,
+) -> Tuple[CompactMDP, SolverResult]:
+    """
+    Compute the composition MDP of comp_mdp, and solve it while it is being built.
+
+    :param dfa: the target DFA.
+    :param services: the community of services.
+    :param gamma: the discount factor.
+    :param epsilon: the tolerance on the successive-iterate difference, within each SCC.
+    :param kronecker: see LazyCompositionMDP.
+    :param partial_order_reduction: see comp_mdp.
+    :param batch_size: the minimum number of states sent to the solver at once.
+    :param queue_size: the maximum number of batches waiting for the solver;
+      when reached, the construction waits for the solver.
+    :param progress: an optional progress reporter, notified of every expanded state.
+    :return: the compact MDP (the state ids follow the order in which the SCCs
+      were closed), and the result of the solver; its iterations are the total
+      number of sweeps over the SCCs.
+    """
+    model = LazyCompositionMDP(
+        dfa, services, gamma=gamma, kronecker=kronecker, partial_order_reduction=partial_order_reduction
+    )
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue(maxsize=queue_size)
+    result_queue = context.Queue()
+    solver = context.Process(target=_solver_process, args=(queue, result_queue, gamma, epsilon))
+    solver.start()
+    try:
+        builder = _TarjanBuilder(model, queue, solver, batch_size, progress)
+        for seed_state in model.seed_states():
+            builder.explore(seed_state)
+        builder.flush()
+        _put(queue, None, solver)
+        if progress is not None:
+            progress.expanded(builder.counter, 0, builder.nb_transitions, force=True)
+        values, best_sa, sweeps = _get(result_queue, solver)
+    finally:
+        if solver.is_alive() and sys.exc_info()[0] is not None:
+            solver.terminate()
+        solver.join()
+    return builder.compact_mdp(gamma, model.initial_state), SolverResult(values, best_sa, sweeps)
@@ -0,0 +1,266 @@
+"""
+This module implements a compact table form of a deterministic composition policy.
+
+The policy stores one small integer action code per state of the
+composition MDP, in a NumPy array indexed by a dense state id, together
+with the table of the actions, i.e. of the (symbol, service id) pairs, and
+the sorted key of every state (see below). The dense ids range over the
+states of the policy (e.g. the reachable states of the composition), not
+over the product of the service and DFA states; hence, the footprint of the
+table is 5 to 10 bytes per reachable state: a one- or two-byte action code,
+plus a 4-byte key (8-byte, if the product space does not fit in 32 bits).
+
+To look up a raw composition state (system state, DFA state), the state is
+encoded as an integer key, in a mixed-radix fashion as in KroneckerSystem,
+combined with the index of the DFA state; the dense id of a state is the
+rank of its key among the sorted keys of the states of the policy, found by
+binary search.
+"""
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from mdp_dp_rl.processes.det_policy import DetPolicy
+from pythomata import SimpleDFA
+
+from stochastic_service_composition.compact_mdp import CompactMDP
+from stochastic_service_composition.composition_mdp import COMPOSITION_MDP_SINK_STATE
+from stochastic_service_composition.services import Service
+from stochastic_service_composition.types import Action, State
+
+
+def _code_dtype(nb_actions: int) -> np.dtype:
+    """Get the smallest unsigned integer type of the action codes; its maximum value is the "no action" code."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if nb_actions < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f"too many actions: {nb_actions}")
+
+
+def _key_dtype(n_keys: int) -> np.dtype:
+    """Get the smallest unsigned integer type for the keys of a product space of n_keys states."""
+    return np.dtype(np.uint32) if n_keys <= np.iinfo(np.uint32).max + 1 else np.dtype(np.uint64)
+
+
+class CompactPolicy:
+    """A deterministic composition policy, as an array of action codes indexed by dense state id."""
+
+    def __init__(
+        self,
+        local_states: Sequence[Sequence[State]],
+        dfa_states: Sequence[State],
+        actions: List[Action],
+        keys: np.ndarray,
+        codes: np.ndarray,
+        sink_code: Optional[int] = None,
+    ):
+        """
+        Initialize the policy.
+
+        :param local_states: the states of each service, in encoding order
+        :param dfa_states: the DFA states, in encoding order
+        :param actions: the actions, indexed by code
+        :param keys: the sorted keys of the states of the policy; the dense id of a state is the position of its key
+        :param codes: the action code of each dense state id; the maximum value
+          of the dtype means that the policy is not defined in that state
+        :param sink_code: the action code of the sink state, if defined
+        """
+        self.local_states = [list(states) for states in local_states]
+        self.dfa_states = list(dfa_states)
+        self.actions = actions
+        self.keys = keys
+        self.codes = codes
+        self.sink_code = sink_code
+        self.no_action = np.iinfo(codes.dtype).max
+        self.local_index: List[Dict[State, int]] = [
+            {state: index for index, state in enumerate(states)}
+            for states in self.local_states
+        ]
+        self.dfa_index: Dict[State, int] = {
+            state: index for index, state in enumerate(self.dfa_states)
+        }
+        self.action_index: Dict[Action, int] = {
+            action: code for code, action in enumerate(actions)
+        }
+        # mixed-radix strides of (service 0, ..., service n-1, DFA)
+        shape = [len(states) for states in self.local_states] + [len(self.dfa_states)]
+        self.strides: Tuple[int, ...] = tuple(
+            int(np.prod(shape[i + 1 :], dtype=np.int64)) for i in range(len(shape))
+        )
+        self.n_keys = int(np.prod(shape, dtype=np.int64))
+        assert len(codes) == len(keys), "one code per state"
+
+    @property
+    def n_states(self) -> int:
+        """Get the number of states of the table (the sink state excluded)."""
+        return len(self.codes)
+
+    @classmethod
+    def empty(
+        cls,
+        services: Sequence[Service],
+        dfa: SimpleDFA,
+        actions: List[Action],
+        states: Iterable[State],
+    ) -> "CompactPolicy":
+        """
+        Build a policy table over a set of states, undefined everywhere.
+
+        :param services: the community of services.
+        :param dfa: the target DFA.
+        :param actions: the actions, indexed by code.
+        :param states: the composition states of the table (e.g. the reachable ones);
+          the sink state, if any, is stored separately.
+        :return: the empty policy.
+        """
+        local_states = [sorted(service.states, key=str) for service in services]
+        dfa_states = sorted(dfa.states, key=str)
+        result = cls(
+            local_states,
+            dfa_states,
+            actions,
+            np.empty(0, dtype=np.uint64),
+            np.empty(0, dtype=_code_dtype(len(actions))),
+        )
+        keys = np.fromiter(
+            (result.encode(state) for state in states if state != COMPOSITION_MDP_SINK_STATE),
+            dtype=np.uint64,
+        )
+        result.keys = np.unique(keys).astype(_key_dtype(result.n_keys))
+        result.codes = np.full(len(result.keys), result.no_action, dtype=result.codes.dtype)
+        return result
+
+    @classmethod
+    def from_det_policy(
+        cls, policy: DetPolicy, services: Sequence[Service], dfa: SimpleDFA
+    ) -> "CompactPolicy":
+        """
+        Build the table form of a deterministic policy of the composition MDP.
+
+        :param policy: the deterministic policy (e.g. computed by DPAnalytic).
+        :param services: the community of services.
+        :param dfa: the target DFA.
+        :return: the compact policy.
+        """
+        state_actions = [
+            (state, list(action_probs)[0]) for state, action_probs in policy.policy_data.items()
+        ]
+        actions = list(dict.fromkeys(action for _state, action in state_actions))
+        result = cls.empty(services, dfa, actions, (state for state, _action in state_actions))
+        for state, action in state_actions:
+            result.set_action(state, action)
+        return result
+
+    @classmethod
+    def from_compact_mdp(
+        cls,
+        mdp: CompactMDP,
+        best_sa: np.ndarray,
+        services: Sequence[Service],
+        dfa: SimpleDFA,
+    ) -> "CompactPolicy":
+        """
+        Build the table form of the policy computed by a sparse solver, over the states of the MDP.
+
+        :param mdp: the compact form of the composition MDP.
+        :param best_sa: the chosen state-action pair of each state.
+        :param services: the community of services.
+        :param dfa: the target DFA.
+        :return: the compact policy.
+        """
+        result = cls.empty(services, dfa, list(mdp.actions), ())
+        state_codes = mdp.sa_action[best_sa]
+        keys: List[int] = []
+        codes: List[int] = []
+        for state, code in zip(mdp.states, state_codes):
+            if state == COMPOSITION_MDP_SINK_STATE:
+                result.sink_code = int(code)
+            else:
+                keys.append(result.encode(state))
+                codes.append(int(code))
+        unique_keys, positions = np.unique(np.asarray(keys, dtype=np.uint64), return_inverse=True)
+        result.keys = unique_keys.astype(_key_dtype(result.n_keys))
+        result.codes = np.full(len(unique_keys), result.no_action, dtype=result.codes.dtype)
+        result.codes[positions.reshape(-1)] = codes
+        return result
+
+    def encode(self, state: State) -> int:
+        """Encode a composition state (system state, DFA state) as an integer."""
+        system_state, dfa_state = state
+        key = self.dfa_index[dfa_state] * self.strides[-1]
+        for i, component in enumerate(system_state):
+            key += self.local_index[i][component] * self.strides[i]
+        return key
+
+    def decode(self, key: int) -> State:
+        """Decode an integer into a composition state (system state, DFA state)."""
+        system_state = tuple(
+            self.local_states[i][(key // self.strides[i]) % len(self.local_states[i])]
+            for i in range(len(self.local_states))
+        )
+        return system_state, self.dfa_states[key % len(self.dfa_states)]
+
+    def key_index(self, key: int) -> Optional[int]:
+        """Get the dense id of an encoded composition state, or None if the state is not in the table."""
+        position = int(np.searchsorted(self.keys, key))
+        if position < len(self.keys) and int(self.keys[position]) == key:
+            return position
+        return None
+
+    def index(self, state: State) -> Optional[int]:
+        """Get the dense id of a composition state, or None if the state is not in the table."""
+        system_state, dfa_state = state
+        if dfa_state not in self.dfa_index or any(
+            component not in self.local_index[i] for i, component in enumerate(system_state)
+        ):
+            return None
+        return self.key_index(self.encode(state))
+
+    def set_action(self, state: State, action: Action) -> None:
+        """Set the action of a composition state of the table."""
+        code = self.action_index[action]
+        if state == COMPOSITION_MDP_SINK_STATE:
+            self.sink_code = code
+            return
+        state_id = self.index(state)
+        if state_id is None:
+            raise ValueError(f"state {state} is not in the policy table")
+        self.codes[state_id] = code
+
+    def get_action_for_id(self, state_id: int) -> Optional[Action]:
+        """Get the action of a dense state id, or None if the policy is not defined there."""
+        code = self.codes[state_id]
+        return self.actions[code] if code != self.no_action else None
+
+    def get_action_for_state(self, state: State) -> Optional[Action]:
+        """Get the action of a composition state, or None if the policy is not defined there."""
+        if state == COMPOSITION_MDP_SINK_STATE:
+            return self.actions[self.sink_code] if self.sink_code is not None else None
+        state_id = self.index(state)
+        return self.get_action_for_id(state_id) if state_id is not None else None
+
+    def get_action_for_key(self, key: int) -> Optional[Action]:
+        """Get the action of an encoded composition state, or None if the policy is not defined there."""
+        state_id = self.key_index(key)
+        return self.get_action_for_id(state_id) if state_id is not None else None
+
+    def items(self) -> Iterator[Tuple[State, Action]]:
+        """Iterate over the (state, action) pairs where the policy is defined."""
+        for state_id in np.flatnonzero(self.codes != self.no_action):
+            yield self.decode(int(self.keys[state_id])), self.actions[self.codes[state_id]]
+        if self.sink_code is not None:
+            yield COMPOSITION_MDP_SINK_STATE, self.actions[self.sink_code]
+
+    def __len__(self) -> int:
+        """Get the number of states where the policy is defined."""
+        return int(np.count_nonzero(self.codes != self.no_action)) + (
+            1 if self.sink_code is not None else 0
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """Get the size of the code table and of the sorted keys, in bytes."""
+        return self.codes.nbytes + self.keys.nbytes
+
+    def to_det_policy(self) -> DetPolicy:
+        """Convert the policy into a DetPolicy (e.g. for print_policy_data)."""
+        return DetPolicy(dict(self.items()))
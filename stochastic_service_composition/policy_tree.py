@@ -0,0 +1,312 @@
+"""
+This module compiles a composition policy into a decision diagram.
+
+The features of a composition state (system state, DFA state) are the DFA
+state and the states of the individual services. The compiler greedily grows
+a binary decision tree, whose internal nodes test whether a feature equals a
+value (e.g. "service 3 is in state br"), choosing at each node the test that
+minimizes the Gini impurity of the chosen actions. Identical subtrees are
+shared, and tests whose branches are identical are removed, so the result is
+a reduced decision diagram. Since no two states have the same features, the
+diagram is exactly equivalent to the policy on the states it is compiled
+from, which is checked after the compilation.
+"""
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from mdp_dp_rl.processes.mdp import MDP
+
+from stochastic_service_composition.composition_mdp import COMPOSITION_MDP_SINK_STATE
+from stochastic_service_composition.runtime_artifact import policy_reachable_transitions
+from stochastic_service_composition.types import Action, State
+
+# the feature of the DFA state; feature i + 1 is the state of service i
+DFA_FEATURE = 0
+LEAF = -1
+
+
+def state_features(state: State) -> Tuple:
+    """Get the features of a composition state: the DFA state, then the state of each service."""
+    system_state, dfa_state = state
+    return (dfa_state,) + tuple(system_state)
+
+
+class PolicyDiagram:
+    """A policy in the form of a reduced binary decision diagram over the state features."""
+
+    def __init__(
+        self,
+        feature: List[int],
+        value: List[Any],
+        true_child: List[int],
+        false_child: List[int],
+        action: List[Optional[Action]],
+        root: int,
+        sink_action: Optional[Action] = None,
+    ):
+        """
+        Initialize the diagram.
+
+        :param feature: the tested feature of each node (LEAF for the leaves)
+        :param value: the tested value of each node
+        :param true_child: the node to go to if the feature equals the value
+        :param false_child: the node to go to otherwise
+        :param action: the action of each leaf
+        :param root: the root node
+        :param sink_action: the action of the sink state, if defined
+        """
+        self.feature = feature
+        self.value = value
+        self.true_child = true_child
+        self.false_child = false_child
+        self.action = action
+        self.root = root
+        self.sink_action = sink_action
+
+    @property
+    def n_nodes(self) -> int:
+        """Get the number of nodes."""
+        return len(self.feature)
+
+    @property
+    def n_leaves(self) -> int:
+        """Get the number of leaves."""
+        return sum(1 for feature in self.feature if feature == LEAF)
+
+    def depth(self, node: Optional[int] = None) -> int:
+        """Get the maximum number of tests from a node (default: the root) to a leaf."""
+        node = self.root if node is None else node
+        if node == LEAF:
+            return 0
+        # the children of a node are created before it, so they have smaller indices
+        depths = [0] * self.n_nodes
+        for current in range(node + 1):
+            if self.feature[current] != LEAF:
+                depths[current] = 1 + max(
+                    depths[self.true_child[current]], depths[self.false_child[current]]
+                )
+        return depths[node]
+
+    def get_action_for_state(self, state: State) -> Optional[Action]:
+        """Get the action of a composition state, or None if the diagram is empty."""
+        if state == COMPOSITION_MDP_SINK_STATE:
+            return self.sink_action
+        if self.root == LEAF:
+            return None
+        features = state_features(state)
+        node = self.root
+        while self.feature[node] != LEAF:
+            node = (
+                self.true_child[node]
+                if features[self.feature[node]] == self.value[node]
+                else self.false_child[node]
+            )
+        return self.action[node]
+
+    def __str__(self) -> str:
+        """Get the textual form of the diagram."""
+        if self.root == LEAF:
+            return "Empty diagram"
+        lines: List[str] = []
+        # the stack holds the nodes to print, with their indentation, and the "else" lines
+        stack: List[Any] = [(self.root, "")]
+        while len(stack) > 0:
+            item = stack.pop()
+            if isinstance(item, str):
+                lines.append(item)
+                continue
+            node, indent = item
+            feature = self.feature[node]
+            if feature == LEAF:
+                lines.append(f"{indent}Action={self.action[node]}")
+                continue
+            name = "DFA" if feature == DFA_FEATURE else f"service {feature - 1}"
+            lines.append(f"{indent}if {name} == {self.value[node]!r}:")
+            stack.append((self.false_child[node], indent + "    "))
+            stack.append(f"{indent}else:")
+            stack.append((self.true_child[node], indent + "    "))
+        return "\n".join(lines)
+
+
+class _DiagramBuilder:
+    """Greedy top-down construction of a PolicyDiagram, with node sharing."""
+
+    def __init__(self, features: np.ndarray, values: List[List[Any]], actions: List[Action]):
+        """
+        Initialize the builder.
+
+        :param features: the matrix of the encoded features, one row per state
+        :param values: the value of each code, for each feature
+        :param actions: the action of each code
+        """
+        self.features = features
+        self.values = values
+        self.actions = actions
+        self.nb_values = [len(feature_values) for feature_values in values]
+        self.feature: List[int] = []
+        self.value: List[Any] = []
+        self.true_child: List[int] = []
+        self.false_child: List[int] = []
+        self.action: List[Optional[Action]] = []
+        self._unique: Dict[Tuple, int] = {}
+
+    def _node(self, feature: int, value: Any, true_child: int, false_child: int, action: Optional[Action]) -> int:
+        """Get the node with the given content, creating it only if it does not exist yet."""
+        key = (feature, value, true_child, false_child, action)
+        node = self._unique.get(key)
+        if node is None:
+            node = len(self.feature)
+            self.feature.append(feature)
+            self.value.append(value)
+            self.true_child.append(true_child)
+            self.false_child.append(false_child)
+            self.action.append(action)
+            self._unique[key] = node
+        return node
+
+    def _best_split(self, rows: np.ndarray, codes: np.ndarray) -> Tuple[int, int]:
+        """Find the test (feature, value code) of minimum Gini impurity."""
+        nb_actions = len(self.actions)
+        total = np.bincount(codes, minlength=nb_actions).astype(np.float64)
+        best_impurity, best_split = np.inf, None
+        for feature in range(self.features.shape[1]):
+            column = self.features[rows, feature]
+            nb_values = self.nb_values[feature]
+            counts = np.bincount(
+                column * nb_actions + codes, minlength=nb_values * nb_actions
+            ).reshape(nb_values, nb_actions).astype(np.float64)
+            true_sizes = counts.sum(axis=1)
+            false_counts = total - counts
+            false_sizes = len(rows) - true_sizes
+            with np.errstate(divide="ignore", invalid="ignore"):
+                impurity = (
+                    true_sizes - np.where(true_sizes > 0, (counts ** 2).sum(axis=1) / true_sizes, 0.0)
+                ) + (
+                    false_sizes
+                    - np.where(false_sizes > 0, (false_counts ** 2).sum(axis=1) / false_sizes, 0.0)
+                )
+            impurity[(true_sizes == 0) | (false_sizes == 0)] = np.inf
+            value_code = int(np.argmin(impurity))
+            if impurity[value_code] < best_impurity:
+                best_impurity, best_split = impurity[value_code], (feature, value_code)
+        if best_split is None:
+            raise ValueError("states with the same features have different actions")
+        return best_split
+
+    def build(self, rows: np.ndarray, codes: np.ndarray) -> int:
+        """
+        Build the diagram of a subset of the states, and return its root.
+
+        The tree is grown depth-first with an explicit stack, so its depth is
+        not bounded by the recursion limit.
+        """
+        roots: List[int] = []
+        # a task either splits a subset of the states (test is None), or joins
+        # the roots of the two branches of a test, found on top of roots
+        tasks: List[Tuple[Optional[np.ndarray], Optional[np.ndarray], Optional[Tuple[int, int]]]] = [
+            (rows, codes, None)
+        ]
+        while len(tasks) > 0:
+            task_rows, task_codes, test = tasks.pop()
+            if test is not None:
+                false_child = roots.pop()
+                true_child = roots.pop()
+                if true_child == false_child:
+                    roots.append(true_child)
+                else:
+                    feature, value_code = test
+                    roots.append(
+                        self._node(feature, self.values[feature][value_code], true_child, false_child, None)
+                    )
+                continue
+            if np.all(task_codes == task_codes[0]):
+                roots.append(self._node(LEAF, None, LEAF, LEAF, self.actions[task_codes[0]]))
+                continue
+            feature, value_code = self._best_split(task_rows, task_codes)
+            is_true = self.features[task_rows, feature] == value_code
+            tasks.append((None, None, (feature, value_code)))
+            tasks.append((task_rows[~is_true], task_codes[~is_true], None))
+            tasks.append((task_rows[is_true], task_codes[is_true], None))
+        return roots.pop()
+
+
+def compile_policy_diagram(policy: Any, states: Iterable[State]) -> PolicyDiagram:
+    """
+    Compile a deterministic policy into a decision diagram, exact on the given states.
+
+    :param policy: the deterministic policy (e.g. a DetPolicy or a CompactPolicy).
+    :param states: the composition states where the diagram must agree with the policy.
+    :return: the decision diagram.
+    """
+    states = list(states)
+    sink_action = (
+        policy.get_action_for_state(COMPOSITION_MDP_SINK_STATE)
+        if COMPOSITION_MDP_SINK_STATE in states
+        else None
+    )
+    states = [state for state in states if state != COMPOSITION_MDP_SINK_STATE]
+    if len(states) == 0:
+        return PolicyDiagram([], [], [], [], [], LEAF, sink_action)
+
+    feature_rows = [state_features(state) for state in states]
+    nb_features = len(feature_rows[0])
+    value_index: List[Dict[Any, int]] = [{} for _ in range(nb_features)]
+    features = np.array(
+        [
+            [value_index[i].setdefault(value, len(value_index[i])) for i, value in enumerate(row)]
+            for row in feature_rows
+        ],
+        dtype=np.int64,
+    )
+    action_index: Dict[Action, int] = {}
+    codes = np.array(
+        [
+            action_index.setdefault(policy.get_action_for_state(state), len(action_index))
+            for state in states
+        ],
+        dtype=np.int64,
+    )
+    builder = _DiagramBuilder(
+        features, [list(index.keys()) for index in value_index], list(action_index.keys())
+    )
+    root = builder.build(np.arange(len(states)), codes)
+    diagram = PolicyDiagram(
+        builder.feature,
+        builder.value,
+        builder.true_child,
+        builder.false_child,
+        builder.action,
+        root,
+        sink_action,
+    )
+    check_equivalence(diagram, policy, states)
+    return diagram
+
+
+def compile_reachable_policy_diagram(mdp: MDP, policy: Any) -> PolicyDiagram:
+    """
+    Compile a deterministic policy into a decision diagram, exact on the policy-reachable states.
+
+    :param mdp: the composition MDP.
+    :param policy: the deterministic policy.
+    :return: the decision diagram.
+    """
+    return compile_policy_diagram(policy, policy_reachable_transitions(mdp, policy).keys())
+
+
+def check_equivalence(diagram: PolicyDiagram, policy: Any, states: Sequence[State]) -> None:
+    """
+    Check that a decision diagram agrees with a policy on the given states.
+
+    :param diagram: the decision diagram.
+    :param policy: the deterministic policy.
+    :param states: the composition states.
+    :raises ValueError: if the diagram and the policy disagree on some state.
+    """
+    for state in states:
+        expected_action = policy.get_action_for_state(state)
+        actual_action = diagram.get_action_for_state(state)
+        if actual_action != expected_action:
+            raise ValueError(
+                f"the diagram chooses {actual_action} in state {state}, instead of {expected_action}"
+            )
@@ -0,0 +1,230 @@
+"""
+This module implements a static analysis of the community of services, to be run before the composition.
+
+The analysis:
+- drops the dead services, i.e. the ones that, from their initial state,
+  can never perform an action of the target;
+- restricts the remaining services to their reachable states;
+- flags (and, on demand, removes) the dominated services, i.e. the ones
+  having the same dynamics as another service, but a worse reward.
+
+Since the system service is the product of the services, each removed
+service with n states divides the size of the composition by n.
+"""
+from collections import deque
+from typing import Deque, Dict, List, Sequence, Set, Tuple, Union
+
+from pythomata import SimpleDFA
+
+from stochastic_service_composition.services import Service
+from stochastic_service_composition.target import Target
+from stochastic_service_composition.types import Action, MDPDynamics, State
+
+
+class PreprocessingReport:
+    """The outcome of the preprocessing of a community of services."""
+
+    def __init__(
+        self,
+        kept_service_ids: List[int],
+        dead_service_ids: List[int],
+        dominated_by: Dict[int, int],
+        removed_dominated: bool,
+        product_size_before: int,
+        product_size_after: int,
+    ):
+        """
+        Initialize the report.
+
+        :param kept_service_ids: the original ids of the kept services; the i-th
+          kept service has id i in the composition.
+        :param dead_service_ids: the original ids of the dead services
+        :param dominated_by: a mapping from the original id of a dominated service
+          to the original id of a service dominating it
+        :param removed_dominated: whether the dominated services have been removed
+        :param product_size_before: the number of system states before the preprocessing
+        :param product_size_after: the number of system states after the preprocessing
+        """
+        self.kept_service_ids = kept_service_ids
+        self.dead_service_ids = dead_service_ids
+        self.dominated_by = dominated_by
+        self.removed_dominated = removed_dominated
+        self.product_size_before = product_size_before
+        self.product_size_after = product_size_after
+
+    def __str__(self) -> str:
+        """Get a human-readable summary of the report."""
+        dominated = ", ".join(
+            f"{worse} (by {better})" for worse, better in sorted(self.dominated_by.items())
+        )
+        return (
+            f"Dead services: {self.dead_service_ids}\n"
+            f"Dominated services: [{dominated}]"
+            f"{' (removed)' if self.removed_dominated else ''}\n"
+            f"Kept services: {self.kept_service_ids}\n"
+            f"System states: {self.product_size_before} -> {self.product_size_after}"
+        )
+
+
+def target_alphabet(target: Union[Target, SimpleDFA]) -> Set[Action]:
+    """
+    Get the actions that can contribute to the target.
+
+    For a DFA, only the symbols on the transitions of the trimmed automaton
+    are considered, i.e. the ones that can still lead to an accepting state.
+
+    :param target: the target service, or the target DFA.
+    :return: the set of relevant actions.
+    """
+    if isinstance(target, SimpleDFA):
+        trimmed = target.trim()
+        return {
+            symbol
+            for transitions_by_symbol in trimmed.transition_function.values()
+            for symbol in transitions_by_symbol.keys()
+        }
+    return set(target.actions)
+
+
+def product_size(services: Sequence[Service]) -> int:
+    """Get the number of states of the product of the services."""
+    result = 1
+    for service in services:
+        result *= len(service.states)
+    return result
+
+
+def reachable_states(service: Service) -> Set[State]:
+    """Get the states of a service reachable from its initial state."""
+    visited = {service.initial_state}
+    queue: Deque[State] = deque([service.initial_state])
+    while len(queue) > 0:
+        current_state = queue.popleft()
+        for next_states, _reward in service.transition_function.get(
+            current_state, {}
+        ).values():
+            for next_state in next_states:
+                if next_state not in visited:
+                    visited.add(next_state)
+                    queue.append(next_state)
+    return visited
+
+
+def is_dead_service(service: Service, alphabet: Set[Action]) -> bool:
+    """Check whether a service can never perform an action in the alphabet."""
+    return not any(
+        action in alphabet
+        for state in reachable_states(service)
+        for action in service.transition_function.get(state, {}).keys()
+    )
+
+
+def restrict_to_reachable(service: Service) -> Service:
+    """Remove the states of a service that are not reachable from its initial state."""
+    states = reachable_states(service)
+    if len(states) == len(service.states):
+        return service
+    transition_function: MDPDynamics = {
+        state: transitions_by_action
+        for state, transitions_by_action in service.transition_function.items()
+        if state in states
+    }
+    actions = {
+        action
+        for transitions_by_action in transition_function.values()
+        for action in transitions_by_action.keys()
+    }
+    return Service(
+        states,
+        actions,
+        set(service.final_states).intersection(states),
+        service.initial_state,
+        transition_function,
+    )
+
+
+def dominates(better: Service, worse: Service) -> bool:
+    """
+    Check whether a service strictly dominates another one.
+
+    The services must have the same states, initial and final states,
+    and the same actions with the same next-state distributions in every state;
+    moreover, the rewards of the better service must be at least as high
+    everywhere, and strictly higher somewhere.
+
+    :param better: the candidate dominating service
+    :param worse: the candidate dominated service
+    :return: True if better strictly dominates worse, False otherwise.
+    """
+    if (
+        better.states != worse.states
+        or better.initial_state != worse.initial_state
+        or better.final_states != worse.final_states
+    ):
+        return False
+    strictly_better = False
+    for state in better.states:
+        better_transitions = better.transition_function.get(state, {})
+        worse_transitions = worse.transition_function.get(state, {})
+        if better_transitions.keys() != worse_transitions.keys():
+            return False
+        for action, (better_next_states, better_reward) in better_transitions.items():
+            worse_next_states, worse_reward = worse_transitions[action]
+            if better_next_states != worse_next_states or better_reward < worse_reward:
+                return False
+            strictly_better = strictly_better or better_reward > worse_reward
+    return strictly_better
+
+
+def preprocess_services(
+    services: Sequence[Service],
+    target: Union[Target, SimpleDFA],
+    remove_dominated: bool = False,
+) -> Tuple[List[Service], PreprocessingReport]:
+    """
+    Run the static preprocessing on a community of services.
+
+    The removal of the dominated services is exact only for services that
+    never become unavailable (e.g. one-state services): for breakable
+    services, the dominated service is a spare that can be used while
+    the dominating one is broken.
+
+    :param services: the community of services.
+    :param target: the target service, or the target DFA.
+    :param remove_dominated: if True, remove the dominated services; otherwise, only flag them.
+    :return: the preprocessed services, and the report of the analysis.
+    """
+    alphabet = target_alphabet(target)
+    dead_service_ids = [
+        service_id
+        for service_id, service in enumerate(services)
+        if is_dead_service(service, alphabet)
+    ]
+    candidates = {
+        service_id: restrict_to_reachable(service)
+        for service_id, service in enumerate(services)
+        if service_id not in dead_service_ids
+    }
+
+    dominated_by: Dict[int, int] = {}
+    for worse_id, worse in candidates.items():
+        for better_id, better in candidates.items():
+            if better_id != worse_id and dominates(better, worse):
+                dominated_by[worse_id] = better_id
+                break
+
+    kept_service_ids = [
+        service_id
+        for service_id in candidates.keys()
+        if not (remove_dominated and service_id in dominated_by)
+    ]
+    kept_services = [candidates[service_id] for service_id in kept_service_ids]
+    report = PreprocessingReport(
+        kept_service_ids,
+        dead_service_ids,
+        dominated_by,
+        remove_dominated,
+        product_size(services),
+        product_size(kept_services),
+    )
+    return kept_services, report
@@ -0,0 +1,181 @@
+"""
+This module implements the pruning of the composition states that can never reach the goal.
+
+A state is live if some path from it reaches a goal state (e.g. a state
+whose DFA component is accepting), i.e. if it can still collect a goal reward.
+The other states form a closed region: all their successors are dead as well,
+hence their values do not depend on the rest of the MDP and can be computed
+upfront, on the dead region only (if all its rewards are zero, as for the
+sink state, all the values are zero).
+
+The dead states are then collapsed into COMPOSITION_MDP_SINK_STATE: the
+probability mass flowing into a dead state t is redirected to the sink, and
+gamma * prob * value(t) is added to the reward of the action. Since the Bellman
+backup is linear in the next-state values, the optimal values (and policy)
+of the live states are preserved.
+"""
+from collections import deque
+from typing import Callable, Deque, Dict, Set, Tuple
+
+from mdp_dp_rl.processes.mdp import MDP
+from pythomata import SimpleDFA
+
+from stochastic_service_composition.composition_mdp import (
+    COMPOSITION_MDP_SINK_STATE,
+    COMPOSITION_MDP_UNDEFINED_ACTION,
+)
+from stochastic_service_composition.types import MDPDynamics, State
+
+
+class PruningReport:
+    """The outcome of the pruning of a composition MDP."""
+
+    def __init__(self, n_states_before: int, n_states_after: int, n_dead_states: int):
+        """
+        Initialize the report.
+
+        :param n_states_before: the number of states before the pruning
+        :param n_states_after: the number of states after the pruning
+        :param n_dead_states: the number of states that cannot reach the goal
+        """
+        self.n_states_before = n_states_before
+        self.n_states_after = n_states_after
+        self.n_dead_states = n_dead_states
+
+    @property
+    def n_pruned_states(self) -> int:
+        """Get the number of states removed from the MDP."""
+        return self.n_states_before - self.n_states_after
+
+    def __str__(self) -> str:
+        """Get a human-readable summary of the report."""
+        return (
+            f"Dead states: {self.n_dead_states}\n"
+            f"States: {self.n_states_before} -> {self.n_states_after} "
+            f"({self.n_pruned_states} pruned)"
+        )
+
+
+def dfa_goal_predicate(dfa: SimpleDFA) -> Callable[[State], bool]:
+    """Get the goal predicate of the states of comp_mdp: the DFA component is accepting."""
+    accepting_states = set(dfa.accepting_states)
+    return (
+        lambda state: isinstance(state, tuple)
+        and len(state) == 2
+        and state[1] in accepting_states
+    )
+
+
+def live_states(mdp: MDP, is_goal: Callable[[State], bool]) -> Set[State]:
+    """
+    Compute the states from which a goal state is reachable (in at least one step).
+
+    :param mdp: the MDP.
+    :param is_goal: the goal predicate.
+    :return: the set of live states.
+    """
+    predecessors: Dict[State, Set[State]] = {}
+    for state, transitions_by_action in mdp.transitions.items():
+        for next_states in transitions_by_action.values():
+            for next_state in next_states.keys():
+                predecessors.setdefault(next_state, set()).add(state)
+
+    live: Set[State] = set()
+    queue: Deque[State] = deque()
+    for state in mdp.all_states:
+        if is_goal(state):
+            for predecessor in predecessors.get(state, set()):
+                if predecessor not in live:
+                    live.add(predecessor)
+                    queue.append(predecessor)
+    while len(queue) > 0:
+        state = queue.popleft()
+        for predecessor in predecessors.get(state, set()):
+            if predecessor not in live:
+                live.add(predecessor)
+                queue.append(predecessor)
+    return live
+
+
+def dead_region_values(
+    mdp: MDP, dead_states: Set[State], tolerance: float = 1e-8
+) -> Dict[State, float]:
+    """
+    Compute the optimal values of a closed region of the MDP.
+
+    :param mdp: the MDP.
+    :param dead_states: the states of the region; all their successors must be in the region.
+    :param tolerance: the tolerance of the value iteration.
+    :return: the optimal value of each state of the region.
+    """
+    values = {state: 0.0 for state in dead_states}
+    has_rewards = any(
+        reward != 0.0
+        for state in dead_states
+        for reward in mdp.rewards.get(state, {}).values()
+    )
+    if not has_rewards:
+        return values
+    while True:
+        max_residual = 0.0
+        for state in dead_states:
+            new_value = max(
+                mdp.rewards[state][action]
+                + mdp.gamma
+                * sum(prob * values[next_state] for next_state, prob in next_states.items())
+                for action, next_states in mdp.transitions[state].items()
+            )
+            max_residual = max(max_residual, abs(new_value - values[state]))
+            values[state] = new_value
+        if max_residual < tolerance:
+            return values
+
+
+def prune_goal_unreachable_states(
+    mdp: MDP, is_goal: Callable[[State], bool], tolerance: float = 1e-8
+) -> Tuple[MDP, PruningReport]:
+    """
+    Collapse the states that cannot reach the goal into the sink state.
+
+    The initial state of the MDP, if dead, is kept, with a single 'undefined'
+    action towards the sink whose reward is the value of the state.
+
+    :param mdp: the composition MDP (e.g. computed by comp_mdp).
+    :param is_goal: the goal predicate (e.g. dfa_goal_predicate(dfa)).
+    :param tolerance: the tolerance of the value iteration on the dead states.
+    :return: the pruned MDP, and the report of the pruning.
+    """
+    initial_state = getattr(mdp, "initial_state", None)
+    live = live_states(mdp, is_goal)
+    dead = set(mdp.all_states).difference(live)
+    values = dead_region_values(mdp, dead, tolerance)
+    gamma = mdp.gamma
+
+    transition_function: MDPDynamics = {}
+    for state in live:
+        transition_function[state] = {}
+        for action, next_states in mdp.transitions[state].items():
+            reward = mdp.rewards[state][action]
+            new_next_states: Dict[State, float] = {}
+            for next_state, prob in next_states.items():
+                if next_state in dead:
+                    reward += gamma * prob * values[next_state]
+                    next_state = COMPOSITION_MDP_SINK_STATE
+                new_next_states[next_state] = new_next_states.get(next_state, 0.0) + prob
+            transition_function[state][action] = (new_next_states, reward)
+    if initial_state in dead:
+        transition_function[initial_state] = {
+            COMPOSITION_MDP_UNDEFINED_ACTION: (
+                {COMPOSITION_MDP_SINK_STATE: 1.0},
+                values[initial_state],
+            )
+        }
+    if len(dead) > 0:
+        transition_function[COMPOSITION_MDP_SINK_STATE] = {
+            COMPOSITION_MDP_UNDEFINED_ACTION: ({COMPOSITION_MDP_SINK_STATE: 1.0}, 0.0)
+        }
+
+    result = MDP(transition_function, gamma)
+    result.initial_state = initial_state
+    report = PruningReport(len(mdp.all_states), len(transition_function), len(dead))
+    return result, report
@@ -0,0 +1,62 @@
+"""
+This module implements on-demand queries of the Q-values of a solved composition MDP.
+
+Instead of materializing the whole action-value function, the Q-values of a
+state are computed from the solved value vector, reading only the
+state-action rows of that state.
+"""
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from stochastic_service_composition.compact_mdp import CompactMDP
+from stochastic_service_composition.types import Action, State
+
+
+def state_q_values(mdp: CompactMDP, values: np.ndarray, state: State) -> Dict[Action, float]:
+    """
+    Compute the Q-values of all the actions of a state.
+
+    :param mdp: the compact MDP.
+    :param values: the solved value vector.
+    :param state: the state.
+    :return: the Q-value of each action available in the state.
+    """
+    state_id = mdp.state_index[state]
+    start, end = mdp.sa_ptr[state_id], mdp.sa_ptr[state_id + 1]
+    q_values = mdp.rewards[start:end] + mdp.gamma * (mdp.transitions[start:end] @ values)
+    return {
+        mdp.actions[code]: float(q_value)
+        for code, q_value in zip(mdp.sa_action[start:end], q_values)
+    }
+
+
+def q_value(mdp: CompactMDP, values: np.ndarray, state: State, action: Action) -> float:
+    """
+    Compute the Q-value of a state-action pair.
+
+    :param mdp: the compact MDP.
+    :param values: the solved value vector.
+    :param state: the state.
+    :param action: the action.
+    :return: the Q-value.
+    """
+    sa = mdp.state_action(mdp.state_index[state], action)
+    next_values = mdp.transitions[sa] @ values
+    return float(mdp.rewards[sa] + mdp.gamma * next_values[0])
+
+
+def top_k_actions(
+    mdp: CompactMDP, values: np.ndarray, state: State, k: int
+) -> List[Tuple[Action, float]]:
+    """
+    Get the k best actions of a state, with their Q-values.
+
+    :param mdp: the compact MDP.
+    :param values: the solved value vector.
+    :param state: the state.
+    :param k: the number of actions.
+    :return: the (action, Q-value) pairs, by decreasing Q-value.
+    """
+    q_values = state_q_values(mdp, values, state)
+    return sorted(q_values.items(), key=lambda item: item[1], reverse=True)[:k]
@@ -0,0 +1,118 @@
+"""
+This module implements the runtime controller of a composition policy.
+
+The controller loads the artifact written by
+runtime_artifact.write_runtime_artifact, which only contains the states
+reachable from the initial state under the policy. To keep it lightweight,
+this module only depends on the standard library: in particular, it does not
+import mdp_dp_rl, sympy or the composition code.
+"""
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+ARTIFACT_FORMAT_VERSION = 1
+SINK_STATE = -1
+
+RuntimeState = Any
+RuntimeAction = Any
+
+
+def _to_hashable(value: Any) -> Any:
+    """Convert the (nested) JSON lists into tuples."""
+    if isinstance(value, list):
+        return tuple(_to_hashable(item) for item in value)
+    return value
+
+
+class RuntimeController:
+    """The controller of a composition policy, restricted to the policy-reachable states."""
+
+    def __init__(self, data: Dict[str, Any]):
+        """
+        Initialize the controller from the content of an artifact.
+
+        :param data: the decoded JSON content of the artifact.
+        """
+        if data["version"] != ARTIFACT_FORMAT_VERSION:
+            raise ValueError(f"unsupported artifact version {data['version']}")
+        self.states: List[RuntimeState] = [_to_hashable(state) for state in data["states"]]
+        self.actions: List[RuntimeAction] = [_to_hashable(action) for action in data["actions"]]
+        self.policy: List[int] = data["policy"]
+        self.successors: List[List[Tuple[int, float]]] = data["successors"]
+        self.state_index: Dict[RuntimeState, int] = {
+            state: index for index, state in enumerate(self.states)
+        }
+        self.initial_state: RuntimeState = self.states[data["initial_state"]]
+
+        dfa = data["dfa"]
+        self.dfa_initial_state = dfa["initial_state"]
+        self.dfa_accepting_states = set(dfa["accepting_states"])
+        self.dfa_alphabet = set(dfa["alphabet"])
+        self.dfa_transitions: Dict[Any, Dict[Any, Any]] = {}
+        for start, symbol, end in dfa["transitions"]:
+            self.dfa_transitions.setdefault(start, {})[symbol] = end
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "RuntimeController":
+        """Load the controller from an artifact file."""
+        with open(path) as f:
+            return cls(json.load(f))
+
+    @property
+    def n_states(self) -> int:
+        """Get the number of states of the controller."""
+        return len(self.states)
+
+    def action(self, state: RuntimeState) -> RuntimeAction:
+        """
+        Get the action of the policy in a state.
+
+        :param state: the composition state (system state, DFA state), as tuples.
+        :return: the action, i.e. a pair (symbol, service id), or the undefined action.
+        """
+        return self.actions[self.policy[self.state_index[state]]]
+
+    def next_dfa_state(self, dfa_state: Any, symbol: Any) -> Optional[Any]:
+        """Get the next DFA state; symbols outside of the alphabet do not change it."""
+        if symbol not in self.dfa_alphabet:
+            return dfa_state
+        return self.dfa_transitions.get(dfa_state, {}).get(symbol)
+
+    def next_state(
+        self, state: RuntimeState, action: RuntimeAction, next_system_state: Tuple
+    ) -> RuntimeState:
+        """
+        Compute the next composition state, after the execution of an action.
+
+        :param state: the current composition state.
+        :param action: the executed action (symbol, service id).
+        :param next_system_state: the observed next system state.
+        :return: the next composition state.
+        """
+        if state == SINK_STATE or not isinstance(action, tuple):
+            return SINK_STATE
+        _system_state, dfa_state = state
+        symbol, _service_id = action
+        return tuple(next_system_state), self.next_dfa_state(dfa_state, symbol)
+
+    def next_states(self, state: RuntimeState) -> Dict[RuntimeState, float]:
+        """Get the distribution of the next states under the policy."""
+        return {
+            self.states[next_id]: prob
+            for next_id, prob in self.successors[self.state_index[state]]
+        }
+
+    def is_accepting(self, state: RuntimeState) -> bool:
+        """Check whether the DFA component of a state is accepting."""
+        return state != SINK_STATE and state[1] in self.dfa_accepting_states
+
+
+def load_runtime_controller(path: Union[str, Path]) -> RuntimeController:
+    """
+    Load the runtime controller from an artifact file.
+
+    :param path: the path of the artifact.
+    :return: the controller.
+    """
+    return RuntimeController.load(path)
@@ -0,0 +1,121 @@
+"""
+This module extracts the policy-reachable part of a solved composition MDP.
+
+comp_mdp seeds every system state, but only the states reachable from the
+initial state under the chosen policy matter for execution. The functions of
+this module walk the policy forward, and write the reachable states, with
+their chosen actions and transition supports, together with the DFA table,
+into a self-contained JSON artifact, to be loaded by runtime.RuntimeController.
+"""
+import json
+import os
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional, Union
+
+from mdp_dp_rl.processes.mdp import MDP
+from pythomata import SimpleDFA
+
+from stochastic_service_composition.composition_mdp import COMPOSITION_MDP_SINK_STATE
+from stochastic_service_composition.runtime import ARTIFACT_FORMAT_VERSION
+from stochastic_service_composition.types import Action, Prob, State
+
+
+def policy_reachable_transitions(
+    mdp: MDP, policy: Any, initial_state: Optional[State] = None
+) -> Dict[State, Dict[State, Prob]]:
+    """
+    Compute the states reachable from the initial state under a deterministic policy.
+
+    :param mdp: the composition MDP.
+    :param policy: the deterministic policy (e.g. a DetPolicy or a CompactPolicy).
+    :param initial_state: the initial state (default: the initial state of the MDP).
+    :return: the next-state distribution under the policy of each reachable state,
+      in breadth-first order from the initial state.
+    """
+    initial_state = mdp.initial_state if initial_state is None else initial_state
+    result: Dict[State, Dict[State, Prob]] = {}
+    queue: Deque[State] = deque([initial_state])
+    seen = {initial_state}
+    while len(queue) > 0:
+        state = queue.popleft()
+        action = policy.get_action_for_state(state)
+        next_states = mdp.transitions[state][action]
+        result[state] = next_states
+        for next_state in next_states.keys():
+            if next_state not in seen:
+                seen.add(next_state)
+                queue.append(next_state)
+    return result
+
+
+def _json_state(state: State) -> Any:
+    """Convert a composition state into a JSON value."""
+    if state == COMPOSITION_MDP_SINK_STATE:
+        return COMPOSITION_MDP_SINK_STATE
+    system_state, dfa_state = state
+    return [list(system_state), dfa_state]
+
+
+def _json_action(action: Action) -> Any:
+    """Convert a composition action into a JSON value."""
+    return list(action) if isinstance(action, tuple) else action
+
+
+def runtime_artifact(mdp: MDP, policy: Any, dfa: SimpleDFA) -> Dict[str, Any]:
+    """
+    Build the content of the runtime artifact of a solved composition.
+
+    :param mdp: the composition MDP.
+    :param policy: the deterministic policy.
+    :param dfa: the target DFA.
+    :return: the content of the artifact, as a JSON-serializable dictionary.
+    """
+    reachable = policy_reachable_transitions(mdp, policy)
+    state_index = {state: index for index, state in enumerate(reachable.keys())}
+    action_index: Dict[Action, int] = {}
+    policy_codes: List[int] = []
+    successors: List[List[Any]] = []
+    for state, next_states in reachable.items():
+        action = policy.get_action_for_state(state)
+        policy_codes.append(action_index.setdefault(action, len(action_index)))
+        successors.append(
+            [[state_index[next_state], prob] for next_state, prob in next_states.items()]
+        )
+    dfa = dfa.trim()
+    return {
+        "version": ARTIFACT_FORMAT_VERSION,
+        "initial_state": state_index[mdp.initial_state],
+        "states": [_json_state(state) for state in reachable.keys()],
+        "actions": [_json_action(action) for action in action_index.keys()],
+        "policy": policy_codes,
+        "successors": successors,
+        "dfa": {
+            "initial_state": dfa.initial_state,
+            "accepting_states": sorted(dfa.accepting_states, key=str),
+            "alphabet": sorted(dfa.alphabet, key=str),
+            "transitions": [
+                [start, symbol, end]
+                for start, transitions_by_symbol in dfa.transition_function.items()
+                for symbol, end in transitions_by_symbol.items()
+            ],
+        },
+    }
+
+
+def write_runtime_artifact(path: Union[str, Path], mdp: MDP, policy: Any, dfa: SimpleDFA) -> int:
+    """
+    Write the runtime artifact of a solved composition.
+
+    :param path: the path of the artifact.
+    :param mdp: the composition MDP.
+    :param policy: the deterministic policy.
+    :param dfa: the target DFA.
+    :return: the number of policy-reachable states.
+    """
+    content = runtime_artifact(mdp, policy, dfa)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(content, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+    return len(content["states"])
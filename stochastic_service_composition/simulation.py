@@ -0,0 +1,205 @@
+"""
+This module implements a vectorized Monte Carlo simulator of composition policies.
+
+The episodes are run in lockstep: the current state of every episode is an
+entry of a NumPy array, and at each step all the next states are sampled at
+once. The rows of the policy transition matrix (in CSR form) are turned into
+a single array of cumulative probabilities, so that sampling a next state is
+a binary search in the row of the current state. Optionally, the episodes are
+split across a pool of processes.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+from pythomata import SimpleDFA
+
+from stochastic_service_composition.compact_mdp import CompactMDP
+from stochastic_service_composition.composition_mdp import COMPOSITION_MDP_SINK_STATE
+
+DEFAULT_HORIZON = 100
+DEFAULT_BROKEN_STATE = "br"
+
+
+class SimulationResult:
+    """The outcome of a batch of simulated episodes."""
+
+    def __init__(self, returns: np.ndarray, accepted: np.ndarray, repairs: np.ndarray, horizon: int):
+        """
+        Initialize the result.
+
+        :param returns: the (discounted) total reward of each episode
+        :param accepted: whether each episode reached an accepting DFA state
+        :param repairs: the number of repairs of each episode
+        :param horizon: the number of steps of each episode
+        """
+        self.returns = returns
+        self.accepted = accepted
+        self.repairs = repairs
+        self.horizon = horizon
+
+    @property
+    def nb_episodes(self) -> int:
+        """Get the number of episodes."""
+        return len(self.returns)
+
+    @property
+    def acceptance_rate(self) -> float:
+        """Get the fraction of the episodes reaching an accepting DFA state."""
+        return float(np.mean(self.accepted)) if self.nb_episodes > 0 else 0.0
+
+    @property
+    def mean_return(self) -> float:
+        """Get the average total reward."""
+        return float(np.mean(self.returns)) if self.nb_episodes > 0 else 0.0
+
+    @classmethod
+    def merge(cls, results: List["SimulationResult"]) -> "SimulationResult":
+        """Merge the results of several batches with the same horizon."""
+        return cls(
+            np.concatenate([result.returns for result in results]),
+            np.concatenate([result.accepted for result in results]),
+            np.concatenate([result.repairs for result in results]),
+            results[0].horizon,
+        )
+
+    def __str__(self) -> str:
+        """Get a human-readable summary of the result."""
+        percentiles = np.percentile(self.returns, [5, 50, 95]) if self.nb_episodes > 0 else [0.0] * 3
+        return (
+            f"Episodes: {self.nb_episodes} (horizon {self.horizon})\n"
+            f"Return: mean={self.mean_return:.4f}, std={np.std(self.returns):.4f}, "
+            f"p5={percentiles[0]:.4f}, p50={percentiles[1]:.4f}, p95={percentiles[2]:.4f}\n"
+            f"Acceptance rate: {self.acceptance_rate:.4f}\n"
+            f"Repairs per episode: {np.mean(self.repairs) if self.nb_episodes > 0 else 0.0:.4f}"
+        )
+
+
+class _PolicyChain:
+    """The Markov chain induced by a deterministic policy, in a form suitable for sampling."""
+
+    def __init__(
+        self,
+        mdp: CompactMDP,
+        best_sa: np.ndarray,
+        accepting: np.ndarray,
+        repairing: np.ndarray,
+    ):
+        """Initialize the chain."""
+        policy_transitions = mdp.transitions[best_sa]
+        policy_transitions.sort_indices()
+        self.indptr = policy_transitions.indptr
+        self.indices = policy_transitions.indices
+        self.cumulative = np.cumsum(policy_transitions.data)
+        # the cumulative probability before the first entry of each row
+        self.row_base = np.concatenate(([0.0], self.cumulative))[self.indptr[:-1]]
+        self.row_total = np.concatenate(([0.0], self.cumulative))[self.indptr[1:]] - self.row_base
+        self.rewards = mdp.rewards[best_sa]
+        self.gamma = mdp.gamma
+        self.initial_state = mdp.initial_state
+        self.accepting = accepting
+        self.repairing = repairing
+
+    def run(self, nb_episodes: int, horizon: int, discounted: bool, seed) -> SimulationResult:
+        """Run a batch of episodes in lockstep."""
+        rng = np.random.default_rng(seed)
+        states = np.full(nb_episodes, self.initial_state, dtype=np.int64)
+        returns = np.zeros(nb_episodes)
+        repairs = np.zeros(nb_episodes, dtype=np.int64)
+        accepted = self.accepting[states]
+        discount = 1.0
+        for _ in range(horizon):
+            returns += discount * self.rewards[states]
+            repairs += self.repairing[states]
+            if discounted:
+                discount *= self.gamma
+            targets = self.row_base[states] + rng.random(nb_episodes) * self.row_total[states]
+            positions = np.searchsorted(self.cumulative, targets, side="right")
+            # guard against rounding at the end of the rows
+            positions = np.clip(positions, self.indptr[states], self.indptr[states + 1] - 1)
+            states = self.indices[positions]
+            accepted |= self.accepting[states]
+        return SimulationResult(returns, accepted, repairs, horizon)
+
+
+def accepting_mask(mdp: CompactMDP, dfa: SimpleDFA) -> np.ndarray:
+    """Get the mask of the composition states whose DFA component is accepting."""
+    return np.array(
+        [
+            state != COMPOSITION_MDP_SINK_STATE and dfa.is_accepting(state[1])
+            for state in mdp.states
+        ],
+        dtype=bool,
+    )
+
+
+def repair_mask(
+    mdp: CompactMDP, best_sa: np.ndarray, broken_state: str = DEFAULT_BROKEN_STATE
+) -> np.ndarray:
+    """
+    Get the mask of the composition states where the policy repairs a service.
+
+    A step is a repair if the service chosen by the policy is in the broken state.
+
+    :param mdp: the compact composition MDP.
+    :param best_sa: the chosen state-action pair of each state.
+    :param broken_state: the name of the broken state of the services.
+    :return: the mask.
+    """
+    result = np.zeros(mdp.n_states, dtype=bool)
+    for state_id, state in enumerate(mdp.states):
+        action = mdp.actions[mdp.sa_action[best_sa[state_id]]]
+        if state == COMPOSITION_MDP_SINK_STATE or not isinstance(action, tuple):
+            continue
+        system_state, _dfa_state = state
+        _symbol, service_id = action
+        result[state_id] = system_state[service_id] == broken_state
+    return result
+
+
+def _run_batch(chain: _PolicyChain, nb_episodes: int, horizon: int, discounted: bool, seed) -> SimulationResult:
+    """Run a batch of episodes (in a worker process)."""
+    return chain.run(nb_episodes, horizon, discounted, seed)
+
+
+def simulate(
+    mdp: CompactMDP,
+    best_sa: np.ndarray,
+    dfa: SimpleDFA,
+    nb_episodes: int,
+    horizon: int = DEFAULT_HORIZON,
+    discounted: bool = True,
+    broken_state: str = DEFAULT_BROKEN_STATE,
+    nb_workers: int = 1,
+    seed: Optional[int] = None,
+) -> SimulationResult:
+    """
+    Simulate a deterministic policy from the initial state of the composition.
+
+    :param mdp: the compact composition MDP.
+    :param best_sa: the chosen state-action pair of each state (e.g. SolverResult.best_sa,
+      or CompactMDP.policy_state_actions of a DetPolicy).
+    :param dfa: the target DFA.
+    :param nb_episodes: the number of episodes.
+    :param horizon: the number of steps of each episode.
+    :param discounted: whether the total reward is discounted.
+    :param broken_state: the name of the broken state of the services, to count the repairs.
+    :param nb_workers: the number of processes; the episodes are split evenly among them.
+    :param seed: the seed of the random generator.
+    :return: the result.
+    """
+    if mdp.initial_state is None:
+        raise ValueError("the MDP has no initial state")
+    chain = _PolicyChain(
+        mdp, best_sa, accepting_mask(mdp, dfa), repair_mask(mdp, best_sa, broken_state)
+    )
+    if nb_workers <= 1:
+        return chain.run(nb_episodes, horizon, discounted, seed)
+    seeds = np.random.SeedSequence(seed).spawn(nb_workers)
+    batch_sizes = [len(batch) for batch in np.array_split(np.arange(nb_episodes), nb_workers)]
+    with ProcessPoolExecutor(max_workers=nb_workers) as executor:
+        futures = [
+            executor.submit(_run_batch, chain, batch_size, horizon, discounted, batch_seed)
+            for batch_size, batch_seed in zip(batch_sizes, seeds)
+        ]
+        return SimulationResult.merge([future.result() for future in futures])
@@ -0,0 +1,350 @@
+"""
+This module implements solvers for the compact (sparse) form of the composition MDP.
+
+All the solvers work on CompactMDP, and perform the Bellman backups as
+vectorized sparse matrix-vector products.
+"""
+from typing import Dict, List, Optional
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+from mdp_dp_rl.processes.det_policy import DetPolicy
+
+from stochastic_service_composition.checkpoint import SolverCheckpoint
+from stochastic_service_composition.compact_mdp import CompactMDP
+from stochastic_service_composition.instrumentation import ProgressReporter
+from stochastic_service_composition.types import Action, State
+
+DEFAULT_EPSILON = 1e-4
+DEFAULT_EVALUATION_TOLERANCE = 1e-10
+# above this number of states, policy evaluation uses an iterative (Krylov) solver
+DIRECT_SOLVER_MAX_STATES = 100000
+
+
+class SolverResult:
+    """The outcome of a solver."""
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        best_sa: np.ndarray,
+        iterations: int,
+        lower: Optional[np.ndarray] = None,
+        upper: Optional[np.ndarray] = None,
+        precision: Optional[float] = None,
+        eliminated_fractions: Optional[List[float]] = None,
+    ):
+        """
+        Initialize the result.
+
+        :param values: the (estimated) value of each state
+        :param best_sa: the chosen state-action pair of each state
+        :param iterations: the number of sweeps performed
+        :param lower: the lower bound of the value of each state, if computed
+        :param upper: the upper bound of the value of each state, if computed
+        :param precision: the guaranteed precision, i.e. the gap between the bounds
+          where the stopping criterion was checked, if computed
+        :param eliminated_fractions: the fraction of state-action pairs eliminated
+          after each sweep, if action elimination was used
+        """
+        self.values = values
+        self.best_sa = best_sa
+        self.iterations = iterations
+        self.lower = lower
+        self.upper = upper
+        self.precision = precision
+        self.eliminated_fractions = eliminated_fractions
+
+
+def value_iteration(
+    mdp: CompactMDP,
+    epsilon: float = DEFAULT_EPSILON,
+    max_iterations: Optional[int] = None,
+    progress: Optional[ProgressReporter] = None,
+    checkpoint: Optional[SolverCheckpoint] = None,
+) -> SolverResult:
+    """
+    Run value iteration until the difference between successive iterates is below epsilon.
+
+    :param mdp: the compact MDP.
+    :param epsilon: the tolerance on the successive-iterate difference.
+    :param max_iterations: the maximum number of sweeps (default: unbounded).
+    :param progress: an optional progress reporter, notified of every sweep.
+    :param checkpoint: an optional checkpoint of the iterates; if it already
+      exists, the iterations resume from it.
+    :return: the result.
+    """
+    values = np.zeros(mdp.n_states, dtype=mdp.value_dtype)
+    iterations = 0
+    restored = (
+        checkpoint.restore(mdp.n_states, "value_iteration", mdp.fingerprint(), epsilon=epsilon)
+        if checkpoint is not None
+        else None
+    )
+    if restored is not None:
+        iterations, arrays = restored
+        values = arrays["values"]
+    while True:
+        new_values, best_sa = mdp.bellman(values)
+        iterations += 1
+        residual = np.max(np.abs(new_values - values)) if mdp.n_states > 0 else 0.0
+        values = new_values
+        done = residual < epsilon or (max_iterations is not None and iterations >= max_iterations)
+        if checkpoint is not None:
+            checkpoint.maybe_save(iterations, values=values)
+        if progress is not None:
+            progress.sweep(iterations, residual, force=done)
+        if done:
+            return SolverResult(values, best_sa, iterations)
+
+
+def reward_bounds(mdp: CompactMDP) -> np.ndarray:
+    """Get the trivial bounds (lower, upper) of the values, from the reward range of the MDP."""
+    return np.array([mdp.rewards.min(), mdp.rewards.max()]) / (1.0 - mdp.gamma)
+
+
+def interval_iteration(
+    mdp: CompactMDP,
+    epsilon: float = DEFAULT_EPSILON,
+    initial_state_only: bool = True,
+    max_iterations: Optional[int] = None,
+    progress: Optional[ProgressReporter] = None,
+    checkpoint: Optional[SolverCheckpoint] = None,
+) -> SolverResult:
+    """
+    Run interval (lower and upper bound) value iteration.
+
+    The bounds are initialized with rmin / (1 - gamma) and rmax / (1 - gamma);
+    since the Bellman operator is monotone, and the initial bounds are a sub-
+    and a super-solution respectively, every iterate still bounds the optimal
+    values. Hence, the gap between the bounds is a sound precision guarantee.
+
+    :param mdp: the compact MDP.
+    :param epsilon: the required precision.
+    :param initial_state_only: if True, stop as soon as the gap at the initial
+      state is below epsilon; otherwise, require it on all the states.
+    :param max_iterations: the maximum number of sweeps (default: unbounded).
+    :param progress: an optional progress reporter, notified of every sweep.
+    :param checkpoint: an optional checkpoint of the iterates; if it already
+      exists, the iterations resume from it.
+    :return: the result; values are the midpoints of the bounds, and the
+      policy is greedy with respect to the lower bound.
+    """
+    if initial_state_only and mdp.initial_state is None:
+        raise ValueError("the MDP has no initial state")
+    min_value, max_value = reward_bounds(mdp)
+    lower = np.full(mdp.n_states, min_value, dtype=mdp.value_dtype)
+    upper = np.full(mdp.n_states, max_value, dtype=mdp.value_dtype)
+    iterations = 0
+    restored = (
+        checkpoint.restore(
+            mdp.n_states,
+            "interval_iteration",
+            mdp.fingerprint(),
+            epsilon=epsilon,
+            initial_state_only=initial_state_only,
+        )
+        if checkpoint is not None
+        else None
+    )
+    if restored is not None:
+        iterations, arrays = restored
+        lower, upper = arrays["lower"], arrays["upper"]
+    while True:
+        new_lower, best_sa = mdp.bellman(lower)
+        new_upper, _ = mdp.bellman(upper)
+        lower = np.maximum(lower, new_lower)
+        upper = np.minimum(upper, new_upper)
+        iterations += 1
+        if checkpoint is not None:
+            checkpoint.maybe_save(iterations, lower=lower, upper=upper)
+        gap = upper - lower
+        precision = (
+            float(gap[mdp.initial_state]) if initial_state_only else float(gap.max())
+        )
+        done = precision < epsilon or (max_iterations is not None and iterations >= max_iterations)
+        if progress is not None:
+            progress.sweep(iterations, precision, force=done)
+        if done:
+            return SolverResult(
+                (lower + upper) / 2.0, best_sa, iterations, lower, upper, precision
+            )
+
+
+def action_elimination_iteration(
+    mdp: CompactMDP,
+    epsilon: float = DEFAULT_EPSILON,
+    initial_state_only: bool = True,
+    max_iterations: Optional[int] = None,
+    progress: Optional[ProgressReporter] = None,
+    checkpoint: Optional[SolverCheckpoint] = None,
+) -> SolverResult:
+    """
+    Run interval value iteration with bounds-based action elimination.
+
+    Every sweep computes lower and upper bounds of the Q-values of the
+    surviving state-action pairs. A pair whose upper bound is below the
+    lower bound of its state (i.e. the best lower bound among its actions)
+    is provably suboptimal, and since the bounds only get tighter, it is
+    permanently removed: the later sweeps only back up the surviving pairs.
+    Removing such pairs never changes the bounds of the states.
+
+    :param mdp: the compact MDP.
+    :param epsilon: the required precision.
+    :param initial_state_only: if True, stop as soon as the gap at the initial
+      state is below epsilon; otherwise, require it on all the states.
+    :param max_iterations: the maximum number of sweeps (default: unbounded).
+    :param progress: an optional progress reporter, notified of every sweep.
+    :param checkpoint: an optional checkpoint of the iterates; if it already
+      exists, the iterations resume from it.
+    :return: the result, including the eliminated fraction after each sweep.
+    """
+    if mdp.decodes_transitions:
+        raise ValueError(
+            "action elimination slices the decoded transition matrix at every sweep; "
+            "solve an encoded MDP with value_iteration or parallel_value_iteration"
+        )
+    if initial_state_only and mdp.initial_state is None:
+        raise ValueError("the MDP has no initial state")
+    min_value, max_value = reward_bounds(mdp)
+    lower = np.full(mdp.n_states, min_value, dtype=mdp.value_dtype)
+    upper = np.full(mdp.n_states, max_value, dtype=mdp.value_dtype)
+    active = np.arange(mdp.n_state_actions)
+    eliminated_fractions: List[float] = []
+    iterations = 0
+    restored = (
+        checkpoint.restore(
+            mdp.n_states,
+            "action_elimination_iteration",
+            mdp.fingerprint(),
+            epsilon=epsilon,
+            initial_state_only=initial_state_only,
+        )
+        if checkpoint is not None
+        else None
+    )
+    if restored is not None:
+        iterations, arrays = restored
+        lower, upper, active = arrays["lower"], arrays["upper"], arrays["active"]
+    while True:
+        # restrict the MDP to the surviving state-action pairs
+        active_transitions = mdp.transitions[active]
+        active_rewards = mdp.rewards[active]
+        active_state = mdp.sa_state[active]
+        starts = np.flatnonzero(np.r_[True, active_state[1:] != active_state[:-1]])
+        nb_active = len(active)
+        while len(active) == nb_active:
+            q_lower = active_rewards + mdp.gamma * (active_transitions @ lower)
+            q_upper = active_rewards + mdp.gamma * (active_transitions @ upper)
+            lower = np.maximum(lower, np.maximum.reduceat(q_lower, starts))
+            upper = np.minimum(upper, np.maximum.reduceat(q_upper, starts))
+            iterations += 1
+
+            surviving = q_upper >= lower[active_state]
+            if not surviving.all():
+                active, active_state = active[surviving], active_state[surviving]
+            eliminated_fractions.append(1.0 - len(active) / mdp.n_state_actions)
+            if checkpoint is not None:
+                checkpoint.maybe_save(iterations, lower=lower, upper=upper, active=active)
+
+            gap = upper - lower
+            precision = (
+                float(gap[mdp.initial_state]) if initial_state_only else float(gap.max())
+            )
+            done = precision < epsilon or (
+                max_iterations is not None and iterations >= max_iterations
+            )
+            if progress is not None:
+                progress.sweep(iterations, precision, force=done)
+            if done:
+                q_lower = q_lower[surviving]
+                starts = np.flatnonzero(np.r_[True, active_state[1:] != active_state[:-1]])
+                is_max = q_lower == np.maximum.reduceat(q_lower, starts)[active_state]
+                candidates = np.where(is_max, np.arange(len(active)), len(active))
+                best_sa = active[np.minimum.reduceat(candidates, starts)]
+                return SolverResult(
+                    (lower + upper) / 2.0,
+                    best_sa,
+                    iterations,
+                    lower,
+                    upper,
+                    precision,
+                    eliminated_fractions,
+                )
+
+
+def _bicgstab(matrix: sp.spmatrix, vector: np.ndarray, x0: np.ndarray, tolerance: float) -> np.ndarray:
+    """Solve a linear system with BiCGSTAB, across the SciPy versions naming the tolerance differently."""
+    try:
+        solution, info = spla.bicgstab(matrix, vector, x0=x0, rtol=tolerance, atol=0.0)
+    except TypeError:
+        solution, info = spla.bicgstab(matrix, vector, x0=x0, tol=tolerance, atol=0.0)
+    if info != 0:
+        raise RuntimeError(f"policy evaluation did not converge (info={info})")
+    return solution
+
+
+def evaluate_policy(
+    mdp: CompactMDP,
+    best_sa: np.ndarray,
+    method: Optional[str] = None,
+    tolerance: float = DEFAULT_EVALUATION_TOLERANCE,
+) -> np.ndarray:
+    """
+    Compute the value of a deterministic policy, by solving (I - gamma P_pi) v = r_pi.
+
+    :param mdp: the compact MDP.
+    :param best_sa: the state-action pair chosen by the policy in each state.
+    :param method: "direct" (sparse LU) or "krylov" (BiCGSTAB); by default, the
+      direct solver is used up to DIRECT_SOLVER_MAX_STATES states.
+    :param tolerance: the relative tolerance of the Krylov solver.
+    :return: the value of each state.
+    """
+    if method is None:
+        method = "direct" if mdp.n_states <= DIRECT_SOLVER_MAX_STATES else "krylov"
+    policy_transitions = mdp.transitions[best_sa]
+    policy_rewards = mdp.rewards[best_sa]
+    matrix = sp.identity(mdp.n_states, format="csr") - mdp.gamma * policy_transitions
+    if method == "direct":
+        return spla.spsolve(matrix.tocsc(), policy_rewards)
+    if method == "krylov":
+        return _bicgstab(matrix, policy_rewards, policy_rewards, tolerance)
+    raise ValueError(f"unknown method {method}")
+
+
+def get_value_func_dict(
+    mdp: CompactMDP, policy: DetPolicy, method: Optional[str] = None
+) -> Dict[State, float]:
+    """
+    Compute the value function of a deterministic policy, indexed by state.
+
+    :param mdp: the compact MDP.
+    :param policy: the deterministic policy; it must be defined on all the states.
+    :param method: the linear solver (see evaluate_policy).
+    :return: the value of each state.
+    """
+    values = evaluate_policy(mdp, mdp.policy_state_actions(policy), method=method)
+    return mdp.value_dict(values)
+
+
+def get_act_value_func_dict(
+    mdp: CompactMDP, policy: DetPolicy, method: Optional[str] = None
+) -> Dict[State, Dict[Action, float]]:
+    """
+    Compute the action-value function of a deterministic policy, indexed by state and action.
+
+    :param mdp: the compact MDP.
+    :param policy: the deterministic policy; it must be defined on all the states.
+    :param method: the linear solver (see evaluate_policy).
+    :return: the Q-value of each state-action pair.
+    """
+    values = evaluate_policy(mdp, mdp.policy_state_actions(policy), method=method)
+    q_values = mdp.q_values(values)
+    result: Dict[State, Dict[Action, float]] = {}
+    for state_id, state in enumerate(mdp.states):
+        result[state] = {
+            mdp.actions[mdp.sa_action[sa]]: float(q_values[sa])
+            for sa in range(mdp.sa_ptr[state_id], mdp.sa_ptr[state_id + 1])
+        }
+    return result